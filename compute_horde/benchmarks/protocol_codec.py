@@ -0,0 +1,336 @@
+"""
+Benchmark of encoding and decoding protocol messages: throughput and peak memory of
+
+* every mv_protocol and em_protocol message type, in every encoding and compression available, with stdout,
+  stderr and inline volumes from a few bytes up to 10 MiB,
+* json serializers of `BaseRequest` (standard library vs orjson) on job results with large stdout,
+* `ECRedisChannelLayer.serialize` / `deserialize` of the miner's layer messages,
+* the miner's `layer_utils.JobRequest` round trip (V0JobRequest -> layer message -> JobRequest).
+
+Results are written as json. With --compare, exits with status 1 if the throughput of any case dropped more than
+--max-regression percent compared to a previous results file (compare results from the same machine only).
+
+    python compute_horde/benchmarks/protocol_codec.py [--output results.json] [--compare baseline.json] [--max-regression 10]
+"""
+import argparse
+import base64
+import dataclasses
+import datetime
+import functools
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+from collections.abc import Callable
+
+from compute_horde_miner.channel_layer.channel_layer import ECRedisChannelLayer
+from compute_horde_miner.miner.miner_consumer import layer_utils
+from protocol_parse import JOB_REQUEST, JOB_UUID, SAMPLES
+
+from compute_horde import base_requests, transport
+from compute_horde.base_requests import BaseRequest
+from compute_horde.mv_protocol import miner_requests as mv_miner_requests
+from compute_horde.mv_protocol import validator_requests as mv_validator_requests
+
+SIZES = {
+    'tiny': 0,
+    '1KiB': 1024,
+    '64KiB': 64 * 1024,
+    '1MiB': 1024 * 1024,
+    '10MiB': 10 * 1024 * 1024,
+}
+OUTPUT_FIELDS = ('docker_process_stdout', 'docker_process_stderr', 'data')
+
+
+@dataclasses.dataclass
+class Case:
+    name: str
+    encode: Callable[[], object]
+    decode: Callable[[], object]
+    frame_bytes: int
+
+
+@functools.cache
+def make_output(size: int) -> str:
+    """Log-like text, compressible about as well as real job output"""
+    rng = random.Random(size)
+    lines = []
+    length = 0
+    while length < size:
+        line = f'[{rng.randrange(10 ** 6):06}] step {len(lines)} loss={rng.random():.6f} rate={rng.random():.3e}\n'
+        lines.append(line)
+        length += len(line)
+    return ''.join(lines)[:size]
+
+
+@functools.cache
+def make_volume_contents(size: int) -> bytes:
+    """Incompressible bytes, inline volumes are zip archives"""
+    return random.Random(size).randbytes(size)
+
+
+def sized(sample: dict, size: int) -> dict | None:
+    """`sample` with its large fields of `size` bytes, None if it has none"""
+    if not size:
+        return sample
+    if any(field in sample for field in OUTPUT_FIELDS):
+        return {**sample, **{field: make_output(size) for field in OUTPUT_FIELDS if field in sample}}
+    if 'volume' in sample:
+        contents = base64.b64encode(make_volume_contents(size)).decode()
+        return {**sample, 'volume': {**sample['volume'], 'contents': contents}}
+    return None
+
+
+def protocol_cases(sizes: dict[str, int]) -> list[Case]:
+    cases = []
+    for base, sample in SAMPLES:
+        for size_label, size in sizes.items():
+            if (sized_sample := sized(sample, size)) is None:
+                continue
+            model = base.parse_decoded(sized_sample)
+            for encoding in transport.supported_encodings():
+                for compression in [None, *transport.supported_compressions()]:
+                    frame = transport.encode(model, encoding, compression)
+                    compressed = isinstance(frame, bytes) and frame.startswith(transport.COMPRESSED_FRAME_PREFIX)
+                    if compression is not None and not compressed:
+                        continue  # below the compression threshold, same as uncompressed
+                    name = (f'{base.__module__.removeprefix("compute_horde.")}.{sample["message_type"]}'
+                            f'[{size_label}]/{encoding.value}{f"+{compression.value}" if compression else ""}')
+                    cases.append(Case(
+                        name=name,
+                        encode=_protocol_encode(model, encoding, compression),
+                        decode=_protocol_decode(base, frame),
+                        frame_bytes=len(frame),
+                    ))
+    return cases
+
+
+def _protocol_encode(model: BaseRequest, encoding: transport.Encoding, compression: transport.Compression | None):
+    return lambda: transport.encode(model, encoding, compression)
+
+
+def _protocol_decode(base: type[BaseRequest], frame: str | bytes):
+    return lambda: base.parse_decoded(transport.decode(frame))
+
+
+def serializer_cases(sizes: dict[str, int]) -> list[Case]:
+    serializers = {
+        'stdlib': (json.dumps, json.loads),
+        'orjson': (base_requests.json_dumps, base_requests.json_loads),
+    }
+    cases = []
+    for size_label, size in sizes.items():
+        output = make_output(size)
+        model = mv_miner_requests.V0JobFinishedRequest(
+            job_uuid=JOB_UUID,
+            docker_process_stdout=output,
+            docker_process_stderr=output,
+        )
+        for serializer, (dumps, loads) in serializers.items():
+            frame = dumps(model.dict(), default=_serializer_default)
+            cases.append(Case(
+                name=f'serializer.V0JobFinishedRequest[{size_label}]/{serializer}',
+                encode=_serializer_encode(model, dumps),
+                decode=_serializer_decode(frame, loads),
+                frame_bytes=len(frame),
+            ))
+    return cases
+
+
+def _serializer_default(value):
+    return value.value
+
+
+def _serializer_encode(model: BaseRequest, dumps: Callable[..., str]):
+    return lambda: dumps(model.dict(), default=_serializer_default)
+
+
+def _serializer_decode(frame: str, loads: Callable[[str], object]):
+    return lambda: loads(frame)
+
+
+def layer_message(job_request: mv_validator_requests.V0JobRequest, volume_blob: bytes | None) -> dict:
+    """What `ValidatorInterfaceMixin.send_job_request` puts on the channel layer"""
+    return {
+        'type': 'miner.job_request',
+        **layer_utils.JobRequest(
+            job_uuid=job_request.job_uuid,
+            docker_image_name=job_request.docker_image_name,
+            docker_run_options_preset=job_request.docker_run_options_preset,
+            docker_run_cmd=job_request.docker_run_cmd,
+            volume={
+                'volume_type': job_request.volume.volume_type.value,
+                'contents': job_request.volume.contents,
+            },
+            output_upload=job_request.output_upload,
+            volume_blob=volume_blob,
+        ).dict(),
+    }
+
+
+def channel_layer_cases(sizes: dict[str, int]) -> list[Case]:
+    layer = ECRedisChannelLayer()
+    cases = []
+    for size_label, size in sizes.items():
+        output = make_output(size)
+        finished = {
+            'type': 'executor.finished',
+            **layer_utils.ExecutorFinished(
+                job_uuid=JOB_UUID,
+                docker_process_stdout=output,
+                docker_process_stderr=output,
+            ).dict(),
+        }
+        # validators don't send output_upload yet
+        job_request = mv_validator_requests.V0JobRequest.parse_obj({**sized(JOB_REQUEST, size), 'output_upload': None})
+        blob_job_request = mv_validator_requests.V0JobRequest.parse_obj(
+            {**JOB_REQUEST, 'volume': {**JOB_REQUEST['volume'], 'contents': ''}, 'output_upload': None},
+        )
+        volume_blob = make_volume_contents(size)
+
+        for name, message in [
+            (f'channel_layer.executor.finished[{size_label}]', finished),
+            (f'channel_layer.miner.job_request[{size_label}]', layer_message(job_request, None)),
+            (f'channel_layer.miner.job_request.blob[{size_label}]', layer_message(blob_job_request, volume_blob)),
+        ]:
+            frame = layer.serialize(message)
+            cases.append(Case(
+                name=name,
+                encode=_layer_encode(layer, message),
+                decode=_layer_decode(layer, frame),
+                frame_bytes=len(frame),
+            ))
+
+        frame = layer.serialize(layer_message(job_request, None))
+        cases.append(Case(
+            name=f'layer_utils.JobRequest[{size_label}]',
+            encode=_layer_encode_job_request(layer, job_request),
+            decode=_layer_decode_job_request(layer, frame),
+            frame_bytes=len(frame),
+        ))
+    return cases
+
+
+def _layer_encode(layer: ECRedisChannelLayer, message: dict):
+    return lambda: layer.serialize(message)
+
+
+def _layer_decode(layer: ECRedisChannelLayer, frame: bytes):
+    return lambda: layer.deserialize(frame)
+
+
+def _layer_encode_job_request(layer: ECRedisChannelLayer, job_request: mv_validator_requests.V0JobRequest):
+    return lambda: layer.serialize(layer_message(job_request, None))
+
+
+def _layer_decode_job_request(layer: ECRedisChannelLayer, frame: bytes):
+    def decode():
+        event = layer.deserialize(frame)
+        event.pop('type')
+        return layer_utils.JobRequest(**event)
+    return decode
+
+
+def measure(fn: Callable[[], object], min_time: float, repeat: int) -> tuple[float, int]:
+    """(best seconds per call, peak bytes allocated by one call)"""
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    start = time.perf_counter()
+    fn()
+    number = max(1, int(min_time / max(time.perf_counter() - start, 1e-9)))
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        best = min(best, (time.perf_counter() - start) / number)
+    return best, peak_memory
+
+
+def run(cases: list[Case], min_time: float, repeat: int) -> list[dict]:
+    print(f'{"case":<80} {"op":<6} {"frame [B]":>10} {"ops/s":>10} {"MB/s":>9} {"peak mem [B]":>13}')
+    results = []
+    for case in cases:
+        for operation, fn in (('encode', case.encode), ('decode', case.decode)):
+            seconds, peak_memory = measure(fn, min_time, repeat)
+            result = {
+                'case': case.name,
+                'operation': operation,
+                'frame_bytes': case.frame_bytes,
+                'ops_per_second': 1 / seconds,
+                'megabytes_per_second': case.frame_bytes / seconds / 1e6,
+                'peak_memory_bytes': peak_memory,
+            }
+            results.append(result)
+            print(f'{case.name:<80} {operation:<6} {case.frame_bytes:>10} {result["ops_per_second"]:>10.1f} '
+                  f'{result["megabytes_per_second"]:>9.1f} {peak_memory:>13}')
+    return results
+
+
+def compare(results: list[dict], baseline: list[dict], max_regression: float) -> list[str]:
+    """Descriptions of cases whose throughput dropped more than `max_regression` percent"""
+    baseline_by_key = {(result['case'], result['operation']): result for result in baseline}
+    regressions = []
+    for result in results:
+        previous = baseline_by_key.get((result['case'], result['operation']))
+        if previous is None:
+            continue
+        change = (result['ops_per_second'] / previous['ops_per_second'] - 1) * 100
+        if change < -max_regression:
+            regressions.append(f'{result["case"]} {result["operation"]}: {previous["ops_per_second"]:.1f} -> '
+                               f'{result["ops_per_second"]:.1f} ops/s ({change:+.1f}%)')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output', help='write results to this json file')
+    parser.add_argument('--compare', help='results json file of a previous run to compare with')
+    parser.add_argument('--max-regression', type=float, default=10.0,
+                        help='throughput drop in percent that fails --compare (default: %(default)s)')
+    parser.add_argument('--sizes', default=','.join(SIZES),
+                        help=f'comma separated payload sizes out of: {", ".join(SIZES)} (default: all)')
+    parser.add_argument('--filter', default='', help='only run cases with this substring in their name')
+    parser.add_argument('--min-time', type=float, default=0.1, help='seconds per timing run (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=3, help='timing runs, the best one is reported')
+    args = parser.parse_args()
+
+    try:
+        sizes = {label: SIZES[label] for label in args.sizes.split(',')}
+    except KeyError as exc:
+        parser.error(f'unknown size: {exc}')
+
+    cases = [case for case in protocol_cases(sizes) + serializer_cases(sizes) + channel_layer_cases(sizes) if args.filter in case.name]
+    results = run(cases, args.min_time, args.repeat)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'created_at': datetime.datetime.now(datetime.UTC).isoformat(),
+                'python': sys.version,
+                'platform': platform.platform(),
+                'encodings': [encoding.value for encoding in transport.supported_encodings()],
+                'compressions': [compression.value for compression in transport.supported_compressions()],
+                'results': results,
+            }, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        if regressions := compare(results, baseline, args.max_regression):
+            print(f'\nThroughput dropped more than {args.max_regression}%:')
+            for regression in regressions:
+                print(f'  {regression}')
+            sys.exit(1)
+        print(f'\nNo throughput drop of more than {args.max_regression}%')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+"""
+Microbenchmark of decoding every mv_protocol and em_protocol message with `BaseRequest.parse`.
+
+Compares the registry-driven single pass decoder against the previous implementation, which validated every
+message twice (once with the base model, once with the concrete one).
+
+    python compute_horde/benchmarks/protocol_parse.py [--number N] [--repeat R]
+"""
+import argparse
+import functools
+import json
+import timeit
+
+import pydantic
+
+from compute_horde.base_requests import (
+    BaseRequest,
+    ValidationError,
+    base_class_to_request_type_mapping,
+)
+from compute_horde.em_protocol import executor_requests as em_executor_requests
+from compute_horde.em_protocol import miner_requests as em_miner_requests
+from compute_horde.mv_protocol import miner_requests as mv_miner_requests
+from compute_horde.mv_protocol import validator_requests as mv_validator_requests
+
+JOB_UUID = '7b522379-a0f3-4a22-9e3d-69d3e1a6b2f1'
+STDOUT = 'x' * 1000
+
+VOLUME = {'volume_type': 'inline', 'contents': 'UEsDBBQAAAAIAAAAIQAAAAAAAAAAAAAAAAsAAABwYXlsb2FkLnR4dA=='}
+OUTPUT_UPLOAD = {
+    'output_upload_type': 'zip_and_http_post',
+    'post_url': 'https://s3.amazonaws.com/bucket/output.zip',
+    'post_form_fields': {'key': 'output.zip', 'policy': 'p' * 64, 'signature': 's' * 64},
+}
+JOB_REQUEST = {
+    'job_uuid': JOB_UUID,
+    'docker_image_name': 'backenddevelopersltd/compute-horde-job:v0-latest',
+    'docker_run_options_preset': 'nvidia_all',
+    'docker_run_cmd': ['--runtime', '600', '--attack-mode', '3', '--hash-type', '1410'],
+    'volume': VOLUME,
+    'output_upload': OUTPUT_UPLOAD,
+}
+INITIAL_JOB_REQUEST = {
+    'job_uuid': JOB_UUID,
+    'base_docker_image_name': 'backenddevelopersltd/compute-horde-job:v0-latest',
+    'timeout_seconds': 90,
+    'volume_type': 'inline',
+}
+
+# (base class used for decoding, sample message) for every concrete message type of both protocols
+SAMPLES: list[tuple[type[BaseRequest], dict]] = [
+    (mv_validator_requests.BaseValidatorRequest, {
+        'message_type': 'V0AuthenticateRequest',
+        'payload': {
+            'validator_hotkey': '5DAAnrj7VHTznn2AWBemMuyBwZWs6FNFjdyVXUeYum3PTXFy',
+            'miner_hotkey': '5HGjWAeFDfFCWPsjFQdVV2Msvz2XtMktvgocEZcCj68kUMaw',
+            'timestamp': 1710000000,
+        },
+        'signature': '0x' + 'ab' * 64,
+    }),
+    (mv_validator_requests.BaseValidatorRequest, {'message_type': 'V0InitialJobRequest', **INITIAL_JOB_REQUEST}),
+    (mv_validator_requests.BaseValidatorRequest, {
+        'message_type': 'V0InitialJobBatchRequest',
+        'jobs': [{'message_type': 'V0InitialJobRequest', **INITIAL_JOB_REQUEST}] * 4,
+    }),
+    (mv_validator_requests.BaseValidatorRequest, {'message_type': 'V0JobRequest', **JOB_REQUEST}),
+    (mv_validator_requests.BaseValidatorRequest, {'message_type': 'GenericError', 'details': 'details'}),
+    (mv_miner_requests.BaseMinerRequest, {'message_type': 'V0AcceptJobRequest', 'job_uuid': JOB_UUID}),
+    (mv_miner_requests.BaseMinerRequest, {'message_type': 'V0DeclineJobRequest', 'job_uuid': JOB_UUID}),
+    (mv_miner_requests.BaseMinerRequest, {
+        'message_type': 'V0JobBatchDecisionRequest',
+        'accepted_job_uuids': [JOB_UUID] * 3,
+        'declined_job_uuids': [JOB_UUID],
+    }),
+    (mv_miner_requests.BaseMinerRequest, {'message_type': 'V0ExecutorReadyRequest', 'job_uuid': JOB_UUID}),
+    (mv_miner_requests.BaseMinerRequest, {'message_type': 'V0ExecutorFailedRequest', 'job_uuid': JOB_UUID}),
+    (mv_miner_requests.BaseMinerRequest, {
+        'message_type': 'V0JobOutputChunk',
+        'job_uuid': JOB_UUID,
+        'stream': 'stdout',
+        'data': STDOUT,
+    }),
+    (mv_miner_requests.BaseMinerRequest, {
+        'message_type': 'V0JobFailedRequest',
+        'job_uuid': JOB_UUID,
+        'docker_process_exit_status': 1,
+        'docker_process_stdout': STDOUT,
+        'docker_process_stderr': STDOUT,
+    }),
+    (mv_miner_requests.BaseMinerRequest, {
+        'message_type': 'V0JobFinishedRequest',
+        'job_uuid': JOB_UUID,
+        'docker_process_stdout': STDOUT,
+        'docker_process_stderr': STDOUT,
+    }),
+    (mv_miner_requests.BaseMinerRequest, {'message_type': 'GenericError', 'details': 'details'}),
+    (mv_miner_requests.BaseMinerRequest, {
+        'message_type': 'UnauthorizedError',
+        'code': 'TOKEN_TOO_OLD',
+        'details': 'details',
+    }),
+    (em_miner_requests.BaseMinerRequest, {'message_type': 'V0PrepareJobRequest', **INITIAL_JOB_REQUEST}),
+    (em_miner_requests.BaseMinerRequest, {'message_type': 'V0RunJobRequest', **JOB_REQUEST}),
+    (em_miner_requests.BaseMinerRequest, {'message_type': 'V0NextJobRequest', 'executor_token': 'token' * 8}),
+    (em_miner_requests.BaseMinerRequest, {'message_type': 'GenericError', 'details': 'details'}),
+    (em_executor_requests.BaseExecutorRequest, {'message_type': 'V0ReadyRequest', 'job_uuid': JOB_UUID}),
+    (em_executor_requests.BaseExecutorRequest, {'message_type': 'V0FailedToPrepare', 'job_uuid': JOB_UUID}),
+    (em_executor_requests.BaseExecutorRequest, {
+        'message_type': 'V0JobOutputChunk',
+        'job_uuid': JOB_UUID,
+        'stream': 'stdout',
+        'data': STDOUT,
+    }),
+    (em_executor_requests.BaseExecutorRequest, {
+        'message_type': 'V0FailedRequest',
+        'job_uuid': JOB_UUID,
+        'docker_process_exit_status': None,
+        'timeout': True,
+        'docker_process_stdout': STDOUT,
+        'docker_process_stderr': STDOUT,
+    }),
+    (em_executor_requests.BaseExecutorRequest, {
+        'message_type': 'V0FinishedRequest',
+        'job_uuid': JOB_UUID,
+        'docker_process_stdout': STDOUT,
+        'docker_process_stderr': STDOUT,
+    }),
+    (em_executor_requests.BaseExecutorRequest, {'message_type': 'GenericError', 'details': 'details'}),
+]
+
+BASE_CLASSES = [
+    mv_validator_requests.BaseValidatorRequest,
+    mv_miner_requests.BaseMinerRequest,
+    em_miner_requests.BaseMinerRequest,
+    em_executor_requests.BaseExecutorRequest,
+]
+
+
+def legacy_parse(cls: type[BaseRequest], str_: str):
+    """`BaseRequest.parse` as it was before the registry, validating each message twice"""
+    try:
+        json_ = json.loads(str_)
+    except json.JSONDecodeError as exc:
+        raise ValidationError.from_json_decode_error(exc)
+
+    try:
+        base_model_object = cls.parse_obj(json_)
+    except pydantic.ValidationError as exc:
+        raise ValidationError.from_pydantic_validation_error(exc)
+
+    target_model = cls.type_to_model(base_model_object.message_type)
+
+    try:
+        return target_model.parse_obj(json_)
+    except pydantic.ValidationError as exc:
+        raise ValidationError.from_pydantic_validation_error(exc)
+
+
+def check_coverage():
+    covered = {(base, sample['message_type']) for base, sample in SAMPLES}
+    missing = [
+        f'{base.__module__}.{message_type}'
+        for base in BASE_CLASSES
+        for message_type in base_class_to_request_type_mapping[base]
+        if (base, message_type) not in covered
+    ]
+    if missing:
+        raise SystemExit(f'No benchmark sample for: {", ".join(missing)}')
+
+
+def best_of(stmt, number: int, repeat: int) -> float:
+    return min(timeit.repeat(stmt, number=number, repeat=repeat)) / number
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--number', type=int, default=2000, help='decodes per timing run')
+    parser.add_argument('--repeat', type=int, default=5, help='timing runs, the best one is reported')
+    args = parser.parse_args()
+
+    check_coverage()
+
+    print(f'{"message type":<55} {"legacy [us]":>12} {"parse [us]":>12} {"speedup":>8}')
+    legacy_total = current_total = 0.0
+    for base, sample in SAMPLES:
+        frame = json.dumps(sample)
+        assert base.parse(frame) == legacy_parse(base, frame)
+        legacy = best_of(functools.partial(legacy_parse, base, frame), args.number, args.repeat)
+        current = best_of(functools.partial(base.parse, frame), args.number, args.repeat)
+        legacy_total += legacy
+        current_total += current
+        name = f'{base.__module__.removeprefix("compute_horde.")}.{sample["message_type"]}'
+        print(f'{name:<55} {legacy * 1e6:>12.2f} {current * 1e6:>12.2f} {legacy / current:>7.2f}x')
+    print(f'{"all message types":<55} {legacy_total * 1e6:>12.2f} {current_total * 1e6:>12.2f} '
+          f'{legacy_total / current_total:>7.2f}x')
+
+
+if __name__ == '__main__':
+    main()
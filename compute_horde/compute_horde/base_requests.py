@@ -2,9 +2,25 @@ import abc
 import enum
 import json
 
+import orjson
 import pydantic
 
 
+def json_dumps(value, *, default=None, **kwargs) -> str:
+    """
+    Serializer of `BaseRequest.json()` with orjson. Any json.dumps options (`sort_keys`, `indent`...)
+    go to the standard library, whose output is byte-for-byte stable, e.g. for signing.
+    """
+    if kwargs:
+        return json.dumps(value, default=default, **kwargs)
+    return orjson.dumps(value, default=default, option=orjson.OPT_NON_STR_KEYS).decode()
+
+
+def json_loads(value: str | bytes):
+    """Counterpart of `json_dumps`, raises json.JSONDecodeError for malformed input"""
+    return orjson.loads(value)
+
+
 class ValidationError(Exception):
     def __init__(self, msg):
         self.msg = msg
@@ -21,46 +37,59 @@ class ValidationError(Exception):
         return f'{type(self).__name__}({self.msg})'
 
 
-def all_subclasses(cls: type):
-    for subcls in cls.__subclasses__():
-        yield subcls
-        yield from all_subclasses(subcls)
-
-
-base_class_to_request_type_mapping = {}
+base_class_to_request_type_mapping: dict[type['BaseRequest'], dict[str, type['BaseRequest']]] = {}
 
 
 class BaseRequest(pydantic.BaseModel, abc.ABC):
     message_type: enum.Enum
 
+    class Config:
+        json_dumps = json_dumps
+        json_loads = json_loads
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if not (message_type := cls.__fields__.get('message_type')):
+            return
+        if not message_type.default:
+            return
+        # every base class gets to decode its concrete subclasses, so a single lookup on the raw
+        # `message_type` value is enough to pick the model that will validate the whole message
+        for klass in cls.__mro__:
+            if issubclass(klass, BaseRequest):
+                mapping = base_class_to_request_type_mapping.setdefault(klass, {})
+                mapping[message_type.default.value] = cls
+
     @classmethod
     def type_to_model(cls, type_: enum.Enum) -> type['BaseRequest']:
-        mapping = base_class_to_request_type_mapping.get(cls)
-        if not mapping:
-            mapping = {}
-            for klass in all_subclasses(cls):
-                if not (message_type := klass.__fields__.get('message_type')):
-                    continue
-                if not message_type.default:
-                    continue
-                mapping[message_type.default] = klass
-            base_class_to_request_type_mapping[cls] = mapping
-
-        return mapping[type_]
+        return base_class_to_request_type_mapping[cls][type_.value]
 
     @classmethod
     def parse(cls, str_: str):
         try:
-            json_ = json.loads(str_)
+            json_ = json_loads(str_)
         except json.JSONDecodeError as exc:
             raise ValidationError.from_json_decode_error(exc)
 
-        try:
-            base_model_object = cls.parse_obj(json_)
-        except pydantic.ValidationError as exc:
-            raise ValidationError.from_pydantic_validation_error(exc)
+        return cls.parse_decoded(json_)
 
-        target_model = cls.type_to_model(base_model_object.message_type)
+    @classmethod
+    def parse_decoded(cls, json_):
+        """
+        Same as `parse`, but for a message that has already been decoded from its wire encoding (json, msgpack)
+        """
+        target_model = None
+        if isinstance(json_, dict) and isinstance(message_type := json_.get('message_type'), str):
+            target_model = base_class_to_request_type_mapping.get(cls, {}).get(message_type)
+
+        if target_model is None:
+            # unknown or missing message type, let pydantic produce the error just like for any other
+            # malformed message
+            try:
+                base_model_object = cls.parse_obj(json_)
+            except pydantic.ValidationError as exc:
+                raise ValidationError.from_pydantic_validation_error(exc)
+            target_model = cls.type_to_model(base_model_object.message_type)
 
         try:
             return target_model.parse_obj(json_)
@@ -6,6 +6,7 @@ from ..base_requests import BaseRequest, JobMixin
 class RequestType(enum.Enum):
     V0ReadyRequest = 'V0ReadyRequest'
     V0FailedToPrepare = 'V0FailedToPrepare'
+    V0JobOutputChunk = 'V0JobOutputChunk'
     V0FinishedRequest = 'V0FinishedRequest'
     V0FailedRequest = 'V0FailedRequest'
     GenericError = 'GenericError'
@@ -15,26 +16,54 @@ class BaseExecutorRequest(BaseRequest):
     message_type: RequestType
 
 
+class OutputStream(enum.Enum):
+    stdout = 'stdout'
+    stderr = 'stderr'
+
+
 class V0ReadyRequest(BaseExecutorRequest, JobMixin):
     message_type: RequestType = RequestType.V0ReadyRequest
+    # sha256 of the content_addressed volumes the executor has cached, None if it doesn't cache volumes
+    cached_volumes: list[str] | None = None
+    # durations of the phases of the job so far (see compute_horde.timeline), with transport.Feature.job_timeline
+    timeline: dict[str, float] | None = None
 
 
 class V0FailedToPrepare(BaseExecutorRequest, JobMixin):
     message_type: RequestType = RequestType.V0FailedToPrepare
 
 
+class V0JobOutputChunk(BaseExecutorRequest, JobMixin):
+    """Output of a running job, sent as it's produced if negotiated with `transport.Feature.output_streaming`"""
+    message_type: RequestType = RequestType.V0JobOutputChunk
+    stream: OutputStream
+    data: str
+
+
 class V0FailedRequest(BaseExecutorRequest, JobMixin):
     message_type: RequestType = RequestType.V0FailedRequest
     docker_process_exit_status: int | None
     timeout: bool
     docker_process_stdout: str  # TODO: add max_length
     docker_process_stderr: str  # TODO: add max_length
+    # sha256 of the utf-8 encoded output, set if it was sent in V0JobOutputChunk messages, which leaves
+    # docker_process_stdout and docker_process_stderr empty
+    docker_process_stdout_sha256: str | None = None
+    docker_process_stderr_sha256: str | None = None
+    # durations of the phases of the job so far (see compute_horde.timeline), with transport.Feature.job_timeline
+    timeline: dict[str, float] | None = None
 
 
 class V0FinishedRequest(BaseExecutorRequest, JobMixin):
     message_type: RequestType = RequestType.V0FinishedRequest
     docker_process_stdout: str  # TODO: add max_length
     docker_process_stderr: str  # TODO: add max_length
+    # sha256 of the utf-8 encoded output, set if it was sent in V0JobOutputChunk messages, which leaves
+    # docker_process_stdout and docker_process_stderr empty
+    docker_process_stdout_sha256: str | None = None
+    docker_process_stderr_sha256: str | None = None
+    # durations of the phases of the job so far (see compute_horde.timeline), with transport.Feature.job_timeline
+    timeline: dict[str, float] | None = None
 
 
 class GenericError(BaseExecutorRequest):
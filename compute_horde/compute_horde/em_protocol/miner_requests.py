@@ -4,11 +4,13 @@ from typing import Mapping
 import pydantic
 
 from ..base_requests import BaseRequest, JobMixin
+from ..transport import BlobReference
 
 
 class RequestType(enum.Enum):
     V0PrepareJobRequest = 'V0PrepareJobRequest'
     V0RunJobRequest = 'V0RunJobRequest'
+    V0NextJobRequest = 'V0NextJobRequest'
     GenericError = 'GenericError'
 
 
@@ -19,6 +21,8 @@ class BaseMinerRequest(BaseRequest):
 class VolumeType(enum.Enum):
     inline = 'inline'
     zip_url = 'zip_url'
+    content_addressed = 'content_addressed'
+    zip_urls = 'zip_urls'
 
 
 class V0InitialJobRequest(BaseMinerRequest, JobMixin):
@@ -26,12 +30,33 @@ class V0InitialJobRequest(BaseMinerRequest, JobMixin):
     base_docker_image_name: str | None
     timeout_seconds: int | None
     volume_type: VolumeType
+    # pins the image, executors run `base_docker_image_name@base_docker_image_digest`
+    base_docker_image_digest: str | None = pydantic.Field(None, regex='^sha256:[0-9a-f]{64}$')
+
+
+class VolumeShard(pydantic.BaseModel):
+    """One of the zips of a zip_urls volume, executors fetch them concurrently"""
+    url: str
+    # extracted to this directory of the volume, the volume itself if empty
+    relative_path: str = ''
+    # verified if given, executors then cache the unpacked shard like content_addressed volumes
+    sha256: str | None = pydantic.Field(None, regex='^[0-9a-f]{64}$')
+    size: int | None = None
 
 
 class Volume(pydantic.BaseModel):
     volume_type: VolumeType
     contents: str  # TODO: this is only valid for volume_type = inline, some polymorphism like with BaseRequest is
     # required here
+    # inline volume sent in a separate blob frame, `contents` is empty then
+    blob: BlobReference | None = None
+    # content_addressed volumes are the zip with this sha256 and size, executors that don't have it cached fetch it
+    # as `fallback_volume_type` from `contents` or `blob`
+    sha256: str | None = pydantic.Field(None, regex='^[0-9a-f]{64}$')
+    size: int | None = None
+    fallback_volume_type: VolumeType | None = None
+    # zips of a zip_urls volume, `contents` is empty then
+    shards: list[VolumeShard] | None = None
 
 
 class OutputUploadType(enum.Enum):
@@ -53,6 +78,13 @@ class V0JobRequest(BaseMinerRequest, JobMixin):
     docker_run_cmd: list[str]
     volume: Volume
     output_upload: OutputUpload | None
+    docker_image_digest: str | None = pydantic.Field(None, regex='^sha256:[0-9a-f]{64}$')
+
+
+class V0NextJobRequest(BaseMinerRequest):
+    """Sent to an idle persistent executor, which connects again with `executor_token` to get its next job"""
+    message_type: RequestType = RequestType.V0NextJobRequest
+    executor_token: str
 
 
 class GenericError(BaseMinerRequest):
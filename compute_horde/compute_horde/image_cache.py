@@ -0,0 +1,227 @@
+"""
+Docker images of a host, pulled as rarely as possible.
+
+An image that is present locally is not pulled again if it's pinned by digest (`name@sha256:...` never changes) or
+if its tag was resolved to the registry's current digest less than `freshness_seconds` ago. Within that period the
+local image is trusted without asking the registry, a tag moved in the meantime is only noticed once it's over, so jobs
+on a warm host get their images without a single registry round trip. After it, the tag's digest is looked up in the
+registry (`docker buildx imagetools inspect`) and the pull is skipped if it's one of the local image's repo digests.
+Otherwise, or if the registry can't be asked that way, `docker pull` downloads only the layers that are missing.
+
+The state is kept in a directory shared by the processes of the host (e.g. /tmp of the host, which executors mount):
+`state.json` with when each image was pulled and used, and a lock file per image, so concurrent pulls of the same
+image are done once. Least recently used evictable images are removed once their total size exceeds
+`max_size_bytes` (sizes of images as reported by docker, layers shared between images are counted for each).
+"""
+import asyncio
+import contextlib
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import tempfile
+import time
+
+logger = logging.getLogger(__name__)
+
+# how often a process waiting for another one's pull of the same image checks whether it's done
+IMAGE_LOCK_POLL_SECONDS = 0.1
+# looking a tag's digest up in the registry takes longer than this only if something is wrong, pulling then
+REGISTRY_DIGEST_TIMEOUT_SECONDS = 30
+
+
+class ImagePullFailed(Exception):
+    def __init__(self, description: str):
+        self.description = description
+
+
+def is_pinned(image: str) -> bool:
+    return '@sha256:' in image
+
+
+def pin(image: str, digest: str | None) -> str:
+    """`image` pinned to `digest` if it isn't already, `name:tag@sha256:...` is fine with docker"""
+    if digest is None or is_pinned(image):
+        return image
+    return f'{image}@{digest}'
+
+
+class ImageCache:
+    def __init__(self, directory: pathlib.Path, max_size_bytes: int = 0, freshness_seconds: float = 600):
+        self.directory = directory
+        self.max_size_bytes = max_size_bytes
+        self.freshness_seconds = freshness_seconds
+
+    async def ensure(self, image: str, evictable: bool = True, timeout: float | None = None) -> bool:
+        """Make sure `image` is present and current, return whether it was pulled, raise ImagePullFailed"""
+        if await self._is_current(image):
+            await asyncio.to_thread(self._record, image, evictable, resolved=False)
+            return False
+        async with self._image_lock(image):
+            # pulled by another process of the host while waiting for the lock
+            if await self._is_current(image):
+                await asyncio.to_thread(self._record, image, evictable, resolved=False)
+                return False
+            if await self._matches_registry(image):
+                await asyncio.to_thread(self._record, image, evictable, resolved=True)
+                return False
+            await self._pull(image, timeout)
+            await asyncio.to_thread(self._record, image, evictable, resolved=True)
+        await self.evict(keep=image)
+        return True
+
+    async def evict(self, keep: str | None = None):
+        """Remove least recently used evictable images above `max_size_bytes`, 0 disables eviction"""
+        if self.max_size_bytes <= 0:
+            return
+        state = await asyncio.to_thread(self._read_state)
+        images = sorted(
+            (image for image, entry in state.items() if entry.get('evictable', True)),
+            key=lambda image: state[image].get('used_at', 0),
+            reverse=True,
+        )
+        total = 0
+        for image in images:
+            size = await self._size(image)
+            if size is None:
+                # removed by someone else
+                await asyncio.to_thread(self._forget, image)
+                continue
+            if image != keep and total + size > self.max_size_bytes:
+                returncode, _, stderr = await self._docker('image', 'rm', image)
+                if returncode == 0:
+                    logger.debug(f'Evicted image {image} of {size} bytes')
+                    await asyncio.to_thread(self._forget, image)
+                    continue
+                # e.g. used by a running job
+                logger.debug(f'Could not evict image {image}: {stderr.strip()}')
+            total += size
+
+    async def _is_current(self, image: str) -> bool:
+        if not is_pinned(image):
+            state = await asyncio.to_thread(self._read_state)
+            if time.time() - state.get(image, {}).get('pulled_at', 0) >= self.freshness_seconds:
+                return False
+        returncode, _, _ = await self._docker('image', 'inspect', '--format', '{{.Id}}', image)
+        return returncode == 0
+
+    async def _matches_registry(self, image: str) -> bool:
+        """Whether the registry's digest of the tag is the local image's, False if either is unknown"""
+        if is_pinned(image):
+            return False
+        returncode, stdout, _ = await self._docker('image', 'inspect', '--format', '{{json .RepoDigests}}', image)
+        if returncode != 0:
+            return False
+        try:
+            local_digests = {repo_digest.rpartition('@')[2] for repo_digest in json.loads(stdout)}
+        except (ValueError, TypeError, AttributeError):
+            return False
+        try:
+            returncode, stdout, stderr = await self._docker(
+                'buildx', 'imagetools', 'inspect', '--format', '{{.Manifest.Digest}}', image,
+                timeout=REGISTRY_DIGEST_TIMEOUT_SECONDS,
+            )
+        except TimeoutError:
+            logger.debug(f'Looking up the digest of image {image} timed out')
+            return False
+        if returncode != 0:
+            # e.g. no buildx, or a registry that wants credentials only the docker daemon has
+            logger.debug(f'Could not look up the digest of image {image}: {stderr.strip()}')
+            return False
+        return stdout.strip() in local_digests
+
+    async def _size(self, image: str) -> int | None:
+        returncode, stdout, _ = await self._docker('image', 'inspect', '--format', '{{.Size}}', image)
+        if returncode != 0:
+            return None
+        try:
+            return int(stdout.strip())
+        except ValueError:
+            return None
+
+    async def _pull(self, image: str, timeout: float | None):
+        logger.debug(f'Pulling image {image}')
+        try:
+            returncode, stdout, stderr = await self._docker('pull', image, timeout=timeout)
+        except TimeoutError:
+            raise ImagePullFailed(f'"docker pull {image}" timed out')
+        if returncode != 0:
+            raise ImagePullFailed(f'"docker pull {image}" failed with status={returncode}'
+                                  f' stdout="{stdout}"\nstderr="{stderr}')
+
+    async def _docker(self, *args: str, timeout: float | None = None) -> tuple[int, str, str]:
+        process = await asyncio.create_subprocess_exec(
+            'docker', *args,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        try:
+            stdout, stderr = await asyncio.wait_for(process.communicate(), timeout)
+        except TimeoutError:
+            process.kill()
+            raise
+        return process.returncode, stdout.decode(), stderr.decode()
+
+    @contextlib.asynccontextmanager
+    async def _image_lock(self, image: str):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with open(self.directory / f'{hashlib.sha256(image.encode()).hexdigest()}.lock', 'w') as f:
+            # polled rather than blocking in a thread, which couldn't be cancelled and would outlive the file
+            while True:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    await asyncio.sleep(IMAGE_LOCK_POLL_SECONDS)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    @contextlib.contextmanager
+    def _state_lock(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with open(self.directory / 'state.lock', 'w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _read_state(self) -> dict[str, dict]:
+        try:
+            state = json.loads((self.directory / 'state.json').read_text())
+        except (OSError, ValueError):
+            return {}
+        return state if isinstance(state, dict) else {}
+
+    def _write_state(self, state: dict[str, dict]):
+        # written aside and renamed, so other processes never read a partial file
+        fd, staging = tempfile.mkstemp(dir=self.directory, prefix='.state-')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(state, f)
+            os.replace(staging, self.directory / 'state.json')
+        except OSError:
+            logger.warning('Could not save the image cache state', exc_info=True)
+            pathlib.Path(staging).unlink(missing_ok=True)
+
+    def _record(self, image: str, evictable: bool, resolved: bool):
+        with self._state_lock():
+            state = self._read_state()
+            entry = state.setdefault(image, {})
+            now = time.time()
+            entry['used_at'] = now
+            entry['evictable'] = evictable
+            if resolved:
+                # pulled, or found current in the registry
+                entry['pulled_at'] = now
+            self._write_state(state)
+
+    def _forget(self, image: str):
+        with self._state_lock():
+            state = self._read_state()
+            if state.pop(image, None) is not None:
+                self._write_state(state)
@@ -0,0 +1,66 @@
+"""
+Prometheus metrics of the library, they end up in the default registry of whichever app (miner, validator,
+executor) uses the library. If prometheus_client is not installed, they are no-ops.
+"""
+try:
+    import prometheus_client
+except ImportError:  # optional
+    prometheus_client = None
+
+
+class _NoopMetric:
+    def labels(self, *args, **kwargs):
+        return self
+
+    def observe(self, *args, **kwargs):
+        pass
+
+    def inc(self, *args, **kwargs):
+        pass
+
+    def dec(self, *args, **kwargs):
+        pass
+
+    def set(self, *args, **kwargs):
+        pass
+
+
+def _metric(metric_class_name: str, name: str, documentation: str, labelnames=(), **kwargs):
+    if prometheus_client is None:
+        return _NoopMetric()
+    return getattr(prometheus_client, metric_class_name)(name, documentation, labelnames, **kwargs)
+
+
+FRAME_COMPRESSION_RATIO = _metric(
+    'Histogram',
+    'compute_horde_frame_compression_ratio',
+    'Compressed size divided by the original size of compressed protocol frames',
+    ['compression'],
+    buckets=(0.01, 0.02, 0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0, float('inf')),
+)
+FRAME_COMPRESSION_DURATION = _metric(
+    'Histogram',
+    'compute_horde_frame_compression_duration_seconds',
+    'Time spent compressing and decompressing protocol frames',
+    ['compression', 'operation'],
+    buckets=(.0001, .0005, .001, .005, .01, .025, .05, .1, .25, .5, 1.0, float('inf')),
+)
+HEARTBEAT_RTT = _metric(
+    'Histogram',
+    'compute_horde_heartbeat_rtt_seconds',
+    'Round trip time of heartbeat pings sent by miner clients',
+    ['client'],
+    buckets=(.001, .005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0, float('inf')),
+)
+SEND_QUEUE_DEPTH = _metric(
+    'Gauge',
+    'compute_horde_send_queue_depth',
+    'Frames waiting in the send queues of miner clients',
+    ['client'],
+)
+SEND_QUEUE_DROPPED = _metric(
+    'Counter',
+    'compute_horde_send_queue_dropped_total',
+    'Frames dropped because the send queue of a miner client was full',
+    ['client'],
+)
@@ -1,24 +1,123 @@
 import abc
 import asyncio
+import collections
+import enum
 import logging
 import random
+import statistics
+from collections.abc import Callable
 
 import websockets
+from websockets.frames import CloseCode
 
+from compute_horde import metrics, transport
 from compute_horde.base_requests import BaseRequest, ValidationError
 
 logger = logging.getLogger(__name__)
 
+HEARTBEAT_INTERVAL_SECONDS = 5.0
+HEARTBEAT_TIMEOUT_SECONDS = 10.0
+SEND_QUEUE_SIZE = 1000
+RECONNECT_BACKOFF_BASE_SECONDS = 1.0
+RECONNECT_BACKOFF_MAX_SECONDS = 30.0
+
+
+class SendQueueOverflow(enum.Enum):
+    block = 'block'  # the sender waits for space in the queue
+    drop_oldest = 'drop_oldest'  # the oldest queued message is dropped, its sender gets SendQueueFull
+    fail = 'fail'  # the sender gets SendQueueFull
+
+
+class SendQueueFull(Exception):
+    pass
+
+
+class MinerConnectionError(Exception):
+    pass
+
+
+class RoundTripTimes:
+    """Round trip times of the last `size` heartbeats of a connection, in seconds"""
+
+    def __init__(self, size: int = 100):
+        self.samples: collections.deque[float] = collections.deque(maxlen=size)
+
+    def add(self, rtt: float):
+        self.samples.append(rtt)
+
+    def __len__(self):
+        return len(self.samples)
+
+    @property
+    def last(self) -> float | None:
+        return self.samples[-1] if self.samples else None
+
+    @property
+    def min(self) -> float | None:
+        return min(self.samples) if self.samples else None
+
+    @property
+    def median(self) -> float | None:
+        return statistics.median(self.samples) if self.samples else None
+
+    def histogram(self, buckets: list[float]) -> dict[float, int]:
+        """Cumulative counts of samples not greater than each bucket's upper bound"""
+        return {bucket: sum(1 for rtt in self.samples if rtt <= bucket) for bucket in buckets}
+
 
 class AbstractMinerClient(abc.ABC):
+    """
+    Connection to a miner, reconnecting when it's lost, with capped exponential backoff between attempts. Connecting
+    gives up with MinerConnectionError after `connect_timeout` seconds, if set. While connected, a ping is sent every `heartbeat_interval`
+    seconds; the round trip times are kept in `rtt` and a connection whose peer doesn't answer within
+    `heartbeat_timeout` seconds is considered dead and replaced. `heartbeat_interval=None` disables heartbeats.
 
-    def __init__(self, loop: asyncio.AbstractEventLoop, miner_name: str):
+    Outgoing frames go through a queue of `send_queue_size` frames, sent in order by a single writer task, which
+    retries a frame until it is sent, reconnecting if needed; if connecting times out the frame's sender gets
+    MinerConnectionError. `send_queue_overflow` decides what happens when the
+    queue is full.
+
+    If the miner selects `transport.Feature.sessions`, the session is resumed after reconnecting: before any other
+    frame, the writer replays the frames the miner hasn't received (see `transport.Session`).
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, miner_name: str,
+                 heartbeat_interval: float | None = HEARTBEAT_INTERVAL_SECONDS,
+                 heartbeat_timeout: float = HEARTBEAT_TIMEOUT_SECONDS,
+                 send_queue_size: int = SEND_QUEUE_SIZE,
+                 send_queue_overflow: SendQueueOverflow = SendQueueOverflow.block,
+                 connect_timeout: float | None = None):
         self.debounce_counter = 0
+        self.connect_timeout = connect_timeout
         self.loop = loop
         self.miner_name = miner_name
         self.ws: websockets.WebSocketClientProtocol | None = None
+        self.encoding = transport.Encoding.json
+        self.features: set[transport.Feature] = set()
+        self.compression: transport.Compression | None = None
+        # set when the miner selected the encoding, compression and features of the current connection
+        self.transport_selected = asyncio.Event()
+        self.received_blobs = transport.ReceivedBlobs()
         self.read_messages_task: asyncio.Task | None = None
-        self.deferred_send_tasks: list[asyncio.Task] = []
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.heartbeat_task: asyncio.Task | None = None
+        self.rtt = RoundTripTimes()
+        # (make_frame, future done when the frame is sent or None if nobody waits for it, whether the frame is part
+        # of the session - all but transport messages are)
+        self.send_queue: asyncio.Queue[tuple[Callable[[], str | bytes | None], asyncio.Future | None, bool]] = \
+            asyncio.Queue(send_queue_size)
+        self.send_queue_overflow = send_queue_overflow
+        self.writer_task: asyncio.Task | None = None
+        # concurrent senders (e.g. multiple jobs over one connection) must not reconnect more than once
+        self.connect_lock = asyncio.Lock()
+        # kept across connections, to be resumed
+        self.session: transport.Session | None = None
+        # frames to send when the session starts on the current connection
+        self.session_replay: list[str | bytes] = []
+        # the connection on which the session was started, frames sent on it are counted
+        self.session_ws: websockets.WebSocketClientProtocol | None = None
+        self.ack_timer: asyncio.TimerHandle | None = None
 
     @abc.abstractmethod
     def miner_url(self) -> str:
@@ -47,19 +146,42 @@ class AbstractMinerClient(abc.ABC):
         await self.await_connect()
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
-        for t in self.deferred_send_tasks:
-            t.cancel()
+        if self.writer_task is not None and not self.writer_task.done():
+            self.writer_task.cancel()
+        if self.ack_timer is not None:
+            self.ack_timer.cancel()
+        while not self.send_queue.empty():
+            _, sent, _ = self._dequeue()
+            if sent is not None and not sent.done():
+                sent.cancel()
 
         if self.read_messages_task is not None and not self.read_messages_task.done():
             self.read_messages_task.cancel()
 
+        if self.heartbeat_task is not None and not self.heartbeat_task.done():
+            self.heartbeat_task.cancel()
+
         if self.ws is not None and not self.ws.closed:
             await self.ws.close()
 
     async def _connect(self):
-        return await websockets.connect(self.miner_url())
+        # heartbeats replace the keepalive pings of websockets, which don't report round trip times
+        ws = await websockets.connect(
+            self.miner_url(),
+            **({'ping_interval': None} if self.heartbeat_interval is not None else {}),
+        )
+        await ws.send(transport.V0TransportOfferRequest.for_this_environment(self.session).json())
+        return ws
 
     async def await_connect(self):
+        try:
+            async with asyncio.timeout(self.connect_timeout):
+                await self._await_connect()
+        except TimeoutError:
+            raise MinerConnectionError(
+                f'Could not connect to miner {self.miner_name} within {self.connect_timeout}s') from None
+
+    async def _await_connect(self):
         while True:
             try:
                 if self.debounce_counter:
@@ -68,34 +190,194 @@ class AbstractMinerClient(abc.ABC):
                     await asyncio.sleep(sleep_time)
                 self.debounce_counter += 1
                 self.ws = await self._connect()
+                self.debounce_counter = 0
+                # until the miner selects an encoding for this connection, it only understands json
+                self.encoding = transport.Encoding.json
+                self.features = set()
+                self.compression = None
+                self.transport_selected.clear()
                 self.read_messages_task = self.loop.create_task(self.read_messages())
+                if self.heartbeat_interval is not None:
+                    self.heartbeat_task = self.loop.create_task(self.heartbeat(self.ws))
                 return
             except (websockets.WebSocketException, OSError) as ex:
                 logger.info(f'Could not connect to miner {self.miner_name}: {str(ex)}')
 
     def sleep_time(self):
-        return (2 ** self.debounce_counter) + random.random()
+        """Exponential, capped and jittered, so that clients of a miner that went away don't come back all at once"""
+        backoff = min(RECONNECT_BACKOFF_BASE_SECONDS * 2 ** (self.debounce_counter - 1), RECONNECT_BACKOFF_MAX_SECONDS)
+        return backoff / 2 + random.uniform(0, backoff / 2)
 
     async def ensure_connected(self):
-        if self.ws is None or self.ws.closed:
-            if self.read_messages_task is not None and not self.read_messages_task.done():
-                self.read_messages_task.cancel()
-            await self.await_connect()
+        async with self.connect_lock:
+            # a connection failed by `heartbeat` is not closed until its closing handshake times out
+            if self.ws is None or not self.ws.open:
+                for task in (self.read_messages_task, self.heartbeat_task):
+                    if task is not None and not task.done():
+                        task.cancel()
+                await self.await_connect()
 
-    async def send_model(self, model: BaseRequest):
-        while True:
+    async def reconnect(self):
+        try:
             await self.ensure_connected()
+        except MinerConnectionError as ex:
+            # the writer tries again when there's something to send
+            logger.warning(str(ex))
+
+    async def wait_for_transport_selection(self, timeout: float) -> bool:
+        """False if the miner didn't select within `timeout` seconds, miners that don't negotiate never do"""
+        try:
+            await asyncio.wait_for(self.transport_selected.wait(), timeout)
+        except TimeoutError:
+            return False
+        return True
+
+    async def send_model(self, model: BaseRequest):
+        await self._send(lambda: transport.encode(model, self.encoding, self.compression))
+
+    async def send_blob(self, data: bytes) -> transport.BlobReference:
+        """
+        Send `data` in a blob frame, the returned reference has to be sent in the message that uses the data.
+        Only valid if the miner selected `Feature.blobs`.
+        """
+        reference, frame = transport.encode_blob(data)
+        await self._send(lambda: frame)
+        return reference
+
+    async def _send(self, make_frame: Callable[[], str | bytes]):
+        """Queue the frame and wait until it's sent"""
+        sent = self.loop.create_future()
+        if self.send_queue.full() and self.send_queue_overflow != SendQueueOverflow.block:
+            self._overflow()
+        await self.send_queue.put((make_frame, sent, True))
+        self._queued()
+        await sent
+
+    def deferred_send_model(self, model: BaseRequest):
+        """
+        Queue the message without waiting for it to be sent. Senders can't wait here, so with
+        `SendQueueOverflow.block` the message is dropped if the queue is full.
+        """
+        if self.send_queue.full():
             try:
-                await self.ws.send(model.json())
-            except websockets.WebSocketException as ex:
-                logger.error(f'Could not send to miner {self.miner_name}: {str(ex)}')
-                await asyncio.sleep(1 + random.random())
-                continue
+                if self.send_queue_overflow == SendQueueOverflow.block:
+                    raise SendQueueFull(f'Send queue of miner {self.miner_name} is full')
+                self._overflow()
+            except SendQueueFull as ex:
+                logger.warning(f'Dropping {model.message_type.value} message: {ex}')
+                metrics.SEND_QUEUE_DROPPED.labels(type(self).__name__).inc()
+                return
+        self.send_queue.put_nowait((lambda: transport.encode(model, self.encoding, self.compression), None, True))
+        self._queued()
+
+    def _overflow(self):
+        """Make space in the full queue, or raise SendQueueFull, according to `send_queue_overflow`"""
+        if self.send_queue_overflow == SendQueueOverflow.fail:
+            raise SendQueueFull(f'Send queue of miner {self.miner_name} is full')
+        _, dropped, _ = self._dequeue()
+        logger.warning(f'Send queue of miner {self.miner_name} is full, dropped the oldest frame')
+        metrics.SEND_QUEUE_DROPPED.labels(type(self).__name__).inc()
+        if dropped is not None and not dropped.done():
+            dropped.set_exception(SendQueueFull(f'Send queue of miner {self.miner_name} was full'))
+
+    def _queued(self):
+        metrics.SEND_QUEUE_DEPTH.labels(type(self).__name__).inc()
+        if self.writer_task is None or self.writer_task.done():
+            self.writer_task = self.loop.create_task(self.write_messages())
+
+    def _dequeue(self) -> tuple[Callable[[], str | bytes | None], asyncio.Future | None, bool]:
+        item = self.send_queue.get_nowait()
+        metrics.SEND_QUEUE_DEPTH.labels(type(self).__name__).dec()
+        return item
+
+    async def write_messages(self):
+        """The only task sending frames, in the order they were queued"""
+        while True:
+            make_frame, sent, sequenced = await self.send_queue.get()
+            metrics.SEND_QUEUE_DEPTH.labels(type(self).__name__).dec()
+            while True:
+                try:
+                    await self.ensure_connected()
+                except MinerConnectionError as ex:
+                    logger.warning(str(ex))
+                    if sent is not None and not sent.done():
+                        sent.set_exception(ex)
+                    break
+                recorded = False
+                try:
+                    await self._start_session()
+                    frame = make_frame()
+                    if frame is None:
+                        # only starting the session
+                        break
+                    if sequenced and self.in_session():
+                        self.session.record_sent(frame)
+                        recorded = True
+                    await self.ws.send(frame)
+                except websockets.WebSocketException as ex:
+                    logger.error(f'Could not send to miner {self.miner_name}: {str(ex)}')
+                    await asyncio.sleep(1 + random.random())
+                    if recorded:
+                        # replayed when the session is resumed
+                        break
+                    continue
+                except Exception as ex:
+                    # e.g. a model that can't be encoded, the sender gets the exception
+                    if sent is not None and not sent.done():
+                        sent.set_exception(ex)
+                    else:
+                        logger.exception(f'Could not send to miner {self.miner_name}')
+                    break
+                break
+            if sent is not None and not sent.done():
+                sent.set_result(None)
+
+    def in_session(self) -> bool:
+        """Whether frames sent on the current connection are counted"""
+        return self.session is not None and self.session_ws is self.ws and self.ws is not None
+
+    async def _start_session(self):
+        """Before other frames on a connection: acknowledge received frames and replay what the miner is missing"""
+        if self.session_ws is self.ws:
+            return
+        if not self.transport_selected.is_set():
+            if self.session is None:
+                # not resuming, frames sent before the selection (e.g. authentication) are not part of the session
+                return
+            await self.wait_for_transport_selection(self.heartbeat_timeout)
+        ws = self.ws
+        if self.session is not None and transport.Feature.sessions in self.features:
+            # the first ack on a connection marks the start of counting
+            await ws.send(transport.encode(self.session.ack(), self.encoding, self.compression))
+            if self.session_replay:
+                logger.info(f'Replaying {len(self.session_replay)} frames to miner {self.miner_name}')
+            while self.session_replay:
+                await ws.send(self.session_replay[0])
+                self.session_replay.pop(0)
+        self.session_ws = ws
+
+    def _session_received(self):
+        """Count a frame received in the session and acknowledge it, now or after a while"""
+        if self.session is None or transport.Feature.sessions not in self.features:
             return
+        if self.session.record_received():
+            self._queue_ack()
+        elif self.ack_timer is None:
+            self.ack_timer = self.loop.call_later(transport.SESSION_ACK_DELAY_SECONDS, self._queue_ack)
 
-    def deferred_send_model(self, model: BaseRequest):
-        task = self.loop.create_task(self.send_model(model))
-        self.deferred_send_tasks.append(task)
+    def _queue_ack(self):
+        if self.ack_timer is not None:
+            self.ack_timer.cancel()
+            self.ack_timer = None
+        if self.session is None or self.session.received == self.session.acknowledged_received:
+            return
+        if self.send_queue.full():
+            # acks are cumulative, the next one will do
+            return
+        session = self.session
+        self.send_queue.put_nowait((lambda: transport.encode(session.ack(), self.encoding, self.compression), None,
+                                    False))
+        self._queued()
 
     async def read_messages(self):
         while True:
@@ -103,11 +385,20 @@ class AbstractMinerClient(abc.ABC):
                 msg = await self.ws.recv()
             except websockets.WebSocketException as ex:
                 logger.info(f'Connection to miner {self.miner_name} lost: {str(ex)}')
-                self.loop.create_task(self.await_connect())
+                self.loop.create_task(self.reconnect())
                 return
 
             try:
-                msg = self.accepted_request_type().parse(msg)
+                if blob := transport.decode_blob(msg):
+                    self._session_received()
+                    self.received_blobs.add(*blob)
+                    continue
+                decoded = transport.decode(msg)
+                if transport_msg := transport.parse_transport_request(decoded):
+                    self.handle_transport_message(transport_msg)
+                    continue
+                self._session_received()
+                msg = self.accepted_request_type().parse_decoded(decoded)
             except ValidationError as ex:
                 error_msg = f'Malformed message from miner {self.miner_name}: {str(ex)}'
                 logger.info(error_msg)
@@ -127,6 +418,69 @@ class AbstractMinerClient(abc.ABC):
                 logger.exception(error_msg)
                 self.deferred_send_model(self.outgoing_generic_error_class()(details=error_msg))
 
+    async def heartbeat(self, ws: websockets.WebSocketClientProtocol):
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            try:
+                async with asyncio.timeout(self.heartbeat_timeout):
+                    pong_waiter = await ws.ping()
+                    rtt = await pong_waiter
+            except TimeoutError:
+                logger.warning(f'Miner {self.miner_name} did not answer a heartbeat within {self.heartbeat_timeout}s, '
+                               f'reconnecting')
+                # makes `read_messages` fail and reconnect
+                ws.fail_connection(CloseCode.INTERNAL_ERROR, 'heartbeat timeout')
+                return
+            except websockets.ConnectionClosed:
+                return
+            self.rtt.add(rtt)
+            metrics.HEARTBEAT_RTT.labels(type(self).__name__).observe(rtt)
+
+    def handle_transport_message(self, msg: transport.BaseTransportRequest):
+        if isinstance(msg, transport.V0TransportSelectedRequest):
+            logger.debug(f'Miner {self.miner_name} selected {msg.encoding.value} encoding, '
+                         f'{msg.compression.value if msg.compression else "no"} compression and features: '
+                         f'{", ".join(feature.value for feature in msg.features)}')
+            self.encoding = msg.encoding
+            self.features = set(msg.features)
+            self.compression = msg.compression
+            if transport.Feature.sessions in self.features:
+                self._select_session(msg)
+            self.transport_selected.set()
+            if transport.Feature.sessions in self.features:
+                self._queue_session_start()
+        elif isinstance(msg, transport.V0TransportAckRequest):
+            if self.session is not None:
+                self.session.peer_received(msg.received)
+
+    def _queue_session_start(self):
+        """Have the writer acknowledge and replay now, not only once there's something else to send"""
+        if self.send_queue.full():
+            # the writer starts the session before the next queued frame anyway
+            return
+        self.send_queue.put_nowait((lambda: None, None, False))
+        self._queued()
+
+    def _select_session(self, msg: transport.V0TransportSelectedRequest):
+        if msg.resumed and self.session is not None and msg.session_id == self.session.session_id:
+            replay = self.session.frames_to_replay(msg.received or 0)
+            if replay is None:
+                logger.warning(f'Session with miner {self.miner_name} resumed, but some frames it is missing are '
+                               f'not buffered anymore')
+                replay = self.session.unacknowledged_frames()
+            self.session_replay = replay
+            return
+        previous = self.session
+        self.session = transport.Session(msg.session_id)
+        self.session_replay = []
+        if previous is not None and (unacknowledged := previous.unacknowledged_frames()):
+            # the miner may have received some of them, better twice than never
+            logger.warning(f'Miner {self.miner_name} did not resume the session, resending {len(unacknowledged)} '
+                           f'unacknowledged frames')
+            for frame in unacknowledged:
+                self.session.record_sent(frame)
+            self.session_replay = unacknowledged
+
 
 class UnsupportedMessageReceived(Exception):
     def __init__(self, msg: BaseRequest):
@@ -6,8 +6,10 @@ from ..base_requests import BaseRequest, JobMixin
 class RequestType(enum.Enum):
     V0AcceptJobRequest = 'V0AcceptJobRequest'
     V0DeclineJobRequest = 'V0DeclineJobRequest'
+    V0JobBatchDecisionRequest = 'V0JobBatchDecisionRequest'
     V0ExecutorReadyRequest = 'V0ExecutorReadyRequest'
     V0ExecutorFailedRequest = 'V0ExecutorFailedRequest'
+    V0JobOutputChunk = 'V0JobOutputChunk'
     V0JobFailedRequest = 'V0JobFailedRequest'
     V0JobFinishedRequest = 'V0JobFinishedRequest'
     GenericError = 'GenericError'
@@ -18,6 +20,11 @@ class BaseMinerRequest(BaseRequest):
     message_type: RequestType
 
 
+class OutputStream(enum.Enum):
+    stdout = 'stdout'
+    stderr = 'stderr'
+
+
 class V0AcceptJobRequest(BaseMinerRequest, JobMixin):
     message_type: RequestType = RequestType.V0AcceptJobRequest
 
@@ -26,25 +33,56 @@ class V0DeclineJobRequest(BaseMinerRequest, JobMixin):
     message_type: RequestType = RequestType.V0DeclineJobRequest
 
 
+class V0JobBatchDecisionRequest(BaseMinerRequest):
+    """Answer to `V0InitialJobBatchRequest`, each of its jobs is either accepted or declined"""
+    message_type: RequestType = RequestType.V0JobBatchDecisionRequest
+    accepted_job_uuids: list[str]
+    declined_job_uuids: list[str]
+
+
 class V0ExecutorReadyRequest(BaseMinerRequest, JobMixin):
     message_type: RequestType = RequestType.V0ExecutorReadyRequest
+    # sha256 of the content_addressed volumes the executor of the job has cached, the validator doesn't need to
+    # send their contents; None if the executor doesn't cache volumes
+    cached_volumes: list[str] | None = None
+    # durations of the phases of the job so far (see compute_horde.timeline), with transport.Feature.job_timeline
+    timeline: dict[str, float] | None = None
 
 
 class V0ExecutorFailedRequest(BaseMinerRequest, JobMixin):
     message_type: RequestType = RequestType.V0ExecutorFailedRequest
 
 
+class V0JobOutputChunk(BaseMinerRequest, JobMixin):
+    """Output of a running job, sent as it's produced if negotiated with `transport.Feature.output_streaming`"""
+    message_type: RequestType = RequestType.V0JobOutputChunk
+    stream: OutputStream
+    data: str
+
+
 class V0JobFailedRequest(BaseMinerRequest, JobMixin):
     message_type: RequestType = RequestType.V0JobFailedRequest
     docker_process_exit_status: int | None
     docker_process_stdout: str  # TODO: add max_length
     docker_process_stderr: str  # TODO: add max_length
+    # sha256 of the utf-8 encoded output, set if it was sent in V0JobOutputChunk messages, which leaves
+    # docker_process_stdout and docker_process_stderr empty - unless the result is resent after a reconnect
+    docker_process_stdout_sha256: str | None = None
+    docker_process_stderr_sha256: str | None = None
+    # durations of the phases of the job so far (see compute_horde.timeline), with transport.Feature.job_timeline
+    timeline: dict[str, float] | None = None
 
 
 class V0JobFinishedRequest(BaseMinerRequest, JobMixin):
     message_type: RequestType = RequestType.V0JobFinishedRequest
     docker_process_stdout: str  # TODO: add max_length
     docker_process_stderr: str  # TODO: add max_length
+    # sha256 of the utf-8 encoded output, set if it was sent in V0JobOutputChunk messages, which leaves
+    # docker_process_stdout and docker_process_stderr empty - unless the result is resent after a reconnect
+    docker_process_stdout_sha256: str | None = None
+    docker_process_stderr_sha256: str | None = None
+    # durations of the phases of the job so far (see compute_horde.timeline), with transport.Feature.job_timeline
+    timeline: dict[str, float] | None = None
 
 
 class GenericError(BaseMinerRequest):
@@ -4,11 +4,13 @@ from typing import Mapping
 import pydantic
 
 from ..base_requests import BaseRequest, JobMixin
+from ..transport import BlobReference
 
 
 class RequestType(enum.Enum):
     V0AuthenticateRequest = 'V0AuthenticateRequest'
     V0InitialJobRequest = 'V0InitialJobRequest'
+    V0InitialJobBatchRequest = 'V0InitialJobBatchRequest'
     V0JobRequest = 'V0JobRequest'
     GenericError = 'GenericError'
 
@@ -19,6 +21,7 @@ class BaseValidatorRequest(BaseRequest):
 
 class VolumeType(enum.Enum):
     inline = 'inline'
+    content_addressed = 'content_addressed'
 
 
 class AuthenticationPayload(pydantic.BaseModel):
@@ -27,6 +30,7 @@ class AuthenticationPayload(pydantic.BaseModel):
     timestamp: int
 
     def blob_for_signing(self):
+        # a plain pydantic model, serialized by the standard library: signatures depend on the exact bytes
         return self.json(sort_keys=True)
 
 
@@ -44,12 +48,30 @@ class V0InitialJobRequest(BaseValidatorRequest, JobMixin):
     base_docker_image_name: str | None
     timeout_seconds: int | None
     volume_type: VolumeType
+    # pins the image, an executor that has it needs no registry round trip to know it's current
+    base_docker_image_digest: str | None = pydantic.Field(None, regex='^sha256:[0-9a-f]{64}$')
+
+
+class V0InitialJobBatchRequest(BaseValidatorRequest):
+    """
+    Initial requests of several jobs in one message, answered with a single `V0JobBatchDecisionRequest`.
+    Only sent if negotiated with `transport.Feature.job_batches`.
+    """
+    message_type: RequestType = RequestType.V0InitialJobBatchRequest
+    jobs: list[V0InitialJobRequest]
 
 
 class Volume(pydantic.BaseModel):
     volume_type: VolumeType
     contents: str  # TODO: this is only valid for volume_type = inline, some polymorphism like with BaseRequest is
     # required here
+    # inline volume sent in a separate blob frame, `contents` is empty then
+    blob: BlobReference | None = None
+    # content_addressed volumes are the zip with this sha256 and size, executors that don't have it cached fetch it
+    # as `fallback_volume_type` from `contents` or `blob`
+    sha256: str | None = pydantic.Field(None, regex='^[0-9a-f]{64}$')
+    size: int | None = None
+    fallback_volume_type: VolumeType | None = None
 
 
 class OutputUploadType(enum.Enum):
@@ -71,6 +93,7 @@ class V0JobRequest(BaseValidatorRequest, JobMixin):
     docker_run_cmd: list[str]
     volume: Volume
     output_upload: OutputUpload | None
+    docker_image_digest: str | None = pydantic.Field(None, regex='^sha256:[0-9a-f]{64}$')
 
 
 class GenericError(BaseValidatorRequest):
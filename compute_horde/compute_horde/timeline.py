@@ -0,0 +1,47 @@
+"""
+Where the time of a job goes. The executor, the miner and the validator each measure the phases of the job they
+run, the executor and the miner pass theirs on in the messages about the job (with
+`transport.Feature.job_timeline`) and the validator stores all of them with the job.
+
+Durations are in seconds. Phases within one process are measured with a monotonic clock, the ones spanning
+processes of the miner's host (`executor_spawn`, relays) with wall clock time.
+"""
+import contextlib
+import enum
+import time
+
+
+class JobPhase(enum.Enum):
+    # miner
+    executor_spawn = 'executor_spawn'  # from accepting the job to the executor connecting
+    ready_relay = 'ready_relay'  # readiness through the channel layer, from the executor's to the validator's consumer
+    result_relay = 'result_relay'  # the same for the result
+    # executor
+    connect = 'connect'
+    cve_check = 'cve_check'
+    docker_pull = 'docker_pull'
+    run_image_pull = 'run_image_pull'  # the job's image if it's not the base one, along with the volume
+    volume = 'volume'  # download and unpack
+    run = 'run'
+    output_upload = 'output_upload'
+    # validator
+    miner_ready = 'miner_ready'  # from sending the initial job request to receiving the readiness
+    job = 'job'  # from sending the job request to receiving the result
+
+
+class Timeline:
+    """Durations of phases of a job, `durations` is what goes into messages"""
+
+    def __init__(self, durations: dict[str, float] | None = None):
+        self.durations: dict[str, float] = dict(durations or {})
+
+    def add(self, phase: JobPhase, seconds: float):
+        self.durations[phase.value] = round(seconds, 6)
+
+    @contextlib.contextmanager
+    def measure(self, phase: JobPhase):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(phase, time.monotonic() - start)
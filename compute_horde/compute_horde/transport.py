@@ -0,0 +1,371 @@
+"""
+Connection level negotiation of how protocol messages are put on the wire.
+
+The connecting side (validator -> miner, executor -> miner) sends `V0TransportOfferRequest` as its first frame,
+the accepting side answers with `V0TransportSelectedRequest` and from then on both sides send messages in the
+selected encoding. Both sides keep accepting text (json) frames at all times, so messages that were in flight
+while negotiating are not lost, and peers that don't know about negotiation keep talking json.
+
+Optional features are negotiated the same way. With `Feature.blobs` large binary payloads (inline volumes) are
+sent as separate binary "blob" frames, which messages refer to by `BlobReference`, instead of base64 inside
+the message. With `Feature.output_streaming` job output is sent in `V0JobOutputChunk` messages while the job
+runs, and the final message only carries digests of it. With `Feature.job_batches` validators may send the initial
+requests of several jobs in one `V0InitialJobBatchRequest`. With `Feature.job_timeline` messages about a job
+carry the durations of its phases so far (see `compute_horde.timeline`).
+
+With `Feature.sessions` a connection belongs to a session, which can be resumed on a new connection without losing
+messages. Frames sent after the handshake are numbered implicitly, by counting them on both ends, and the
+receiver acknowledges them with `V0TransportAckRequest` carrying the number of frames it received so far. The
+connecting side only starts counting its frames after its first ack on the connection, the accepting side right
+after its selection. Unacknowledged frames are kept in a bounded replay buffer (`Session`). To resume, the connecting
+side sends the session id and the number of frames it received in its offer, the accepting side answers with the
+number of frames it received in the selection and both replay what the other side is missing.
+
+Compression is negotiated as well: frames larger than `COMPRESSION_THRESHOLD_BYTES` are sent as binary
+"compressed" frames wrapping the original text or msgpack frame. Blob frames are never compressed, inline
+volumes are zip archives already.
+"""
+import collections
+import enum
+import json
+import time
+import uuid
+import zlib
+
+import pydantic
+import zstandard
+
+from compute_horde.base_requests import BaseRequest, ValidationError, json_loads
+from compute_horde.metrics import FRAME_COMPRESSION_DURATION, FRAME_COMPRESSION_RATIO
+
+try:
+    import msgpack
+except ImportError:  # optional, without it only json is offered
+    msgpack = None
+
+
+class Encoding(enum.Enum):
+    json = 'json'
+    msgpack = 'msgpack'
+
+
+def supported_encodings() -> list[Encoding]:
+    """Encodings available in this environment, in order of preference"""
+    if msgpack is None:
+        return [Encoding.json]
+    return [Encoding.msgpack, Encoding.json]
+
+
+class Feature(enum.Enum):
+    blobs = 'blobs'
+    output_streaming = 'output_streaming'
+    job_batches = 'job_batches'
+    sessions = 'sessions'
+    job_timeline = 'job_timeline'
+
+
+SUPPORTED_FEATURES = [
+    Feature.blobs, Feature.output_streaming, Feature.job_batches, Feature.sessions, Feature.job_timeline,
+]
+
+
+class Compression(enum.Enum):
+    zstd = 'zstd'
+    deflate = 'deflate'
+
+
+def supported_compressions() -> list[Compression]:
+    """Compressions in order of preference, peers that don't know zstd settle on deflate"""
+    return [Compression.zstd, Compression.deflate]
+
+
+class RequestType(enum.Enum):
+    V0TransportOfferRequest = 'V0TransportOfferRequest'
+    V0TransportSelectedRequest = 'V0TransportSelectedRequest'
+    V0TransportAckRequest = 'V0TransportAckRequest'
+
+
+class BaseTransportRequest(BaseRequest):
+    message_type: RequestType
+
+
+class V0TransportOfferRequest(BaseTransportRequest):
+    message_type: RequestType = RequestType.V0TransportOfferRequest
+    # plain strings, so that encodings added in the future don't make the whole offer invalid
+    encodings: list[str]
+    features: list[str] = []
+    compressions: list[str] = []
+    # session to resume and the number of its frames received so far
+    session_id: str | None = None
+    received: int | None = None
+
+    @classmethod
+    def for_this_environment(cls, session: 'Session | None' = None):
+        return cls(
+            encodings=[encoding.value for encoding in supported_encodings()],
+            features=[feature.value for feature in SUPPORTED_FEATURES],
+            compressions=[compression.value for compression in supported_compressions()],
+            session_id=session.session_id if session is not None else None,
+            received=session.received if session is not None else None,
+        )
+
+    def select_encoding(self) -> Encoding:
+        supported = {encoding.value: encoding for encoding in supported_encodings()}
+        for encoding in self.encodings:
+            if encoding in supported:
+                return supported[encoding]
+        return Encoding.json
+
+    def select_features(self) -> list[Feature]:
+        return [feature for feature in SUPPORTED_FEATURES if feature.value in self.features]
+
+    def select_compression(self) -> Compression | None:
+        supported = {compression.value: compression for compression in supported_compressions()}
+        for compression in self.compressions:
+            if compression in supported:
+                return supported[compression]
+        return None
+
+
+class V0TransportSelectedRequest(BaseTransportRequest):
+    message_type: RequestType = RequestType.V0TransportSelectedRequest
+    encoding: Encoding
+    features: list[Feature] = []
+    compression: Compression | None = None
+    # with Feature.sessions: the session of the connection, whether it's the one the offer asked to resume and the
+    # number of its frames received so far
+    session_id: str | None = None
+    resumed: bool = False
+    received: int | None = None
+
+
+class V0TransportAckRequest(BaseTransportRequest):
+    message_type: RequestType = RequestType.V0TransportAckRequest
+    received: int
+
+
+def _msgpack_default(value):
+    if isinstance(value, enum.Enum):
+        return value.value
+    raise TypeError(f'Cannot serialize {type(value).__name__}')
+
+
+def encode(model: BaseRequest, encoding: Encoding, compression: Compression | None = None) -> str | bytes:
+    """Text frame for json, binary frame for msgpack, compressed binary frame if it's large"""
+    if encoding == Encoding.msgpack:
+        frame = msgpack.packb(model.dict(), use_bin_type=True, default=_msgpack_default)
+    else:
+        frame = model.json()
+    if compression is not None and len(frame) > COMPRESSION_THRESHOLD_BYTES:
+        return compress(frame, compression)
+    return frame
+
+
+def decode(frame: str | bytes):
+    """Decode a text (json), binary (msgpack) or compressed frame, raise ValidationError if it's malformed"""
+    if isinstance(frame, bytes) and frame.startswith(COMPRESSED_FRAME_PREFIX):
+        frame = decompress(frame)
+    if isinstance(frame, str):
+        try:
+            return json_loads(frame)
+        except json.JSONDecodeError as exc:
+            raise ValidationError.from_json_decode_error(exc)
+
+    if msgpack is None:
+        raise ValidationError('Binary frames are not supported')
+    try:
+        return msgpack.unpackb(frame, raw=False)
+    except Exception as exc:  # msgpack reports malformed data with a number of unrelated exception types
+        raise ValidationError(f'Malformed msgpack frame: {exc!r}')
+
+
+def parse_transport_request(decoded) -> BaseTransportRequest | None:
+    """Return the negotiation message if `decoded` is one, None for all other messages"""
+    if not isinstance(decoded, dict):
+        return None
+    message_type = decoded.get('message_type')
+    if not isinstance(message_type, str) or message_type not in RequestType.__members__:
+        return None
+    return BaseTransportRequest.parse_decoded(decoded)
+
+
+# msgpack messages are maps, so they never start with a zero byte
+COMPRESSED_FRAME_PREFIX = b'\x00zip'
+COMPRESSED_FRAME_HEADER_LENGTH = len(COMPRESSED_FRAME_PREFIX) + 2
+COMPRESSION_THRESHOLD_BYTES = 16 * 1024
+MAX_DECOMPRESSED_FRAME_BYTES = 256 * 1024 * 1024
+
+_COMPRESSION_CODES = {Compression.zstd: b'z', Compression.deflate: b'd'}
+_COMPRESSIONS_BY_CODE = {code: compression for compression, code in _COMPRESSION_CODES.items()}
+_TEXT_FRAME = b't'
+_BINARY_FRAME = b'b'
+
+
+def compress(frame: str | bytes, compression: Compression) -> bytes:
+    """
+    Wrap a text or binary frame in a compressed frame:
+    prefix, compression code, original frame kind, compressed original frame
+    """
+    if isinstance(frame, str):
+        kind, data = _TEXT_FRAME, frame.encode()
+    else:
+        kind, data = _BINARY_FRAME, frame
+    start = time.perf_counter()
+    if compression == Compression.zstd:
+        compressed = zstandard.ZstdCompressor().compress(data)
+    else:
+        compressed = zlib.compress(data)
+    FRAME_COMPRESSION_DURATION.labels(compression.value, 'compress').observe(time.perf_counter() - start)
+    FRAME_COMPRESSION_RATIO.labels(compression.value).observe(len(compressed) / len(data) if data else 1.0)
+    return COMPRESSED_FRAME_PREFIX + _COMPRESSION_CODES[compression] + kind + compressed
+
+
+def decompress(frame: bytes) -> str | bytes:
+    """Unwrap a compressed frame, raise ValidationError if it's malformed"""
+    if len(frame) < COMPRESSED_FRAME_HEADER_LENGTH:
+        raise ValidationError('Truncated compressed frame')
+    code = frame[len(COMPRESSED_FRAME_PREFIX):len(COMPRESSED_FRAME_PREFIX) + 1]
+    kind = frame[len(COMPRESSED_FRAME_PREFIX) + 1:COMPRESSED_FRAME_HEADER_LENGTH]
+    compression = _COMPRESSIONS_BY_CODE.get(code)
+    if compression is None or compression not in supported_compressions():
+        raise ValidationError(f'Unsupported compression: {code!r}')
+    if kind not in (_TEXT_FRAME, _BINARY_FRAME):
+        raise ValidationError(f'Unknown compressed frame kind: {kind!r}')
+
+    payload = frame[COMPRESSED_FRAME_HEADER_LENGTH:]
+    start = time.perf_counter()
+    if compression == Compression.zstd:
+        try:
+            with zstandard.ZstdDecompressor().stream_reader(payload) as reader:
+                data = reader.read(MAX_DECOMPRESSED_FRAME_BYTES + 1)
+        except zstandard.ZstdError as exc:
+            raise ValidationError(f'Malformed compressed frame: {exc!r}')
+        if len(data) > MAX_DECOMPRESSED_FRAME_BYTES:
+            raise ValidationError(f'Compressed frame exceeds {MAX_DECOMPRESSED_FRAME_BYTES} bytes')
+    else:
+        decompressor = zlib.decompressobj()
+        try:
+            data = decompressor.decompress(payload, MAX_DECOMPRESSED_FRAME_BYTES)
+        except zlib.error as exc:
+            raise ValidationError(f'Malformed compressed frame: {exc!r}')
+        if decompressor.unconsumed_tail:
+            raise ValidationError(f'Compressed frame exceeds {MAX_DECOMPRESSED_FRAME_BYTES} bytes')
+    FRAME_COMPRESSION_DURATION.labels(compression.value, 'decompress').observe(time.perf_counter() - start)
+
+    if kind == _TEXT_FRAME:
+        try:
+            return data.decode()
+        except UnicodeDecodeError as exc:
+            raise ValidationError(f'Malformed compressed text frame: {exc!r}')
+    return data
+
+
+BLOB_FRAME_PREFIX = b'\x00blob'
+BLOB_FRAME_HEADER_LENGTH = len(BLOB_FRAME_PREFIX) + 16
+MAX_PENDING_BLOBS = 16
+
+
+class BlobReference(pydantic.BaseModel):
+    blob_id: str
+    size: int
+
+
+def encode_blob(data: bytes) -> tuple[BlobReference, bytes]:
+    blob_id = uuid.uuid4()
+    return BlobReference(blob_id=blob_id.hex, size=len(data)), BLOB_FRAME_PREFIX + blob_id.bytes + data
+
+
+def decode_blob(frame: str | bytes) -> tuple[str, bytes] | None:
+    """Return (blob_id, data) if `frame` is a blob frame, None for all other frames"""
+    if not isinstance(frame, bytes) or not frame.startswith(BLOB_FRAME_PREFIX):
+        return None
+    if len(frame) < BLOB_FRAME_HEADER_LENGTH:
+        raise ValidationError('Truncated blob frame')
+    blob_id = uuid.UUID(bytes=frame[len(BLOB_FRAME_PREFIX):BLOB_FRAME_HEADER_LENGTH])
+    return blob_id.hex, frame[BLOB_FRAME_HEADER_LENGTH:]
+
+
+class ReceivedBlobs:
+    """Blobs waiting for the message that refers to them, the oldest ones are dropped if never claimed"""
+
+    def __init__(self, max_pending: int = MAX_PENDING_BLOBS):
+        self.max_pending = max_pending
+        self._blobs: dict[str, bytes] = {}
+
+    def add(self, blob_id: str, data: bytes):
+        self._blobs[blob_id] = data
+        while len(self._blobs) > self.max_pending:
+            self._blobs.pop(next(iter(self._blobs)))
+
+    def pop(self, reference: BlobReference) -> bytes:
+        try:
+            data = self._blobs.pop(reference.blob_id)
+        except KeyError:
+            raise ValidationError(f'Unknown blob: {reference.blob_id}')
+        if len(data) != reference.size:
+            raise ValidationError(f'Blob {reference.blob_id} has {len(data)} bytes instead of {reference.size}')
+        return data
+
+
+SESSION_ACK_EVERY = 32
+SESSION_ACK_DELAY_SECONDS = 1.0
+REPLAY_BUFFER_FRAMES = 1000
+REPLAY_BUFFER_BYTES = 64 * 1024 * 1024
+
+
+class Session:
+    """
+    One end of a session, see `Feature.sessions`: counts of frames sent and received and the sent frames the peer
+    hasn't acknowledged yet. The oldest frames are dropped from the replay buffer above `max_frames` or `max_bytes`,
+    after which the session can't be resumed losslessly. Frames carry no sequence numbers, a websocket delivers them in
+    order, so the n-th frame sent by one end is the n-th received by the other and counts identify them.
+    """
+
+    def __init__(self, session_id: str | None = None, max_frames: int = REPLAY_BUFFER_FRAMES,
+                 max_bytes: int = REPLAY_BUFFER_BYTES):
+        self.session_id = session_id or uuid.uuid4().hex
+        self.max_frames = max_frames
+        self.max_bytes = max_bytes
+        self.sent = 0
+        self.received = 0
+        self.acknowledged_received = 0
+        self.replay_buffer: collections.deque[tuple[int, str | bytes]] = collections.deque()
+        self.replay_buffer_bytes = 0
+        self.disconnected_at: float | None = None
+
+    def record_sent(self, frame: str | bytes):
+        self.sent += 1
+        self.replay_buffer.append((self.sent, frame))
+        self.replay_buffer_bytes += len(frame)
+        while self.replay_buffer and (
+            len(self.replay_buffer) > self.max_frames or self.replay_buffer_bytes > self.max_bytes
+        ):
+            _, dropped = self.replay_buffer.popleft()
+            self.replay_buffer_bytes -= len(dropped)
+
+    def record_received(self) -> bool:
+        """True if it's time to acknowledge"""
+        self.received += 1
+        return self.received - self.acknowledged_received >= SESSION_ACK_EVERY
+
+    def ack(self) -> V0TransportAckRequest:
+        self.acknowledged_received = self.received
+        return V0TransportAckRequest(received=self.received)
+
+    def peer_received(self, received: int):
+        """The peer acknowledged `received` frames, they won't be replayed"""
+        while self.replay_buffer and self.replay_buffer[0][0] <= received:
+            _, frame = self.replay_buffer.popleft()
+            self.replay_buffer_bytes -= len(frame)
+
+    def frames_to_replay(self, received: int) -> list[str | bytes] | None:
+        """Frames the peer, which received `received` frames, is missing. None if some are not buffered anymore"""
+        self.peer_received(received)
+        if received > self.sent:
+            return None
+        if received < self.sent and (not self.replay_buffer or self.replay_buffer[0][0] != received + 1):
+            return None
+        return [frame for _, frame in self.replay_buffer]
+
+    def unacknowledged_frames(self) -> list[str | bytes]:
+        return [frame for _, frame in self.replay_buffer]
@@ -0,0 +1,93 @@
+import asyncio
+import json
+import logging
+import os
+import pathlib
+import platform
+import stat
+import tempfile
+import time
+from collections.abc import Callable
+from typing import Self
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+BOOT_ID_PATH = pathlib.Path('/proc/sys/kernel/random/boot_id')
+DOCKER_VERSION_TIMEOUT_SECONDS = 10
+
+
+class CveCheckCache:
+    """
+    Result of the CVE-2022-0492 check, which depends only on the host. The file is shared by executors of the same
+    host, in a directory of their own. A safe result is valid for `ttl_seconds`, as long as the host key (kernel
+    release, boot id, docker daemon version) stays the same, unsafe ones are never cached. The file and its directory
+    are only trusted if they are owned by the executor's user and nobody else can write them, jobs must not be able
+    to mark a host safe.
+    """
+
+    def __init__(self, path: pathlib.Path, ttl_seconds: int):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+
+    @classmethod
+    def from_settings(cls) -> Self:
+        return cls(pathlib.Path(settings.CVE_CHECK_CACHE_PATH), settings.CVE_CHECK_CACHE_TTL_SECONDS)
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl_seconds > 0
+
+    async def host_key(self) -> str | None:
+        """Kernel release, boot id and docker daemon version, None if any of them can't be read"""
+        try:
+            boot_id = BOOT_ID_PATH.read_text().strip()
+        except OSError:
+            return None
+        process = await asyncio.create_subprocess_exec(
+            'docker', 'version', '--format', '{{.Server.Version}}',
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        try:
+            stdout, _ = await asyncio.wait_for(process.communicate(), DOCKER_VERSION_TIMEOUT_SECONDS)
+        except TimeoutError:
+            return None
+        finally:
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+        if process.returncode != 0:
+            return None
+        return f'{platform.release()}/{boot_id}/{stdout.decode().strip()}'
+
+    @staticmethod
+    def _trusted(path: pathlib.Path, file_type: Callable[[int], bool]) -> bool:
+        path_stat = path.lstat()
+        return (file_type(path_stat.st_mode) and path_stat.st_uid == os.getuid()
+                and not path_stat.st_mode & (stat.S_IWGRP | stat.S_IWOTH))
+
+    def is_safe(self, host_key: str) -> bool:
+        """Whether the host was found safe by a check that is still valid"""
+        try:
+            if not (self._trusted(self.path.parent, stat.S_ISDIR) and self._trusted(self.path, stat.S_ISREG)):
+                logger.warning(f'Not trusting {self.path}, it or its directory can be written by others')
+                return False
+            entry = json.loads(self.path.read_text())
+            return (entry['host_key'] == host_key and entry['safe'] is True
+                    and time.time() - entry['checked_at'] < self.ttl_seconds)
+        except (OSError, ValueError, TypeError, KeyError):
+            return False
+
+    def store_safe(self, host_key: str):
+        self.path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+        # written aside and renamed, so other executors never read a partial file
+        fd, staging = tempfile.mkstemp(dir=self.path.parent, prefix=f'.{self.path.name}-')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'host_key': host_key, 'safe': True, 'checked_at': time.time()}, f)
+            os.replace(staging, self.path)
+        except OSError:
+            logger.warning('Could not cache the CVE-2022-0492 check result', exc_info=True)
+            pathlib.Path(staging).unlink(missing_ok=True)
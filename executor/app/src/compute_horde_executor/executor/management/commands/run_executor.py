@@ -1,47 +1,72 @@
 import asyncio
 import base64
+import codecs
+import hashlib
 import io
 import logging
+import os
 import pathlib
+import re
 import shutil
 import tempfile
+import threading
 import time
 import zipfile
+from collections.abc import Awaitable, Callable
+from typing import BinaryIO
 
 import httpx
 import pydantic
-from compute_horde.base_requests import BaseRequest
+from compute_horde import transport
+from compute_horde.base_requests import BaseRequest, ValidationError
 from compute_horde.em_protocol import executor_requests, miner_requests
 from compute_horde.em_protocol.executor_requests import (
     GenericError,
+    OutputStream,
     V0FailedRequest,
     V0FailedToPrepare,
     V0FinishedRequest,
+    V0JobOutputChunk,
     V0ReadyRequest,
 )
 from compute_horde.em_protocol.miner_requests import (
     BaseMinerRequest,
     V0InitialJobRequest,
     V0JobRequest,
+    V0NextJobRequest,
+    Volume,
+    VolumeShard,
     VolumeType,
 )
+from compute_horde.image_cache import ImageCache, ImagePullFailed, pin
 from compute_horde.miner_client.base import AbstractMinerClient, UnsupportedMessageReceived
+from compute_horde.timeline import JobPhase, Timeline
 from django.conf import settings
 from django.core.management.base import BaseCommand
 
+from compute_horde_executor.executor.cve_check_cache import CveCheckCache
 from compute_horde_executor.executor.output_uploader import OutputUploader, OutputUploadFailed
+from compute_horde_executor.executor.volume_cache import VolumeCache
+from compute_horde_executor.executor.zip_stream import ZipStreamError, extract_zip_stream
 
 logger = logging.getLogger(__name__)
 
 temp_dir = pathlib.Path(tempfile.mkdtemp())
 volume_mount_dir = temp_dir / 'volume'
 output_volume_mount_dir = temp_dir / 'output'
+# zips of zip_urls volumes that are cached, extracted aside before being moved to the volume
+shards_staging_dir = temp_dir / 'shards'
 
 CVE_2022_0492_TIMEOUT_SECONDS = 120
 MAX_RESULT_SIZE_IN_RESPONSE = 1000
 TRUNCATED_RESPONSE_PREFIX_LEN = 100
 TRUNCATED_RESPONSE_SUFFIX_LEN = 100
 INPUT_VOLUME_UNPACK_TIMEOUT_SECONDS = 300
+OUTPUT_CHUNK_SIZE = 64 * 1024
+VOLUME_DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+VOLUME_DOWNLOAD_RANGE_ATTEMPTS = 3
+VOLUME_DOWNLOAD_RETRY_DELAY_SECONDS = 1
+CONTENT_RANGE_RE = re.compile(r'bytes (\d+)-(\d+)/(\d+|\*)')
 
 
 class RunConfigManager:
@@ -65,6 +90,9 @@ class MinerClient(AbstractMinerClient):
         self.initial_msg_lock = asyncio.Lock()
         self.full_payload = asyncio.Future()
         self.full_payload_lock = asyncio.Lock()
+        self.volume_blob: bytes | None = None
+        # phases measured by the executor, sent along with the job's messages if the miner wants them
+        self.timeline = Timeline()
 
     def miner_url(self) -> str:
         return f'{self.miner_address}/v0/executor_interface/{self.token}'
@@ -102,25 +130,48 @@ class MinerClient(AbstractMinerClient):
             if not self.initial_msg.done():
                 msg = f'Received job request before an initial job request {msg.job_uuid=}'
                 logger.error(msg)
-                await self.deferred_send_model(GenericError(details=msg))
+                self.deferred_send_model(GenericError(details=msg))
                 return
             if self.full_payload.done():
                 msg = (f'Received duplicate full job payload request: first '
                        f'{self.job_uuid=} and then {msg.job_uuid=}')
                 logger.error(msg)
-                await self.deferred_send_model(GenericError(details=msg))
+                self.deferred_send_model(GenericError(details=msg))
                 return
             logger.debug(f'Received full job payload request: {msg.job_uuid=}')
+            if msg.volume.blob is not None:
+                try:
+                    self.volume_blob = self.received_blobs.pop(msg.volume.blob)
+                except ValidationError as ex:
+                    # the job will fail when unpacking the volume
+                    logger.error(f'Received job request with invalid volume blob {msg.job_uuid=}: {ex.msg}')
             self.full_payload.set_result(msg)
 
-    async def send_ready(self):
-        await self.send_model(V0ReadyRequest(job_uuid=self.job_uuid))
+    def timeline_durations(self) -> dict[str, float] | None:
+        return self.timeline.durations if transport.Feature.job_timeline in self.features else None
+
+    async def send_ready(self, cached_volumes: list[str] | None = None):
+        await self.send_model(V0ReadyRequest(
+            job_uuid=self.job_uuid,
+            cached_volumes=cached_volumes,
+            timeline=self.timeline_durations(),
+        ))
+
+    async def send_output_chunk(self, stream: OutputStream, data: str):
+        await self.send_model(V0JobOutputChunk(
+            job_uuid=self.job_uuid,
+            stream=stream,
+            data=data,
+        ))
 
     async def send_finished(self, job_result: 'JobResult'):
         await self.send_model(V0FinishedRequest(
             job_uuid=self.job_uuid,
             docker_process_stdout=job_result.stdout,
             docker_process_stderr=job_result.stderr,
+            docker_process_stdout_sha256=job_result.stdout_sha256,
+            docker_process_stderr_sha256=job_result.stderr_sha256,
+            timeline=self.timeline_durations(),
         ))
 
     async def send_failed(self, job_result: 'JobResult'):
@@ -130,6 +181,9 @@ class MinerClient(AbstractMinerClient):
             timeout=job_result.timeout,
             docker_process_stdout=job_result.stdout,
             docker_process_stderr=job_result.stderr,
+            docker_process_stdout_sha256=job_result.stdout_sha256,
+            docker_process_stderr_sha256=job_result.stderr_sha256,
+            timeline=self.timeline_durations(),
         ))
 
     async def send_generic_error(self, details: str):
@@ -143,12 +197,45 @@ class MinerClient(AbstractMinerClient):
         ))
 
 
+class IdleMinerClient(AbstractMinerClient):
+    """Connection of a persistent executor waiting for its next job, registered under a token of its own"""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, miner_address: str, token: str):
+        super().__init__(loop, '')
+        self.miner_address = miner_address
+        self.token = token
+        self.next_job_token = asyncio.Future()
+
+    def miner_url(self) -> str:
+        return f'{self.miner_address}/v0/executor_interface/idle/{self.token}'
+
+    def accepted_request_type(self) -> type[BaseRequest]:
+        return BaseMinerRequest
+
+    def incoming_generic_error_class(self):
+        return miner_requests.GenericError
+
+    def outgoing_generic_error_class(self):
+        return executor_requests.GenericError
+
+    async def handle_message(self, msg: BaseRequest):
+        if not isinstance(msg, V0NextJobRequest):
+            raise UnsupportedMessageReceived(msg)
+        if self.next_job_token.done():
+            logger.error(f'Received another next job request {msg.executor_token=}, already got one')
+            return
+        self.next_job_token.set_result(msg.executor_token)
+
+
 class JobResult(pydantic.BaseModel):
     success: bool
     exit_status: int | None
     timeout: bool
     stdout: str
     stderr: str
+    # set if the output was streamed, stdout and stderr are empty then
+    stdout_sha256: str | None = None
+    stderr_sha256: str | None = None
 
 
 def truncate(v: str) -> str:
@@ -158,39 +245,113 @@ def truncate(v: str) -> str:
         return v
 
 
+def clean_job_dirs():
+    """Empty the volume and output dirs for the next job of a persistent executor"""
+    for directory in (volume_mount_dir, output_volume_mount_dir):
+        assert str(directory) not in {'~', '/'}
+        shutil.rmtree(directory, ignore_errors=True)
+        directory.mkdir()
+
+
+def parse_content_range(header: str) -> tuple[int, int, int | None] | None:
+    """First and last byte and total size (None if unknown) of a `bytes first-last/size` Content-Range"""
+    match = CONTENT_RANGE_RE.fullmatch(header.strip())
+    if match is None:
+        return None
+    first, last, size = match.groups()
+    return int(first), int(last), None if size == '*' else int(size)
+
+
+def preallocate(fd: int, size: int):
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except OSError:
+        # e.g. not supported by the filesystem
+        os.ftruncate(fd, size)
+
+
 class JobError(Exception):
     def __init__(self, description: str):
         self.description = description
 
 
+class VolumeSizeLimit:
+    """Bytes downloaded for a volume, by concurrent downloads of its zips, up to `max_size` (0 or less is no limit)"""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.size = 0
+        # extraction threads add what they pull
+        self.lock = threading.Lock()
+
+    def check(self, size: int):
+        if 0 < self.max_size < self.size + size:
+            raise JobError("Input volume too large")
+
+    def add(self, size: int):
+        with self.lock:
+            self.check(size)
+            self.size += size
+
+
 class JobRunner:
-    def __init__(self, initial_job_request: V0InitialJobRequest):
+    def __init__(self, initial_job_request: V0InitialJobRequest, timeline: Timeline | None = None):
         self.initial_job_request = initial_job_request
+        self.volume_cache = VolumeCache.from_settings()
+        self.image_cache = ImageCache(
+            pathlib.Path(settings.IMAGE_CACHE_DIR),
+            settings.IMAGE_CACHE_MAX_SIZE_BYTES,
+            settings.IMAGE_CACHE_FRESHNESS_SECONDS,
+        )
+        self.timeline = timeline if timeline is not None else Timeline()
+
+    def base_docker_image(self) -> str:
+        return pin(self.initial_job_request.base_docker_image_name, self.initial_job_request.base_docker_image_digest)
+
+    def cached_volumes(self) -> list[str] | None:
+        return self.volume_cache.digests() if self.volume_cache.enabled else None
 
     async def prepare(self):
         volume_mount_dir.mkdir(exist_ok=True)
         output_volume_mount_dir.mkdir(exist_ok=True)
 
-        process = await asyncio.create_subprocess_exec(
-            'docker', 'pull', self.initial_job_request.base_docker_image_name,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-        )
-        stdout, stderr = await process.communicate()
+        with self.timeline.measure(JobPhase.docker_pull):
+            await self.docker_pull(self.base_docker_image())
 
-        if process.returncode != 0:
-            msg = (f'"docker pull {self.initial_job_request.base_docker_image_name}" '
-                   f'(job_uuid={self.initial_job_request.job_uuid})'
-                   f' failed with status={process.returncode}'
-                   f' stdout="{stdout.decode()}"\nstderr="{stderr.decode()}')
+    async def docker_pull(self, image: str):
+        try:
+            await self.image_cache.ensure(image)
+        except ImagePullFailed as exc:
+            msg = f'{exc.description} (job_uuid={self.initial_job_request.job_uuid})'
             logger.error(msg)
             raise JobError(msg)
 
-    async def run_job(self, job_request: V0JobRequest):
+    async def _pull_run_image(self, image: str):
+        with self.timeline.measure(JobPhase.run_image_pull):
+            try:
+                await self.docker_pull(image)
+            except JobError:
+                # docker run pulls it again, and fails the job if the image is really not there
+                pass
+
+    async def run_job(self, job_request: V0JobRequest, volume_blob: bytes | None = None,
+                      send_output_chunk: Callable[[OutputStream, str], Awaitable] | None = None):
+        """
+        With `send_output_chunk` the output is sent as it's produced and written to the output volume, instead of
+        being returned in the result.
+        """
+        # pulled along with unpacking the volume, instead of by docker run after it
+        docker_image = pin(job_request.docker_image_name, job_request.docker_image_digest)
+        run_image_pull = None
+        if docker_image != self.base_docker_image():
+            run_image_pull = asyncio.create_task(self._pull_run_image(docker_image))
         try:
             docker_run_options = RunConfigManager.preset_to_docker_run_args(job_request.docker_run_options_preset)
-            await self.unpack_volume(job_request)
+            with self.timeline.measure(JobPhase.volume):
+                await self.unpack_volume(job_request, volume_blob)
         except JobError as ex:
+            if run_image_pull is not None:
+                run_image_pull.cancel()
             return JobResult(
                 success=False,
                 exit_status=None,
@@ -198,6 +359,8 @@ class JobRunner:
                 stdout=ex.description,
                 stderr="",
             )
+        if run_image_pull is not None:
+            await run_image_pull
 
         cmd = [
             'docker',
@@ -210,7 +373,7 @@ class JobRunner:
             f'{volume_mount_dir.as_posix()}/:/volume/',
             '-v',
             f'{output_volume_mount_dir.as_posix()}/:/output/',
-            job_request.docker_image_name,
+            docker_image,
             *job_request.docker_run_cmd,
         ]
         process = await asyncio.create_subprocess_exec(
@@ -219,7 +382,10 @@ class JobRunner:
             stderr=asyncio.subprocess.PIPE,
         )
 
-        t1 = time.time()
+        t1 = time.monotonic()
+        if send_output_chunk is not None:
+            return await self._run_streaming(process, cmd, t1, send_output_chunk)
+
         try:
             stdout, stderr = await asyncio.wait_for(process.communicate(),
                                                     timeout=self.initial_job_request.timeout_seconds)
@@ -238,7 +404,8 @@ class JobRunner:
             exit_status = process.returncode
             timeout = False
 
-        time_took = time.time() - t1
+        time_took = time.monotonic() - t1
+        self.timeline.add(JobPhase.run, time_took)
         success = exit_status == 0
 
         if success:
@@ -256,7 +423,63 @@ class JobRunner:
             stderr=stderr,
         )
 
-    async def _unpack_volume(self, job_request: V0JobRequest):
+    async def _run_streaming(self, process: asyncio.subprocess.Process, cmd: list[str], t1: float,
+                             send_output_chunk: Callable[[OutputStream, str], Awaitable]):
+        # the pipes are read until the process is gone, also if it gets killed
+        stream_tasks = [
+            asyncio.create_task(self._stream_output(process.stdout, OutputStream.stdout, send_output_chunk)),
+            asyncio.create_task(self._stream_output(process.stderr, OutputStream.stderr, send_output_chunk)),
+        ]
+        try:
+            await asyncio.wait_for(process.wait(), timeout=self.initial_job_request.timeout_seconds)
+        except TimeoutError:
+            logger.error(f'Process didn\'t finish in time, killing it, job_uuid={self.initial_job_request.job_uuid}')
+            process.kill()
+            timeout = True
+            exit_status = None
+        else:
+            exit_status = process.returncode
+            timeout = False
+        stdout_sha256, stderr_sha256 = await asyncio.gather(*stream_tasks)
+
+        time_took = time.monotonic() - t1
+        self.timeline.add(JobPhase.run, time_took)
+        success = exit_status == 0
+
+        if success:
+            logger.info(f'Job "{self.initial_job_request.job_uuid}" finished successfully in {time_took:0.2f} seconds')
+        else:
+            logger.error(f'"{" ".join(cmd)}" (job_uuid={self.initial_job_request.job_uuid})'
+                         f' failed after {time_took:0.2f} seconds with status={process.returncode}')
+
+        return JobResult(
+            success=success,
+            exit_status=exit_status,
+            timeout=timeout,
+            stdout='',
+            stderr='',
+            stdout_sha256=stdout_sha256,
+            stderr_sha256=stderr_sha256,
+        )
+
+    async def _stream_output(self, reader: asyncio.StreamReader, stream: OutputStream,
+                             send_output_chunk: Callable[[OutputStream, str], Awaitable]) -> str:
+        """Send the output in chunks and save it in the output volume, return its sha256"""
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        digest = hashlib.sha256()
+        # TODO: Replace open() with async calls (aiofiles or something) if it becomes a async-bottleneck
+        with open(output_volume_mount_dir / f'{stream.value}.txt', 'w') as f:
+            while True:
+                data = await reader.read(OUTPUT_CHUNK_SIZE)
+                text = decoder.decode(data, final=not data)
+                if text:
+                    f.write(text)
+                    digest.update(text.encode())
+                    await send_output_chunk(stream, text)
+                if not data:
+                    return digest.hexdigest()
+
+    async def _unpack_volume(self, job_request: V0JobRequest, volume_blob: bytes | None):
         assert str(volume_mount_dir) not in {'~', '/'}
         for path in volume_mount_dir.glob("*"):
             if path.is_file():
@@ -264,33 +487,275 @@ class JobRunner:
             elif path.is_dir():
                 shutil.rmtree(path)
 
-        if job_request.volume.volume_type == VolumeType.inline:
-            decoded_contents = base64.b64decode(job_request.volume.contents)
+        volume = job_request.volume
+        volume_type = volume.volume_type
+        from_cache = False
+        if volume_type == VolumeType.content_addressed:
+            if volume.sha256 is None:
+                raise JobError("Content addressed volume without sha256")
+            from_cache = await asyncio.to_thread(self.volume_cache.copy_to, volume.sha256, volume_mount_dir)
+            if not from_cache:
+                if volume.fallback_volume_type is None:
+                    raise JobError(f"Volume {volume.sha256} is not cached and has no fallback")
+                volume_type = volume.fallback_volume_type
+
+        if from_cache:
+            logger.debug(f'Volume {volume.sha256} of job {job_request.job_uuid} found in cache')
+        elif volume_type == VolumeType.inline:
+            if volume.blob is not None:
+                if volume_blob is None:
+                    raise JobError("Input volume blob not received")
+                decoded_contents = volume_blob
+            else:
+                decoded_contents = base64.b64decode(volume.contents)
+            if volume.volume_type == VolumeType.content_addressed:
+                self._verify_volume_digest(volume, hashlib.sha256(decoded_contents).hexdigest(), len(decoded_contents))
             bytes_io = io.BytesIO(decoded_contents)
             zip_file = zipfile.ZipFile(bytes_io)
             zip_file.extractall(volume_mount_dir.as_posix())
-        elif job_request.volume.volume_type == VolumeType.zip_url:
-            with tempfile.NamedTemporaryFile() as download_file:
-                async with httpx.AsyncClient() as client:
-                    async with client.stream('GET', job_request.volume.contents) as response:
-                        volume_size = int(response.headers["Content-Length"])
-                        if 0 < settings.VOLUME_MAX_SIZE_BYTES < volume_size:
-                            raise JobError("Input volume too large")
-
-                        async for chunk in response.aiter_bytes():
-                            download_file.write(chunk)
-                download_file.seek(0)
-                zip_file = zipfile.ZipFile(download_file)
-                zip_file.extractall(volume_mount_dir.as_posix())
+        elif volume_type == VolumeType.zip_url:
+            # content addressed volumes are cached under their sha256, once verified
+            content_addressed = volume.volume_type == VolumeType.content_addressed
+            result = await self._download_and_extract(
+                volume.contents, volume_mount_dir, VolumeSizeLimit(settings.VOLUME_MAX_SIZE_BYTES),
+                cache_by_etag=not content_addressed,
+            )
+            if content_addressed:
+                # verified once the whole archive is downloaded, a mismatching volume is not cached
+                self._verify_volume_digest(volume, *result)
+        elif volume_type == VolumeType.zip_urls:
+            if volume.volume_type == VolumeType.content_addressed:
+                # its sha256 is that of a single zip
+                raise JobError("Content addressed volume can't fall back to zip_urls")
+            await self._unpack_shards(volume.shards or [])
         else:
-            raise NotImplementedError(f'Unsupported volume_type: {job_request.volume.volume_type}')
+            raise NotImplementedError(f'Unsupported volume_type: {volume_type}')
+
+        if volume.volume_type == VolumeType.content_addressed and not from_cache:
+            # cached before the job gets to modify it
+            await asyncio.to_thread(self.volume_cache.store, volume.sha256, volume_mount_dir)
 
         chmod_proc = await asyncio.create_subprocess_exec("chmod", "-R", "777", temp_dir.as_posix())
         assert 0 == await chmod_proc.wait()
 
-    async def unpack_volume(self, job_request: V0JobRequest):
+    async def _unpack_shards(self, shards: list[VolumeShard]):
+        """Download and extract the zips of a zip_urls volume concurrently, each to its directory of the volume"""
+        size_limit = VolumeSizeLimit(settings.VOLUME_MAX_SIZE_BYTES)
+        downloads = asyncio.Semaphore(max(settings.VOLUME_SHARD_DOWNLOADS, 1))
+        volume_dir = volume_mount_dir.resolve()
+        destinations = []
+        for shard in shards:
+            destination = (volume_dir / shard.relative_path).resolve()
+            if not destination.is_relative_to(volume_dir):
+                raise JobError(f"Volume shard path {shard.relative_path} is outside of the volume")
+            destinations.append(destination)
         try:
-            await asyncio.wait_for(self._unpack_volume(job_request), timeout=INPUT_VOLUME_UNPACK_TIMEOUT_SECONDS)
+            async with asyncio.TaskGroup() as tg:
+                for index, (shard, destination) in enumerate(zip(shards, destinations)):
+                    tg.create_task(self._unpack_shard(
+                        shard, destination, size_limit, downloads, shards_staging_dir / str(index)))
+        except ExceptionGroup as exc:
+            raise exc.exceptions[0]
+        finally:
+            shutil.rmtree(shards_staging_dir, ignore_errors=True)
+
+    async def _unpack_shard(self, shard: VolumeShard, destination: pathlib.Path, size_limit: VolumeSizeLimit,
+                            downloads: asyncio.Semaphore, staging: pathlib.Path):
+        async with downloads:
+            destination.mkdir(parents=True, exist_ok=True)
+            if shard.sha256 is not None and await asyncio.to_thread(
+                    self.volume_cache.copy_to, shard.sha256, destination):
+                logger.debug(f'Volume shard {shard.sha256} found in cache')
+                return
+            # extracted aside to be cached alone, other shards may share its directory
+            staging.mkdir(parents=True)
+            result = await self._download_and_extract(
+                shard.url, staging, size_limit, cache_by_etag=shard.sha256 is None)
+            if shard.sha256 is not None:
+                self._verify_volume_digest(shard, *result)
+                await asyncio.to_thread(self.volume_cache.store, shard.sha256, staging)
+            await asyncio.to_thread(shutil.copytree, staging, destination, copy_function=os.replace,
+                                    dirs_exist_ok=True)
+
+    async def _download_and_extract(self, url: str, destination: pathlib.Path, size_limit: VolumeSizeLimit,
+                                    cache_by_etag: bool = False) -> tuple[str, int] | None:
+        """
+        Download the zip at `url` and extract it to `destination`, return the sha256 and size of the zip.
+        With `cache_by_etag`, a zip served with an ETag is cached under its url and ETag, and None is returned if it's
+        found there. `destination` must then hold this zip only.
+        """
+        range_size = settings.VOLUME_DOWNLOAD_RANGE_SIZE_BYTES
+        async with httpx.AsyncClient() as client:
+            # the first range tells whether the server supports ranges, and the size of the volume
+            headers = {'Range': f'bytes=0-{range_size - 1}'} if range_size > 0 else {}
+            async with client.stream('GET', url, headers=headers) as response:
+                if response.status_code not in (httpx.codes.OK, httpx.codes.PARTIAL_CONTENT):
+                    raise JobError(f"Input volume download failed with HTTP {response.status_code}")
+                cache_key = None
+                etag = response.headers.get('ETag')
+                if cache_by_etag and self.volume_cache.enabled and etag:
+                    cache_key = self.volume_cache.url_key(url, etag)
+                if cache_key is not None and await asyncio.to_thread(self.volume_cache.copy_to, cache_key, destination):
+                    logger.debug(f'Volume {url} with ETag {etag} found in cache')
+                    return None
+
+                size = None
+                if response.status_code == httpx.codes.PARTIAL_CONTENT:
+                    content_range = parse_content_range(response.headers.get('Content-Range', ''))
+                    if content_range is None or content_range[0] != 0 or content_range[2] is None:
+                        raise JobError("Input volume served with an invalid Content-Range")
+                    size = content_range[2]
+                if size is not None and size > range_size:
+                    size_limit.add(size)
+                    result = await self._download_ranges_and_extract(client, url, response, size, destination)
+                else:
+                    result = await self._stream_and_extract(response, destination, size_limit)
+
+        if cache_key is not None:
+            await asyncio.to_thread(self.volume_cache.store, cache_key, destination)
+        return result
+
+    async def _stream_and_extract(self, response: httpx.Response, destination: pathlib.Path,
+                                  size_limit: VolumeSizeLimit) -> tuple[str, int]:
+        """
+        Extract the zip to `destination` while it's downloaded, return its sha256 and size.
+        The extraction thread pulls the chunks from the download running in the event loop. The zip is kept aside as it
+        arrives, and extracted with zipfile once downloaded if it can't be extracted on the fly (e.g. it doesn't start
+        with its first entry, or a stored entry is followed by its size).
+        """
+        loop = asyncio.get_running_loop()
+        digest = hashlib.sha256()
+        size = 0
+        abandoned = threading.Event()
+
+        content_length = response.headers.get("Content-Length")
+        if content_length is not None:
+            size_limit.check(int(content_length))
+        chunks = response.aiter_bytes(VOLUME_DOWNLOAD_CHUNK_SIZE)
+
+        with tempfile.TemporaryFile() as download_file:
+            def add(chunk: bytes):
+                nonlocal size
+                size += len(chunk)
+                # enforced on the fly, Content-Length is not sent by every server
+                size_limit.add(len(chunk))
+                digest.update(chunk)
+                download_file.write(chunk)
+
+            def next_chunk() -> bytes:
+                if abandoned.is_set():
+                    raise JobError("Input volume download abandoned")
+                try:
+                    chunk = asyncio.run_coroutine_threadsafe(anext(chunks), loop).result()
+                except StopAsyncIteration:
+                    return b''
+                add(chunk)
+                return chunk
+
+            streamed = True
+            try:
+                await asyncio.to_thread(extract_zip_stream, next_chunk, destination)
+            except ZipStreamError as exc:
+                logger.info(f'Input volume can\'t be extracted while downloaded ({exc}), extracting it once downloaded')
+                streamed = False
+            finally:
+                # e.g. timed out, the thread stops at its next chunk
+                abandoned.set()
+            # the central directory, for the digest of the whole zip, or the rest of a zip extracted once downloaded
+            async for chunk in chunks:
+                add(chunk)
+            if not streamed:
+                await asyncio.to_thread(self._extract_zip_file, download_file, destination)
+        return digest.hexdigest(), size
+
+    async def _download_ranges_and_extract(self, client: httpx.AsyncClient, url: str, first_response: httpx.Response,
+                                           size: int, destination: pathlib.Path) -> tuple[str, int]:
+        """
+        Download the zip in concurrent ranges to a preallocated file, the first one from `first_response`, then extract
+        it to `destination`. Return its sha256 and size.
+        """
+        range_size = settings.VOLUME_DOWNLOAD_RANGE_SIZE_BYTES
+        connections = asyncio.Semaphore(max(settings.VOLUME_DOWNLOAD_CONNECTIONS, 1))
+        with tempfile.NamedTemporaryFile() as download_file:
+            fd = download_file.fileno()
+            await asyncio.to_thread(preallocate, fd, size)
+            try:
+                async with asyncio.TaskGroup() as tg:
+                    for start in range(0, size, range_size):
+                        tg.create_task(self._download_range(
+                            client, url, fd, start, min(start + range_size, size), connections,
+                            first_response if start == 0 else None,
+                        ))
+            except ExceptionGroup as exc:
+                raise exc.exceptions[0]
+
+            def file_digest() -> str:
+                with open(download_file.name, 'rb') as f:
+                    return hashlib.file_digest(f, 'sha256').hexdigest()
+
+            digest, _ = await asyncio.gather(
+                asyncio.to_thread(file_digest),
+                asyncio.to_thread(self._extract_zip_file, download_file.name, destination),
+            )
+        return digest, size
+
+    async def _download_range(self, client: httpx.AsyncClient, url: str, fd: int, start: int, end: int,
+                              connections: asyncio.Semaphore, response: httpx.Response | None = None):
+        """Download bytes [start, end) of `url` to the file, resuming where a failed attempt stopped"""
+        async with connections:
+            offset = start
+            for attempt in range(VOLUME_DOWNLOAD_RANGE_ATTEMPTS):
+                await asyncio.sleep(attempt * VOLUME_DOWNLOAD_RETRY_DELAY_SECONDS)
+                try:
+                    if response is not None:
+                        offset = await self._write_range(response, fd, offset, end)
+                    else:
+                        async with client.stream('GET', url, headers={'Range': f'bytes={offset}-{end - 1}'}) as r:
+                            offset = await self._write_range(r, fd, offset, end)
+                except httpx.HTTPError as exc:
+                    logger.warning(f'Downloading bytes {offset}-{end - 1} of the input volume failed: {exc!r}')
+                response = None
+                if offset == end:
+                    return
+        raise JobError(f"Input volume bytes {start}-{end - 1} could not be downloaded")
+
+    @staticmethod
+    async def _write_range(response: httpx.Response, fd: int, offset: int, end: int) -> int:
+        """Write the range served by `response` from `offset` up to `end`, return the offset it got to"""
+        if response.is_error:
+            raise JobError(f"Input volume download failed with HTTP {response.status_code}")
+        content_range = parse_content_range(response.headers.get('Content-Range', ''))
+        if response.status_code != httpx.codes.PARTIAL_CONTENT or content_range is None or content_range[0] != offset:
+            logger.warning(f'Unexpected response to the input volume range request: {response.status_code}'
+                           f' {response.headers.get("Content-Range")}')
+            return offset
+        async for chunk in response.aiter_bytes(VOLUME_DOWNLOAD_CHUNK_SIZE):
+            chunk = chunk[:end - offset]
+            os.pwrite(fd, chunk, offset)
+            offset += len(chunk)
+            if offset == end:
+                break
+        return offset
+
+    @staticmethod
+    def _extract_zip_file(file: str | BinaryIO, destination: pathlib.Path):
+        try:
+            zipfile.ZipFile(file).extractall(destination.as_posix())
+        except zipfile.BadZipFile as exc:
+            raise JobError(f"Invalid input volume: {exc}") from exc
+
+    @staticmethod
+    def _verify_volume_digest(volume: Volume | VolumeShard, sha256: str, size: int):
+        """Content addressed volumes must be what they claim to be, they are cached under their sha256"""
+        if sha256 != volume.sha256 or (volume.size is not None and size != volume.size):
+            raise JobError(f"Volume does not match its sha256 {volume.sha256} and size {volume.size}")
+
+    async def unpack_volume(self, job_request: V0JobRequest, volume_blob: bytes | None = None):
+        try:
+            await asyncio.wait_for(
+                self._unpack_volume(job_request, volume_blob),
+                timeout=INPUT_VOLUME_UNPACK_TIMEOUT_SECONDS,
+            )
         except TimeoutError as exc:
             raise JobError("Input volume downloading took too long") from exc
 
@@ -299,15 +764,40 @@ class Command(BaseCommand):
     help = 'Run the executor, query the miner for job details, and run the job docker'
 
     MINER_CLIENT_CLASS = MinerClient
+    IDLE_MINER_CLIENT_CLASS = IdleMinerClient
     JOB_RUNNER_CLASS = JobRunner
 
     def __init__(self, *a, **kw):
         super().__init__(*a, **kw)
         self.loop = asyncio.get_event_loop()
         self.miner_client = self.MINER_CLIENT_CLASS(self.loop, settings.MINER_ADDRESS, settings.EXECUTOR_TOKEN)
+        # checked once, a persistent executor runs many jobs on the same host
+        self.system_safe: bool | None = None
 
     def handle(self, *args, **options):
-        self.loop.run_until_complete(self._executor_loop())
+        self.loop.run_until_complete(self._main_loop())
+
+    async def _main_loop(self):
+        while True:
+            await self._executor_loop()
+            if not settings.PERSISTENT_EXECUTOR or not settings.EXECUTOR_IDLE_TOKEN or self.system_safe is False:
+                return
+            await asyncio.to_thread(clean_job_dirs)
+            token = await self._wait_for_next_job()
+            if token is None:
+                return
+            self.miner_client = self.MINER_CLIENT_CLASS(self.loop, settings.MINER_ADDRESS, token)
+
+    async def _wait_for_next_job(self) -> str | None:
+        """Register with the miner as idle under the token it minted, return the next job's token, None on timeout"""
+        idle_client = self.IDLE_MINER_CLIENT_CLASS(self.loop, settings.MINER_ADDRESS, settings.EXECUTOR_IDLE_TOKEN)
+        logger.debug(f'Waiting for the next job as {idle_client.token}')
+        async with idle_client:
+            try:
+                return await asyncio.wait_for(idle_client.next_job_token, settings.EXECUTOR_IDLE_TIMEOUT_SECONDS)
+            except TimeoutError:
+                logger.info(f'No job in {settings.EXECUTOR_IDLE_TIMEOUT_SECONDS} seconds, exiting')
+                return None
 
     async def is_system_safe_for_cve_2022_0492(self):
         process = await asyncio.create_subprocess_exec(
@@ -323,6 +813,11 @@ class Command(BaseCommand):
         except TimeoutError:
             logger.error('CVE-2022-0492 check timed out')
             return False
+        finally:
+            if process.returncode is None:
+                # timed out, or cancelled with the job
+                process.kill()
+                await process.wait()
 
         if process.returncode != 0:
             logger.error(f'CVE-2022-0492 check failed: stdout="{stdout.decode()}"\nstderr="{stderr.decode()}')
@@ -335,35 +830,61 @@ class Command(BaseCommand):
 
         return True
 
+    async def check_system_safety(self, timeline: Timeline) -> bool:
+        """The CVE-2022-0492 check, once per process and sharing safe results with other executors of the host"""
+        if self.system_safe is not None:
+            return self.system_safe
+        with timeline.measure(JobPhase.cve_check):
+            cache = CveCheckCache.from_settings()
+            host_key = await cache.host_key() if cache.enabled else None
+            if host_key is not None and await asyncio.to_thread(cache.is_safe, host_key):
+                logger.debug('Host found safe for CVE-2022-0492 by a cached check')
+                self.system_safe = True
+            else:
+                logger.debug('Checking for CVE-2022-0492 vulnerability')
+                self.system_safe = await self.is_system_safe_for_cve_2022_0492()
+                if self.system_safe and host_key is not None:
+                    await asyncio.to_thread(cache.store_safe, host_key)
+        return self.system_safe
+
     async def _executor_loop(self):
         logger.debug(f'Connecting to miner: {settings.MINER_ADDRESS}')
+        timeline = self.miner_client.timeline
+        connect_started = time.monotonic()
         async with self.miner_client:
+            timeline.add(JobPhase.connect, time.monotonic() - connect_started)
             logger.debug(f'Connected to miner: {settings.MINER_ADDRESS}')
             initial_message: V0InitialJobRequest = await self.miner_client.initial_msg
-            logger.debug('Checking for CVE-2022-0492 vulnerability')
-            if not await self.is_system_safe_for_cve_2022_0492():
-                await self.miner_client.send_failed_to_prepare()
-                return
+            # the check runs while the job is being prepared
+            safety_check = asyncio.create_task(self.check_system_safety(timeline))
             try:
-                job_runner = self.JOB_RUNNER_CLASS(initial_message)
+                job_runner = self.JOB_RUNNER_CLASS(initial_message, timeline)
                 logger.debug(f'Preparing for job {initial_message.job_uuid}')
                 try:
                     await job_runner.prepare()
                 except JobError:
                     await self.miner_client.send_failed_to_prepare()
                     return
+                if not await safety_check:
+                    await self.miner_client.send_failed_to_prepare()
+                    return
 
                 logger.debug(f'Prepared for job {initial_message.job_uuid}')
 
-                await self.miner_client.send_ready()
+                await self.miner_client.send_ready(job_runner.cached_volumes())
                 logger.debug(f'Informed miner that I\'m ready for job {initial_message.job_uuid}')
 
                 job_request = await self.miner_client.full_payload
                 logger.debug(f'Running job {initial_message.job_uuid}')
-                result = await job_runner.run_job(job_request)
+                send_output_chunk = None
+                if transport.Feature.output_streaming in self.miner_client.features:
+                    send_output_chunk = self.miner_client.send_output_chunk
+                result = await job_runner.run_job(job_request, self.miner_client.volume_blob, send_output_chunk)
 
-                # Save the streams in output volume and truncate them in response.
+                # Save the streams in output volume and truncate them in response, streamed ones are saved already.
                 for field in ('stdout', 'stderr'):
+                    if getattr(result, f'{field}_sha256') is not None:
+                        continue
                     value = getattr(result, field)
                     # TODO: Replace open() with async calls (aiofiles or something) if it becomes a async-bottleneck
                     with open(output_volume_mount_dir / f'{field}.txt', 'w') as f:
@@ -373,7 +894,8 @@ class Command(BaseCommand):
                 if result.success:
                     if job_request.output_upload:
                         output_uploader = OutputUploader.for_upload_output(job_request.output_upload)
-                        await output_uploader.upload(output_volume_mount_dir)
+                        with timeline.measure(JobPhase.output_upload):
+                            await output_uploader.upload(output_volume_mount_dir)
                     await self.miner_client.send_finished(result)
                 else:
                     await self.miner_client.send_failed(result)
@@ -388,6 +910,10 @@ class Command(BaseCommand):
                 ))
             except Exception:
                 logger.error(f'Unhandled exception when working on job {initial_message.job_uuid}', exc_info=True)
-                # not deferred, because this is the end of the process, making it deferred would cause it never
-                # to be sent
+                # not deferred, because this is the end of the job's connection, making it deferred would cause it
+                # never to be sent
                 await self.miner_client.send_generic_error('Unexpected error')
+            finally:
+                safety_check.cancel()
+                # its docker run is stopped before the job's connection is closed
+                await asyncio.gather(safety_check, return_exceptions=True)
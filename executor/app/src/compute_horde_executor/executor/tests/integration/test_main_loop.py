@@ -1,7 +1,9 @@
 import asyncio
 import base64
+import hashlib
 import io
 import json
+import os
 import random
 import string
 import uuid
@@ -9,9 +11,21 @@ import zipfile
 from functools import partial
 from unittest import mock
 
-from pytest_httpx import HTTPXMock
+import httpx
+import msgpack
+import pytest
+from compute_horde import transport
+from compute_horde.image_cache import ImageCache
+from pytest_httpx import HTTPXMock, IteratorStream
 
-from compute_horde_executor.executor.management.commands.run_executor import Command, MinerClient
+from compute_horde_executor.executor.cve_check_cache import CveCheckCache
+from compute_horde_executor.executor.management.commands import run_executor
+from compute_horde_executor.executor.management.commands.run_executor import (
+    Command,
+    IdleMinerClient,
+    MinerClient,
+)
+from compute_horde_executor.executor.volume_cache import VolumeCache
 
 payload = ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(32))
 
@@ -37,6 +51,7 @@ class ContainsStr:
 class MockWebsocket:
     def __init__(self, messages):
         self.closed = False
+        self.open = True
         self.sent: list[str] = []
         self.messages = messages
         self.sent_messages: list[str] = []
@@ -50,6 +65,11 @@ class MockWebsocket:
         except StopIteration:
             await asyncio.Future()
 
+    async def ping(self):
+        pong_waiter = asyncio.get_running_loop().create_future()
+        pong_waiter.set_result(0.001)
+        return pong_waiter
+
     async def close(self):
         ...
 
@@ -63,12 +83,66 @@ class TestMinerClient(MinerClient):
         return MockWebsocket(self.__messages)
 
 
+class TestIdleMinerClient(IdleMinerClient):
+    def __init__(self, *args, messages, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.__messages = messages
+
+    async def _connect(self):
+        return MockWebsocket(self.__messages)
+
+
 class TestCommand(Command):
     def __init__(self, messages, *args, **kwargs):
         self.MINER_CLIENT_CLASS = partial(TestMinerClient, messages=messages)
         super().__init__(*args, **kwargs)
 
 
+class PersistentTestCommand(Command):
+    """Gets the messages of each job and of each wait for the next job from `jobs` and `idle`"""
+
+    def __init__(self, jobs, idle, *args, **kwargs):
+        self.miner_clients = []
+        self.idle_miner_clients = []
+
+        def miner_client(*a, **kw):
+            self.miner_clients.append(TestMinerClient(*a, messages=next(jobs), **kw))
+            return self.miner_clients[-1]
+
+        def idle_miner_client(*a, **kw):
+            self.idle_miner_clients.append(TestIdleMinerClient(*a, messages=next(idle), **kw))
+            return self.idle_miner_clients[-1]
+
+        self.MINER_CLIENT_CLASS = miner_client
+        self.IDLE_MINER_CLIENT_CLASS = idle_miner_client
+        super().__init__(*args, **kwargs)
+
+
+def job_messages(uuid_: str, image_digest: str | None = None):
+    return iter([
+        json.dumps({
+            "message_type": "V0PrepareJobRequest",
+            "base_docker_image_name": "alpine",
+            "base_docker_image_digest": image_digest,
+            "timeout_seconds": None,
+            "volume_type": "inline",
+            "job_uuid": uuid_,
+        }),
+        json.dumps({
+            "message_type": "V0RunJobRequest",
+            "docker_image_name": "backenddevelopersltd/compute-horde-job-echo:v0-latest",
+            "docker_image_digest": image_digest,
+            "docker_run_cmd": [],
+            "docker_run_options_preset": 'none',
+            "volume": {
+                "volume_type": "inline",
+                "contents": base64_zipfile,
+            },
+            "job_uuid": uuid_,
+        }),
+    ])
+
+
 def test_main_loop():
     command = TestCommand(iter([
         json.dumps({
@@ -95,16 +169,498 @@ def test_main_loop():
         {
             "message_type": "V0ReadyRequest",
             "job_uuid": job_uuid,
+            "cached_volumes": [],
+            "timeline": None,
+        },
+        {
+            "message_type": "V0FinishedRequest",
+            "docker_process_stdout": payload,
+            "docker_process_stderr": mock.ANY,
+            "docker_process_stdout_sha256": None,
+            "docker_process_stderr_sha256": None,
+            "timeline": None,
+            "job_uuid": job_uuid,
+        }
+    ]
+
+
+def test_main_loop_job_timeline():
+    command = TestCommand(iter([
+        json.dumps({
+            "message_type": "V0TransportSelectedRequest",
+            "encoding": "json",
+            "features": ["job_timeline"],
+        }),
+        json.dumps({
+            "message_type": "V0PrepareJobRequest",
+            "base_docker_image_name": "alpine",
+            "timeout_seconds": None,
+            "volume_type": "inline",
+            "job_uuid": job_uuid,
+        }),
+        json.dumps({
+            "message_type": "V0RunJobRequest",
+            "docker_image_name": "backenddevelopersltd/compute-horde-job-echo:v0-latest",
+            "docker_run_cmd": [],
+            "docker_run_options_preset": 'none',
+            "volume": {
+                "volume_type": "inline",
+                "contents": base64_zipfile,
+            },
+            "job_uuid": job_uuid,
+        }),
+    ]))
+    command.handle()
+    ready, finished = [json.loads(msg) for msg in command.miner_client.ws.sent_messages]
+    assert ready["message_type"] == "V0ReadyRequest"
+    assert set(ready["timeline"]) == {"connect", "cve_check", "docker_pull"}
+    assert finished["message_type"] == "V0FinishedRequest"
+    assert set(finished["timeline"]) == {"connect", "cve_check", "docker_pull", "run_image_pull", "volume", "run"}
+    assert all(duration >= 0 for duration in finished["timeline"].values())
+
+
+def test_main_loop_persistent(settings):
+    settings.PERSISTENT_EXECUTOR = True
+    settings.EXECUTOR_IDLE_TIMEOUT_SECONDS = 1
+    settings.EXECUTOR_IDLE_TOKEN = "idle-token"
+    second_job_uuid = str(uuid.uuid4())
+    command = PersistentTestCommand(
+        jobs=iter([job_messages(job_uuid), job_messages(second_job_uuid)]),
+        idle=iter([
+            iter([json.dumps({"message_type": "V0NextJobRequest", "executor_token": "next-token"})]),
+            iter([]),
+        ]),
+    )
+    command.handle()
+
+    first, second = command.miner_clients
+    assert second.token == "next-token"
+    for client, uuid_ in ((first, job_uuid), (second, second_job_uuid)):
+        ready, finished = [json.loads(msg) for msg in client.ws.sent_messages]
+        assert ready["message_type"] == "V0ReadyRequest"
+        assert ready["job_uuid"] == uuid_
+        assert finished["message_type"] == "V0FinishedRequest"
+        assert finished["job_uuid"] == uuid_
+        assert finished["docker_process_stdout"] == payload
+
+    # registered as idle under the token minted by the miner after each job, the second wait timed out
+    first_idle, second_idle = command.idle_miner_clients
+    assert first_idle.token == second_idle.token == "idle-token"
+    assert second_idle.next_job_token.cancelled()
+
+
+def test_main_loop_cached_cve_check(settings, tmp_path, monkeypatch):
+    settings.CVE_CHECK_CACHE_PATH = str(tmp_path / 'cve_check.json')
+    host_key = 'some kernel/some boot/some docker'
+    checks = []
+
+    async def get_host_key(self):
+        return host_key
+
+    async def is_system_safe(self):
+        checks.append(host_key)
+        return True
+
+    monkeypatch.setattr(CveCheckCache, 'host_key', get_host_key)
+    monkeypatch.setattr(Command, 'is_system_safe_for_cve_2022_0492', is_system_safe)
+
+    for _ in range(2):
+        command = TestCommand(job_messages(job_uuid))
+        command.handle()
+        assert [json.loads(msg)["message_type"] for msg in command.miner_client.ws.sent_messages] == [
+            "V0ReadyRequest",
+            "V0FinishedRequest",
+        ]
+    assert checks == [host_key]
+
+    # e.g. after a reboot
+    host_key = 'some kernel/other boot/some docker'
+    TestCommand(job_messages(job_uuid)).handle()
+    assert checks == ['some kernel/some boot/some docker', host_key]
+
+
+def test_main_loop_cached_images(settings, tmp_path, monkeypatch):
+    settings.IMAGE_CACHE_DIR = str(tmp_path)
+    local_images = set()
+    pulled = []
+
+    async def docker(self, *args, timeout=None):
+        if args[0] == 'pull':
+            pulled.append(args[1])
+            local_images.add(args[1])
+            return 0, '', ''
+        if args[:2] == ('image', 'inspect') and args[-1] in local_images:
+            return 0, '1000', ''
+        return 1, '', 'No such image'
+
+    monkeypatch.setattr(ImageCache, '_docker', docker)
+
+    for _ in range(2):
+        command = TestCommand(job_messages(job_uuid))
+        command.handle()
+        assert [json.loads(msg)["message_type"] for msg in command.miner_client.ws.sent_messages] == [
+            "V0ReadyRequest",
+            "V0FinishedRequest",
+        ]
+    # the second job finds both images fresh
+    assert pulled == ["alpine", "backenddevelopersltd/compute-horde-job-echo:v0-latest"]
+
+
+def test_main_loop_images_checked_with_registry(settings, tmp_path, monkeypatch):
+    settings.IMAGE_CACHE_DIR = str(tmp_path)
+    settings.IMAGE_CACHE_FRESHNESS_SECONDS = 0
+    local_digest = f'sha256:{hashlib.sha256(b"some image").hexdigest()}'
+    registry_digest = local_digest
+    local_images = set()
+    pulled = []
+
+    async def docker(self, *args, timeout=None):
+        if args[0] == 'pull':
+            pulled.append(args[1])
+            local_images.add(args[1])
+            return 0, '', ''
+        if args[:2] == ('image', 'inspect') and args[-1] in local_images:
+            if args[3] == '{{json .RepoDigests}}':
+                return 0, json.dumps([f'{args[-1]}@{local_digest}']), ''
+            return 0, '1000', ''
+        if args[:3] == ('buildx', 'imagetools', 'inspect'):
+            return 0, f'{registry_digest}\n', ''
+        return 1, '', 'No such image'
+
+    monkeypatch.setattr(ImageCache, '_docker', docker)
+
+    for _ in range(2):
+        TestCommand(job_messages(job_uuid)).handle()
+    # stale, but the registry has the same digests
+    assert pulled == ["alpine", "backenddevelopersltd/compute-horde-job-echo:v0-latest"]
+
+    registry_digest = f'sha256:{hashlib.sha256(b"other image").hexdigest()}'
+    TestCommand(job_messages(job_uuid)).handle()
+    assert pulled == ["alpine", "backenddevelopersltd/compute-horde-job-echo:v0-latest"] * 2
+
+
+def test_main_loop_pinned_images(settings, tmp_path, monkeypatch):
+    settings.IMAGE_CACHE_DIR = str(tmp_path)
+    # pinned images are never stale
+    settings.IMAGE_CACHE_FRESHNESS_SECONDS = 0
+    image_digest = f'sha256:{hashlib.sha256(b"some image").hexdigest()}'
+    local_images = set()
+    pulled = []
+
+    async def docker(self, *args, timeout=None):
+        if args[0] == 'pull':
+            pulled.append(args[1])
+            local_images.add(args[1])
+            return 0, '', ''
+        if args[:2] == ('image', 'inspect') and args[-1] in local_images:
+            return 0, '1000', ''
+        return 1, '', 'No such image'
+
+    monkeypatch.setattr(ImageCache, '_docker', docker)
+
+    for _ in range(2):
+        command = TestCommand(job_messages(job_uuid, image_digest))
+        command.handle()
+        assert [json.loads(msg)["message_type"] for msg in command.miner_client.ws.sent_messages] == [
+            "V0ReadyRequest",
+            "V0FinishedRequest",
+        ]
+    assert pulled == [
+        f"alpine@{image_digest}",
+        f"backenddevelopersltd/compute-horde-job-echo:v0-latest@{image_digest}",
+    ]
+
+
+def test_main_loop_unsafe_system(monkeypatch):
+    async def is_system_safe(self):
+        return False
+
+    monkeypatch.setattr(Command, 'is_system_safe_for_cve_2022_0492', is_system_safe)
+    command = TestCommand(job_messages(job_uuid))
+    command.handle()
+    assert [json.loads(msg) for msg in command.miner_client.ws.sent_messages] == [
+        {
+            "message_type": "V0FailedToPrepare",
+            "job_uuid": job_uuid,
+        },
+    ]
+
+
+def test_main_loop_msgpack_encoding():
+    command = TestCommand(iter([
+        json.dumps({
+            "message_type": "V0TransportSelectedRequest",
+            "encoding": "msgpack",
+        }),
+        msgpack.packb({
+            "message_type": "V0PrepareJobRequest",
+            "base_docker_image_name": "alpine",
+            "timeout_seconds": None,
+            "volume_type": "inline",
+            "job_uuid": job_uuid,
+        }),
+        msgpack.packb({
+            "message_type": "V0RunJobRequest",
+            "docker_image_name": "backenddevelopersltd/compute-horde-job-echo:v0-latest",
+            "docker_run_cmd": [],
+            "docker_run_options_preset": 'none',
+            "volume": {
+                "volume_type": "inline",
+                "contents": base64_zipfile,
+            },
+            "job_uuid": job_uuid,
+        }),
+    ]))
+    command.handle()
+    assert [msgpack.unpackb(msg) for msg in command.miner_client.ws.sent_messages] == [
+        {
+            "message_type": "V0ReadyRequest",
+            "job_uuid": job_uuid,
+            "cached_volumes": [],
+            "timeline": None,
+        },
+        {
+            "message_type": "V0FinishedRequest",
+            "docker_process_stdout": payload,
+            "docker_process_stderr": mock.ANY,
+            "docker_process_stdout_sha256": None,
+            "docker_process_stderr_sha256": None,
+            "timeline": None,
+            "job_uuid": job_uuid,
+        }
+    ]
+
+
+def test_main_loop_volume_blob():
+    blob_reference, blob_frame = transport.encode_blob(zip_contents)
+    command = TestCommand(iter([
+        json.dumps({
+            "message_type": "V0TransportSelectedRequest",
+            "encoding": "json",
+            "features": ["blobs"],
+        }),
+        json.dumps({
+            "message_type": "V0PrepareJobRequest",
+            "base_docker_image_name": "alpine",
+            "timeout_seconds": None,
+            "volume_type": "inline",
+            "job_uuid": job_uuid,
+        }),
+        blob_frame,
+        json.dumps({
+            "message_type": "V0RunJobRequest",
+            "docker_image_name": "backenddevelopersltd/compute-horde-job-echo:v0-latest",
+            "docker_run_cmd": [],
+            "docker_run_options_preset": 'none',
+            "volume": {
+                "volume_type": "inline",
+                "contents": "",
+                "blob": blob_reference.dict(),
+            },
+            "job_uuid": job_uuid,
+        }),
+    ]))
+    command.handle()
+    assert [json.loads(msg) for msg in command.miner_client.ws.sent_messages] == [
+        {
+            "message_type": "V0ReadyRequest",
+            "job_uuid": job_uuid,
+            "cached_volumes": [],
+            "timeline": None,
+        },
+        {
+            "message_type": "V0FinishedRequest",
+            "docker_process_stdout": payload,
+            "docker_process_stderr": mock.ANY,
+            "docker_process_stdout_sha256": None,
+            "docker_process_stderr_sha256": None,
+            "timeline": None,
+            "job_uuid": job_uuid,
+        }
+    ]
+
+
+def test_main_loop_compression():
+    command = TestCommand(iter([
+        json.dumps({
+            "message_type": "V0TransportSelectedRequest",
+            "encoding": "msgpack",
+            "compression": "deflate",
+        }),
+        transport.compress(msgpack.packb({
+            "message_type": "V0PrepareJobRequest",
+            "base_docker_image_name": "alpine",
+            "timeout_seconds": None,
+            "volume_type": "inline",
+            "job_uuid": job_uuid,
+        }), transport.Compression.deflate),
+        transport.compress(msgpack.packb({
+            "message_type": "V0RunJobRequest",
+            "docker_image_name": "backenddevelopersltd/compute-horde-job-echo:v0-latest",
+            "docker_run_cmd": [],
+            "docker_run_options_preset": 'none',
+            "volume": {
+                "volume_type": "inline",
+                "contents": base64_zipfile,
+            },
+            "job_uuid": job_uuid,
+        }), transport.Compression.deflate),
+    ]))
+    # compress every frame, not only the large ones
+    with mock.patch.object(transport, 'COMPRESSION_THRESHOLD_BYTES', 0):
+        command.handle()
+    assert all(msg.startswith(transport.COMPRESSED_FRAME_PREFIX) for msg in command.miner_client.ws.sent_messages)
+    assert [transport.decode(msg) for msg in command.miner_client.ws.sent_messages] == [
+        {
+            "message_type": "V0ReadyRequest",
+            "job_uuid": job_uuid,
+            "cached_volumes": [],
+            "timeline": None,
         },
         {
             "message_type": "V0FinishedRequest",
             "docker_process_stdout": payload,
             "docker_process_stderr": mock.ANY,
+            "docker_process_stdout_sha256": None,
+            "docker_process_stderr_sha256": None,
+            "timeline": None,
             "job_uuid": job_uuid,
         }
     ]
 
 
+def test_main_loop_output_streaming():
+    command = TestCommand(iter([
+        json.dumps({
+            "message_type": "V0TransportSelectedRequest",
+            "encoding": "json",
+            "features": ["output_streaming"],
+        }),
+        json.dumps({
+            "message_type": "V0PrepareJobRequest",
+            "base_docker_image_name": "alpine",
+            "timeout_seconds": None,
+            "volume_type": "inline",
+            "job_uuid": job_uuid,
+        }),
+        json.dumps({
+            "message_type": "V0RunJobRequest",
+            "docker_image_name": "backenddevelopersltd/compute-horde-job-echo:v0-latest",
+            "docker_run_cmd": [],
+            "docker_run_options_preset": 'none',
+            "volume": {
+                "volume_type": "inline",
+                "contents": base64_zipfile,
+            },
+            "job_uuid": job_uuid,
+        }),
+    ]))
+    command.handle()
+    sent = [json.loads(msg) for msg in command.miner_client.ws.sent_messages]
+    assert sent[0] == {
+        "message_type": "V0ReadyRequest",
+        "job_uuid": job_uuid,
+        "cached_volumes": [],
+        "timeline": None,
+    }
+    chunks = sent[1:-1]
+    assert {chunk["message_type"] for chunk in chunks} == {"V0JobOutputChunk"}
+    stdout = ''.join(chunk["data"] for chunk in chunks if chunk["stream"] == "stdout")
+    stderr = ''.join(chunk["data"] for chunk in chunks if chunk["stream"] == "stderr")
+    assert stdout == payload
+    assert sent[-1] == {
+        "message_type": "V0FinishedRequest",
+        "docker_process_stdout": "",
+        "docker_process_stderr": "",
+        "docker_process_stdout_sha256": hashlib.sha256(stdout.encode()).hexdigest(),
+        "docker_process_stderr_sha256": hashlib.sha256(stderr.encode()).hexdigest(),
+        "timeline": None,
+        "job_uuid": job_uuid,
+    }
+
+
+def test_content_addressed_volume(settings, tmp_path):
+    settings.VOLUME_CACHE_DIR = str(tmp_path)
+    zip_sha256 = hashlib.sha256(zip_contents).hexdigest()
+
+    def run(volume: dict) -> list[dict]:
+        command = TestCommand(iter([
+            json.dumps({
+                "message_type": "V0PrepareJobRequest",
+                "base_docker_image_name": "alpine",
+                "timeout_seconds": None,
+                "volume_type": "content_addressed",
+                "job_uuid": job_uuid,
+            }),
+            json.dumps({
+                "message_type": "V0RunJobRequest",
+                "docker_image_name": "backenddevelopersltd/compute-horde-job-echo:v0-latest",
+                "docker_run_cmd": [],
+                "docker_run_options_preset": 'none',
+                "volume": {
+                    "volume_type": "content_addressed",
+                    "sha256": zip_sha256,
+                    "size": len(zip_contents),
+                    **volume,
+                },
+                "job_uuid": job_uuid,
+            }),
+        ]))
+        command.handle()
+        return [json.loads(msg) for msg in command.miner_client.ws.sent_messages]
+
+    finished = {
+        "message_type": "V0FinishedRequest",
+        "docker_process_stdout": payload,
+        "docker_process_stderr": mock.ANY,
+        "docker_process_stdout_sha256": None,
+        "docker_process_stderr_sha256": None,
+        "timeline": None,
+        "job_uuid": job_uuid,
+    }
+    # not cached yet, fetched from the fallback
+    assert run({"contents": base64_zipfile, "fallback_volume_type": "inline"}) == [
+        {"message_type": "V0ReadyRequest", "job_uuid": job_uuid, "cached_volumes": [], "timeline": None},
+        finished,
+    ]
+    assert run({"contents": ""}) == [
+        {"message_type": "V0ReadyRequest", "job_uuid": job_uuid, "cached_volumes": [zip_sha256], "timeline": None},
+        finished,
+    ]
+
+
+def test_content_addressed_volume_digest_mismatch(settings, tmp_path):
+    settings.VOLUME_CACHE_DIR = str(tmp_path)
+    command = TestCommand(iter([
+        json.dumps({
+            "message_type": "V0PrepareJobRequest",
+            "base_docker_image_name": "alpine",
+            "timeout_seconds": None,
+            "volume_type": "content_addressed",
+            "job_uuid": job_uuid,
+        }),
+        json.dumps({
+            "message_type": "V0RunJobRequest",
+            "docker_image_name": "backenddevelopersltd/compute-horde-job-echo:v0-latest",
+            "docker_run_cmd": [],
+            "docker_run_options_preset": 'none',
+            "volume": {
+                "volume_type": "content_addressed",
+                "sha256": hashlib.sha256(b"something else").hexdigest(),
+                "size": len(zip_contents),
+                "contents": base64_zipfile,
+                "fallback_volume_type": "inline",
+            },
+            "job_uuid": job_uuid,
+        }),
+    ]))
+    command.handle()
+    sent = [json.loads(msg) for msg in command.miner_client.ws.sent_messages]
+    assert sent[-1]["message_type"] == "V0FailedRequest"
+    assert "does not match its sha256" in sent[-1]["docker_process_stdout"]
+    assert not list(tmp_path.iterdir())
+
+
 def test_zip_url_volume(httpx_mock: HTTPXMock):
     zip_url = 'https://localhost/payload.txt'
     httpx_mock.add_response(url=zip_url, content=zip_contents)
@@ -134,11 +690,16 @@ def test_zip_url_volume(httpx_mock: HTTPXMock):
         {
             "message_type": "V0ReadyRequest",
             "job_uuid": job_uuid,
+            "cached_volumes": [],
+            "timeline": None,
         },
         {
             "message_type": "V0FinishedRequest",
             "docker_process_stdout": payload,
             "docker_process_stderr": mock.ANY,
+            "docker_process_stdout_sha256": None,
+            "docker_process_stderr_sha256": None,
+            "timeline": None,
             "job_uuid": job_uuid,
         }
     ]
@@ -175,6 +736,8 @@ def test_zip_url_too_big_volume_should_fail(httpx_mock: HTTPXMock, settings):
         {
             "message_type": "V0ReadyRequest",
             "job_uuid": job_uuid,
+            "cached_volumes": [],
+            "timeline": None,
         },
         {
             "message_type": "V0FailedRequest",
@@ -182,11 +745,281 @@ def test_zip_url_too_big_volume_should_fail(httpx_mock: HTTPXMock, settings):
             "timeout": False,
             "docker_process_stdout": "Input volume too large",
             "docker_process_stderr": "",
+            "docker_process_stdout_sha256": None,
+            "docker_process_stderr_sha256": None,
+            "timeline": None,
             "job_uuid": job_uuid,
         }
     ]
 
 
+def zip_url_volume_messages(zip_url: str):
+    return iter([
+        json.dumps({
+            "message_type": "V0PrepareJobRequest",
+            "base_docker_image_name": "alpine",
+            "timeout_seconds": None,
+            "volume_type": "zip_url",
+            "job_uuid": job_uuid,
+        }),
+        json.dumps({
+            "message_type": "V0RunJobRequest",
+            "docker_image_name": "backenddevelopersltd/compute-horde-job-echo:v0-latest",
+            "docker_run_cmd": [],
+            "docker_run_options_preset": 'none',
+            "volume": {
+                "volume_type": "zip_url",
+                "contents": zip_url,
+            },
+            "job_uuid": job_uuid,
+        }),
+    ])
+
+
+def test_zip_url_volume_without_content_length(httpx_mock: HTTPXMock):
+    zip_url = 'https://localhost/payload.txt'
+    # chunked, extracted as the chunks arrive
+    httpx_mock.add_response(url=zip_url, stream=IteratorStream([zip_contents[i:i + 10]
+                                                                for i in range(0, len(zip_contents), 10)]))
+
+    command = TestCommand(zip_url_volume_messages(zip_url))
+    command.handle()
+    assert [json.loads(msg)["message_type"] for msg in command.miner_client.ws.sent_messages] == [
+        "V0ReadyRequest",
+        "V0FinishedRequest",
+    ]
+    assert json.loads(command.miner_client.ws.sent_messages[-1])["docker_process_stdout"] == payload
+
+
+def test_zip_url_too_big_volume_without_content_length_should_fail(httpx_mock: HTTPXMock, settings):
+    settings.VOLUME_MAX_SIZE_BYTES = len(zip_contents) - 1
+
+    zip_url = 'https://localhost/payload.txt'
+    httpx_mock.add_response(url=zip_url, stream=IteratorStream([zip_contents]))
+
+    command = TestCommand(zip_url_volume_messages(zip_url))
+    command.handle()
+    failed = json.loads(command.miner_client.ws.sent_messages[-1])
+    assert failed["message_type"] == "V0FailedRequest"
+    assert failed["docker_process_stdout"] == "Input volume too large"
+
+
+def test_zip_url_invalid_volume_should_fail(httpx_mock: HTTPXMock):
+    zip_url = 'https://localhost/payload.txt'
+    httpx_mock.add_response(url=zip_url, content=b'not a zip')
+
+    command = TestCommand(zip_url_volume_messages(zip_url))
+    command.handle()
+    failed = json.loads(command.miner_client.ws.sent_messages[-1])
+    assert failed["message_type"] == "V0FailedRequest"
+    assert failed["docker_process_stdout"] == "Invalid input volume: File is not a zip file"
+
+
+
+def test_zip_url_volume_http_error_should_fail(httpx_mock: HTTPXMock):
+    zip_url = 'https://localhost/payload.txt'
+    httpx_mock.add_response(url=zip_url, status_code=404, content=b'Not Found')
+
+    command = TestCommand(zip_url_volume_messages(zip_url))
+    command.handle()
+    failed = json.loads(command.miner_client.ws.sent_messages[-1])
+    assert failed["message_type"] == "V0FailedRequest"
+    assert failed["docker_process_stdout"] == "Input volume download failed with HTTP 404"
+
+
+def test_zip_url_volume_range_http_error_should_fail(httpx_mock: HTTPXMock, settings):
+    settings.VOLUME_DOWNLOAD_RANGE_SIZE_BYTES = 50
+
+    def serve_range(request: httpx.Request):
+        first, last = map(int, request.headers['Range'].removeprefix('bytes=').split('-'))
+        if first > 0:
+            return httpx.Response(status_code=403, content=b'Forbidden')
+        return httpx.Response(
+            status_code=206,
+            headers={'Content-Range': f'bytes {first}-{last}/{len(zip_contents)}'},
+            content=zip_contents[first:last + 1],
+        )
+
+    httpx_mock.add_callback(serve_range, url='https://localhost/payload.txt')
+
+    command = TestCommand(zip_url_volume_messages('https://localhost/payload.txt'))
+    command.handle()
+    failed = json.loads(command.miner_client.ws.sent_messages[-1])
+    assert failed["message_type"] == "V0FailedRequest"
+    assert failed["docker_process_stdout"] == "Input volume download failed with HTTP 403"
+
+class UnseekableBytesIO(io.BytesIO):
+    def seekable(self):
+        return False
+
+    def seek(self, *args):
+        raise io.UnsupportedOperation('seek')
+
+
+def stored_with_data_descriptors() -> bytes:
+    # a streaming writer doesn't know the sizes of entries before writing them
+    output = UnseekableBytesIO()
+    with zipfile.ZipFile(output, 'w', compression=zipfile.ZIP_STORED) as zipf:
+        zipf.writestr('payload.txt', payload)
+    return output.getvalue()
+
+
+@pytest.mark.parametrize('contents', [
+    stored_with_data_descriptors(),
+    # e.g. a self-extracting archive
+    b'#!/bin/sh\nexit 0\n' + zip_contents,
+])
+def test_zip_url_volume_not_extracted_while_downloaded(httpx_mock: HTTPXMock, contents):
+    zip_url = 'https://localhost/payload.txt'
+    httpx_mock.add_response(url=zip_url, stream=IteratorStream([contents[i:i + 10]
+                                                                for i in range(0, len(contents), 10)]))
+
+    command = TestCommand(zip_url_volume_messages(zip_url))
+    command.handle()
+    assert [json.loads(msg)["message_type"] for msg in command.miner_client.ws.sent_messages] == [
+        "V0ReadyRequest",
+        "V0FinishedRequest",
+    ]
+    assert json.loads(command.miner_client.ws.sent_messages[-1])["docker_process_stdout"] == payload
+
+
+def test_zip_url_volume_in_ranges(httpx_mock: HTTPXMock, settings, monkeypatch):
+    settings.VOLUME_DOWNLOAD_RANGE_SIZE_BYTES = 50
+    monkeypatch.setattr(run_executor, 'VOLUME_DOWNLOAD_RETRY_DELAY_SECONDS', 0)
+    zip_url = 'https://localhost/payload.txt'
+    requested_ranges = []
+
+    def serve_range(request: httpx.Request):
+        first, last = map(int, request.headers['Range'].removeprefix('bytes=').split('-'))
+        requested_ranges.append((first, last))
+        if requested_ranges.count((first, last)) == 1 and first == 50:
+            raise httpx.ReadError('connection reset')
+        last = min(last, len(zip_contents) - 1)
+        return httpx.Response(
+            status_code=206,
+            headers={'Content-Range': f'bytes {first}-{last}/{len(zip_contents)}'},
+            content=zip_contents[first:last + 1],
+        )
+
+    httpx_mock.add_callback(serve_range, url=zip_url)
+
+    command = TestCommand(zip_url_volume_messages(zip_url))
+    command.handle()
+    assert [json.loads(msg)["message_type"] for msg in command.miner_client.ws.sent_messages] == [
+        "V0ReadyRequest",
+        "V0FinishedRequest",
+    ]
+    assert json.loads(command.miner_client.ws.sent_messages[-1])["docker_process_stdout"] == payload
+    # the failed range is retried
+    assert sorted(requested_ranges) == sorted([
+        (start, min(start + 49, len(zip_contents) - 1)) for start in range(0, len(zip_contents), 50)
+    ] + [(50, 99)])
+
+
+def test_zip_url_volume_cached_by_etag(httpx_mock: HTTPXMock, settings, tmp_path):
+    settings.VOLUME_CACHE_DIR = str(tmp_path)
+    zip_url = 'https://localhost/payload.zip'
+    # the body of the second response is not read, the volume is found in the cache by its ETag
+    httpx_mock.add_response(url=zip_url, content=zip_contents, headers={'ETag': '"1"'})
+    httpx_mock.add_response(url=zip_url, content=b'not a zip', headers={'ETag': '"1"'})
+
+    for _ in range(2):
+        command = TestCommand(zip_url_volume_messages(zip_url))
+        command.handle()
+        assert [json.loads(msg) for msg in command.miner_client.ws.sent_messages] == [
+            # not reported as content addressed volumes
+            {"message_type": "V0ReadyRequest", "job_uuid": job_uuid, "cached_volumes": [], "timeline": None},
+            {
+                "message_type": "V0FinishedRequest",
+                "docker_process_stdout": payload,
+                "docker_process_stderr": mock.ANY,
+                "docker_process_stdout_sha256": None,
+                "docker_process_stderr_sha256": None,
+                "timeline": None,
+                "job_uuid": job_uuid,
+            },
+        ]
+
+
+def test_zip_urls_volume(httpx_mock: HTTPXMock, settings, tmp_path):
+    settings.VOLUME_CACHE_DIR = str(tmp_path)
+    other_zip = io.BytesIO()
+    with zipfile.ZipFile(other_zip, 'w') as zip_file:
+        zip_file.writestr('other.txt', 'other')
+    httpx_mock.add_response(url='https://localhost/payload.zip', content=zip_contents)
+    httpx_mock.add_response(url='https://localhost/other.zip', content=other_zip.getvalue())
+
+    def run() -> list[str]:
+        command = TestCommand(iter([
+            json.dumps({
+                "message_type": "V0PrepareJobRequest",
+                "base_docker_image_name": "alpine",
+                "timeout_seconds": None,
+                "volume_type": "zip_urls",
+                "job_uuid": job_uuid,
+            }),
+            json.dumps({
+                "message_type": "V0RunJobRequest",
+                "docker_image_name": "backenddevelopersltd/compute-horde-job-echo:v0-latest",
+                "docker_run_cmd": [],
+                "docker_run_options_preset": 'none',
+                "volume": {
+                    "volume_type": "zip_urls",
+                    "contents": "",
+                    "shards": [
+                        {
+                            "url": 'https://localhost/payload.zip',
+                            "sha256": hashlib.sha256(zip_contents).hexdigest(),
+                            "size": len(zip_contents),
+                        },
+                        {"url": 'https://localhost/other.zip', "relative_path": "data/other"},
+                    ],
+                },
+                "job_uuid": job_uuid,
+            }),
+        ]))
+        command.handle()
+        assert (run_executor.volume_mount_dir / 'data' / 'other' / 'other.txt').read_text() == 'other'
+        return [json.loads(msg)["message_type"] for msg in command.miner_client.ws.sent_messages]
+
+    assert run() == ["V0ReadyRequest", "V0FinishedRequest"]
+    # the shard with a sha256 is cached
+    assert run() == ["V0ReadyRequest", "V0FinishedRequest"]
+    assert sorted(str(request.url) for request in httpx_mock.get_requests()) == [
+        'https://localhost/other.zip',
+        'https://localhost/other.zip',
+        'https://localhost/payload.zip',
+    ]
+
+
+def test_zip_urls_volume_outside_path_should_fail():
+    command = TestCommand(iter([
+        json.dumps({
+            "message_type": "V0PrepareJobRequest",
+            "base_docker_image_name": "alpine",
+            "timeout_seconds": None,
+            "volume_type": "zip_urls",
+            "job_uuid": job_uuid,
+        }),
+        json.dumps({
+            "message_type": "V0RunJobRequest",
+            "docker_image_name": "backenddevelopersltd/compute-horde-job-echo:v0-latest",
+            "docker_run_cmd": [],
+            "docker_run_options_preset": 'none',
+            "volume": {
+                "volume_type": "zip_urls",
+                "contents": "",
+                "shards": [{"url": 'https://localhost/payload.zip', "relative_path": "../output"}],
+            },
+            "job_uuid": job_uuid,
+        }),
+    ]))
+    command.handle()
+    failed = json.loads(command.miner_client.ws.sent_messages[-1])
+    assert failed["message_type"] == "V0FailedRequest"
+    assert failed["docker_process_stdout"] == "Volume shard path ../output is outside of the volume"
+
+
 def test_zip_and_http_post_output_uploader(httpx_mock: HTTPXMock, tmp_path):
     # Arrange
     httpx_mock.add_response()
@@ -227,11 +1060,16 @@ def test_zip_and_http_post_output_uploader(httpx_mock: HTTPXMock, tmp_path):
         {
             "message_type": "V0ReadyRequest",
             "job_uuid": job_uuid,
+            "cached_volumes": [],
+            "timeline": None,
         },
         {
             "message_type": "V0FinishedRequest",
             "docker_process_stdout": payload,
             "docker_process_stderr": mock.ANY,
+            "docker_process_stdout_sha256": None,
+            "docker_process_stderr_sha256": None,
+            "timeline": None,
             "job_uuid": job_uuid,
         },
     ]
@@ -240,3 +1078,70 @@ def test_zip_and_http_post_output_uploader(httpx_mock: HTTPXMock, tmp_path):
     assert request is not None
     assert request.url == post_url
     assert request.method == 'POST'
+
+
+def test_cve_check_cache_writable_by_others_not_trusted(tmp_path):
+    host_key = 'some kernel/some boot/some docker'
+    cache = CveCheckCache(tmp_path / 'cve_check' / 'result.json', ttl_seconds=60)
+    cache.store_safe(host_key)
+    assert cache.is_safe(host_key)
+
+    cache.path.chmod(0o666)
+    assert not cache.is_safe(host_key)
+    cache.path.chmod(0o600)
+    cache.path.parent.chmod(0o777)
+    assert not cache.is_safe(host_key)
+    cache.path.parent.chmod(0o700)
+    assert cache.is_safe(host_key)
+
+
+def test_cancelled_cve_check_stops_docker(tmp_path, monkeypatch):
+    pid_path = tmp_path / 'docker.pid'
+    docker = tmp_path / 'docker'
+    docker.write_text(f'#!/bin/sh\necho $$ > {pid_path}\nexec sleep 60\n')
+    docker.chmod(0o755)
+    monkeypatch.setenv('PATH', f'{tmp_path}:{os.environ["PATH"]}')
+
+    async def cancel_check():
+        check = asyncio.create_task(Command().is_system_safe_for_cve_2022_0492())
+        while not pid_path.exists() or not pid_path.read_text():
+            await asyncio.sleep(0.01)
+        check.cancel()
+        await asyncio.gather(check, return_exceptions=True)
+
+    asyncio.run(asyncio.wait_for(cancel_check(), 10))
+    with pytest.raises(ProcessLookupError):
+        os.kill(int(pid_path.read_text()), 0)
+
+
+def test_image_lock_wait_cancellable(tmp_path):
+    cache = ImageCache(tmp_path)
+
+    async def lock_twice():
+        async with cache._image_lock('image'):
+            waiting = asyncio.create_task(cache._image_lock('image').__aenter__())
+            await asyncio.sleep(0.3)
+            assert not waiting.done()
+            waiting.cancel()
+            await asyncio.gather(waiting, return_exceptions=True)
+            assert waiting.cancelled()
+        # released, and not taken by the cancelled waiter
+        async with cache._image_lock('image'):
+            pass
+
+    asyncio.run(asyncio.wait_for(lock_twice(), 5))
+
+
+def test_volume_from_cache_modified_in_place(tmp_path):
+    cache = VolumeCache(tmp_path / 'cache', max_size_bytes=1024)
+    volume = tmp_path / 'volume'
+    volume.mkdir()
+    (volume / 'payload.txt').write_text(payload)
+    cache.store('key', volume)
+
+    for job_volume in (tmp_path / 'first', tmp_path / 'second'):
+        assert cache.copy_to('key', job_volume)
+        assert (job_volume / 'payload.txt').read_text() == payload
+        # e.g. a job writing to its volume files, later jobs don't see it
+        with open(job_volume / 'payload.txt', 'r+') as f:
+            f.write('modified')
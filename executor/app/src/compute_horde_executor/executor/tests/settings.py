@@ -1,4 +1,5 @@
 import os
+import tempfile
 
 os.environ.update({
     "DEBUG_TOOLBAR": "False",
@@ -7,3 +8,4 @@ os.environ.update({
 from compute_horde_executor.settings import *  # noqa: E402,F403
 
 PROMETHEUS_EXPORT_MIGRATIONS = False
+VOLUME_CACHE_DIR = tempfile.mkdtemp()
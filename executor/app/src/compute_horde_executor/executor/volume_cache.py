@@ -0,0 +1,125 @@
+import fcntl
+import hashlib
+import logging
+import os
+import pathlib
+import shutil
+import tempfile
+from typing import Self
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# how many digests are reported to the miner, most recently used first
+MAX_REPORTED_DIGESTS = 100
+# entries of zips cached under their url and ETag rather than their sha256
+URL_KEY_PREFIX = 'url-'
+# ioctl cloning a file copy-on-write, fcntl.FICLONE from Python 3.12
+FICLONE = 0x40049409
+
+
+class VolumeCache:
+    """
+    Unpacked content_addressed volumes, keyed by the sha256 of their zip, and zips downloaded from urls, keyed by
+    `url_key`. The cache directory is shared by executors of the same host (e.g. /tmp of the host), least recently
+    used volumes are evicted above `max_size_bytes`.
+
+    Layout: `<directory>/<key>/volume/` with the unpacked files and `<directory>/<key>/size` with their size.
+    Volumes get copy-on-write clones of the cached files where the filesystem supports them (btrfs, xfs), so they
+    share the data with the cache until a job modifies it, and copies elsewhere.
+    """
+
+    def __init__(self, directory: pathlib.Path, max_size_bytes: int):
+        self.directory = directory
+        self.max_size_bytes = max_size_bytes
+
+    @classmethod
+    def from_settings(cls) -> Self:
+        return cls(pathlib.Path(settings.VOLUME_CACHE_DIR), settings.VOLUME_CACHE_MAX_SIZE_BYTES)
+
+    @staticmethod
+    def url_key(url: str, etag: str) -> str | None:
+        """Key of the zip served from `url` with `etag`, None for weak ETags, which don't identify the bytes"""
+        if etag.startswith('W/'):
+            return None
+        return URL_KEY_PREFIX + hashlib.sha256(f'{url}\n{etag}'.encode()).hexdigest()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size_bytes > 0
+
+    def _entries(self) -> list[pathlib.Path]:
+        """Complete entries, most recently used first"""
+        if not self.enabled or not self.directory.is_dir():
+            return []
+        entries = [entry for entry in self.directory.iterdir() if (entry / 'size').is_file()]
+        return sorted(entries, key=lambda entry: entry.stat().st_mtime, reverse=True)
+
+    def digests(self) -> list[str]:
+        digests = [entry.name for entry in self._entries() if not entry.name.startswith(URL_KEY_PREFIX)]
+        return digests[:MAX_REPORTED_DIGESTS]
+
+    def copy_to(self, key: str, destination: pathlib.Path) -> bool:
+        """Copy the unpacked volume into `destination`, False if it's not cached"""
+        if not self.enabled:
+            return False
+        entry = self.directory / key
+        if not (entry / 'size').is_file():
+            return False
+        try:
+            shutil.copytree(entry / 'volume', destination, dirs_exist_ok=True, copy_function=self._clone)
+        except (OSError, shutil.Error):
+            # evicted by another executor in the meantime
+            logger.warning(f'Could not copy cached volume {key}', exc_info=True)
+            return False
+        os.utime(entry)
+        logger.debug(f'Volume {key} copied from cache')
+        return True
+
+    @staticmethod
+    def _clone(source: str, destination: str):
+        try:
+            with open(source, 'rb') as source_file, open(destination, 'wb') as destination_file:
+                fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+        except OSError:
+            # e.g. not supported by the filesystem, or another filesystem
+            shutil.copy2(source, destination)
+            return
+        shutil.copystat(source, destination)
+
+    def store(self, key: str, source: pathlib.Path):
+        """Cache the unpacked volume in `source`, evicting others if needed"""
+        if not self.enabled:
+            return
+        size = sum(path.stat().st_size for path in source.rglob('*') if path.is_file())
+        if size > self.max_size_bytes:
+            logger.debug(f'Volume {key} of {size} bytes is too large to be cached')
+            return
+        self.directory.mkdir(parents=True, exist_ok=True)
+        entry = self.directory / key
+        # copied aside and renamed, so other executors never see a partial entry
+        staging = pathlib.Path(tempfile.mkdtemp(dir=self.directory, prefix='.staging-'))
+        try:
+            shutil.copytree(source, staging / 'volume')
+            (staging / 'size').write_text(str(size))
+            staging.rename(entry)
+        except OSError:
+            # cached by another executor in the meantime
+            shutil.rmtree(staging, ignore_errors=True)
+            return
+        logger.debug(f'Volume {key} cached')
+        self.evict()
+
+    def evict(self):
+        total = 0
+        for entry in self._entries():
+            try:
+                size = int((entry / 'size').read_text())
+            except (OSError, ValueError):
+                continue
+            if total + size > self.max_size_bytes:
+                logger.debug(f'Evicting volume {entry.name} from cache')
+                shutil.rmtree(entry, ignore_errors=True)
+            else:
+                total += size
@@ -0,0 +1,177 @@
+"""
+Extraction of zip archives while they are downloaded.
+
+Every zip entry is preceded by a local header, so entries can be extracted in order as the bytes arrive, without the
+central directory at the end of the archive (which is skipped). Supported are the methods with streaming
+decompressors: stored, deflated and bzip2. Sizes that follow the data of an entry (data descriptors, written by
+streaming zip writers) are supported for deflated and bzip2 entries. Names are sanitized the way
+zipfile.ZipFile.extractall does it.
+"""
+import bz2
+import os
+import pathlib
+import struct
+import zlib
+from collections.abc import Callable
+
+LOCAL_HEADER_SIGNATURE = b'PK\x03\x04'
+CENTRAL_DIRECTORY_SIGNATURE = b'PK\x01\x02'
+END_OF_CENTRAL_DIRECTORY_SIGNATURE = b'PK\x05\x06'
+DATA_DESCRIPTOR_SIGNATURE = b'PK\x07\x08'
+
+# local header after the signature: version, flags, method, time, date, crc32, compressed size, size, name length,
+# extra field length
+LOCAL_HEADER = struct.Struct('<5H3L2H')
+EXTRA_FIELD_HEADER = struct.Struct('<2H')
+ZIP64_EXTRA_FIELD_ID = 0x0001
+ZIP64_LIMIT = 0xFFFFFFFF
+
+FLAG_ENCRYPTED = 0x1
+FLAG_DATA_DESCRIPTOR = 0x8
+FLAG_UTF8 = 0x800
+
+METHOD_STORED = 0
+METHOD_DEFLATED = 8
+METHOD_BZIP2 = 12
+
+READ_SIZE = 1024 * 1024
+
+
+class ZipStreamError(Exception):
+    pass
+
+
+class _Reader:
+    def __init__(self, next_chunk: Callable[[], bytes]):
+        self.next_chunk = next_chunk
+        self.buffer = b''
+
+    def read(self, size: int) -> bytes:
+        """Up to `size` bytes, b'' at the end of the stream"""
+        if not self.buffer:
+            self.buffer = self.next_chunk()
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def read_exactly(self, size: int) -> bytes:
+        data = b''
+        while len(data) < size:
+            chunk = self.read(size - len(data))
+            if not chunk:
+                raise ZipStreamError('Archive is truncated')
+            data += chunk
+        return data
+
+    def unread(self, data: bytes):
+        self.buffer = data + self.buffer
+
+
+class _Stored:
+    eof = False
+    unused_data = b''
+
+    def decompress(self, data: bytes) -> bytes:
+        return data
+
+    def flush(self) -> bytes:
+        return b''
+
+
+def _decompressor(method: int):
+    if method == METHOD_STORED:
+        return _Stored()
+    if method == METHOD_DEFLATED:
+        return zlib.decompressobj(-zlib.MAX_WBITS)
+    if method == METHOD_BZIP2:
+        return bz2.BZ2Decompressor()
+    raise ZipStreamError(f'Unsupported compression method {method}')
+
+
+def _sanitized_path(destination: pathlib.Path, name: str) -> pathlib.Path | None:
+    # same as zipfile.ZipFile._extract_member: no drives, absolute paths, "." or ".." components
+    name = os.path.splitdrive(name.replace('\\', '/'))[1]
+    parts = [part for part in name.split('/') if part not in ('', os.path.curdir, os.path.pardir)]
+    return destination.joinpath(*parts) if parts else None
+
+
+def _zip64_field(extra: bytes) -> bytes | None:
+    while len(extra) >= EXTRA_FIELD_HEADER.size:
+        field_id, field_size = EXTRA_FIELD_HEADER.unpack_from(extra)
+        field, extra = extra[EXTRA_FIELD_HEADER.size:][:field_size], extra[EXTRA_FIELD_HEADER.size + field_size:]
+        if field_id == ZIP64_EXTRA_FIELD_ID:
+            return field
+    return None
+
+
+def _extract_entry(reader: _Reader, destination: pathlib.Path):
+    _, flags, method, _, _, crc, compressed_size, size, name_length, extra_length = LOCAL_HEADER.unpack(
+        reader.read_exactly(LOCAL_HEADER.size))
+    name = reader.read_exactly(name_length).decode('utf-8' if flags & FLAG_UTF8 else 'cp437')
+    extra = reader.read_exactly(extra_length)
+    if flags & FLAG_ENCRYPTED:
+        raise ZipStreamError(f'{name} is encrypted')
+    zip64_field = _zip64_field(extra)
+    if zip64_field is not None:
+        # only the sizes that don't fit the local header are in the field, size first
+        if size == ZIP64_LIMIT:
+            (size,), zip64_field = struct.unpack_from('<Q', zip64_field), zip64_field[8:]
+        if compressed_size == ZIP64_LIMIT:
+            (compressed_size,) = struct.unpack_from('<Q', zip64_field)
+    sizes_follow = bool(flags & FLAG_DATA_DESCRIPTOR)
+    if sizes_follow and method == METHOD_STORED:
+        raise ZipStreamError(f'{name} is stored without its size')
+
+    path = _sanitized_path(destination, name)
+    if path is not None and name.endswith('/'):
+        path.mkdir(parents=True, exist_ok=True)
+        path = None
+    elif path is not None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+    decompressor = _decompressor(method)
+    actual_crc = 0
+    actual_size = 0
+    remaining = compressed_size
+    with open(path, 'wb') if path is not None else open(os.devnull, 'wb') as f:
+        while sizes_follow or remaining:
+            data = reader.read(READ_SIZE if sizes_follow else min(remaining, READ_SIZE))
+            if not data:
+                raise ZipStreamError('Archive is truncated')
+            remaining -= len(data)
+            output = decompressor.decompress(data)
+            if sizes_follow and decompressor.eof:
+                reader.unread(decompressor.unused_data)
+                sizes_follow = False
+                remaining = 0
+            f.write(output)
+            actual_crc = zlib.crc32(output, actual_crc)
+            actual_size += len(output)
+        output = decompressor.flush() if method == METHOD_DEFLATED else b''
+        f.write(output)
+        actual_crc = zlib.crc32(output, actual_crc)
+        actual_size += len(output)
+
+    if flags & FLAG_DATA_DESCRIPTOR:
+        descriptor = reader.read_exactly(4)
+        if descriptor == DATA_DESCRIPTOR_SIGNATURE:
+            descriptor = reader.read_exactly(4)
+        crc = struct.unpack('<L', descriptor)[0]
+        size_format = '<2Q' if zip64_field is not None else '<2L'
+        _, size = struct.unpack(size_format, reader.read_exactly(struct.calcsize(size_format)))
+    if actual_crc != crc or actual_size != size:
+        raise ZipStreamError(f'{name} is corrupted')
+
+
+def extract_zip_stream(next_chunk: Callable[[], bytes], destination: pathlib.Path):
+    """
+    Extract the zip archive read by `next_chunk` calls (b'' at its end) to `destination`, raise ZipStreamError.
+    Stops at the central directory, the rest of the archive is left unread.
+    """
+    reader = _Reader(next_chunk)
+    while True:
+        signature = reader.read_exactly(4)
+        if signature in (CENTRAL_DIRECTORY_SIGNATURE, END_OF_CENTRAL_DIRECTORY_SIGNATURE):
+            return
+        if signature != LOCAL_HEADER_SIGNATURE:
+            raise ZipStreamError('Not a zip archive')
+        _extract_entry(reader, destination)
@@ -251,6 +251,29 @@ MINER_ADDRESS = env.str('MINER_ADDRESS')
 EXECUTOR_TOKEN = env.str('EXECUTOR_TOKEN')
 VOLUME_MAX_SIZE_BYTES = env.int('VOLUME_MAX_SIZE_BYTES')
 OUTPUT_ZIP_UPLOAD_MAX_SIZE_BYTES = env.int('OUTPUT_ZIP_UPLOAD_MAX_SIZE_BYTES')
+# zip_url volumes larger than a range are downloaded in concurrent ranges if the server supports it, 0 disables this
+VOLUME_DOWNLOAD_RANGE_SIZE_BYTES = env.int('VOLUME_DOWNLOAD_RANGE_SIZE_BYTES', default=64 * 1024 ** 2)
+VOLUME_DOWNLOAD_CONNECTIONS = env.int('VOLUME_DOWNLOAD_CONNECTIONS', default=8)
+# zips of a zip_urls volume downloaded at the same time, VOLUME_MAX_SIZE_BYTES applies to all of them together
+VOLUME_SHARD_DOWNLOADS = env.int('VOLUME_SHARD_DOWNLOADS', default=4)
+# unpacked content_addressed volumes, and zip_url ones served with an ETag, shared by the executors of a host
+VOLUME_CACHE_DIR = env.str('VOLUME_CACHE_DIR', default='/tmp/compute_horde_volume_cache')
+VOLUME_CACHE_MAX_SIZE_BYTES = env.int('VOLUME_CACHE_MAX_SIZE_BYTES', default=10 * 1024 ** 3)
+# docker images of jobs, shared by the executors of a host: present images are not pulled again within the
+# freshness period (images pinned by digest never are), after it only if the registry has another digest for the tag.
+# Least recently used ones are removed above the max size
+IMAGE_CACHE_DIR = env.str('IMAGE_CACHE_DIR', default='/tmp/compute_horde_image_cache')
+IMAGE_CACHE_MAX_SIZE_BYTES = env.int('IMAGE_CACHE_MAX_SIZE_BYTES', default=100 * 1024 ** 3)
+IMAGE_CACHE_FRESHNESS_SECONDS = env.int('IMAGE_CACHE_FRESHNESS_SECONDS', default=60 * 60)
+# safe results of the CVE-2022-0492 check, shared by the executors of a host in a directory only their user can
+# write, a TTL of 0 disables this
+CVE_CHECK_CACHE_PATH = env.str('CVE_CHECK_CACHE_PATH', default='/tmp/compute_horde_cve_check/result.json')
+CVE_CHECK_CACHE_TTL_SECONDS = env.int('CVE_CHECK_CACHE_TTL_SECONDS', default=24 * 60 * 60)
+# a persistent executor waits for the next job after each one, and exits if none comes in the idle timeout
+PERSISTENT_EXECUTOR = env.bool('PERSISTENT_EXECUTOR', default=False)
+EXECUTOR_IDLE_TIMEOUT_SECONDS = env.int('EXECUTOR_IDLE_TIMEOUT_SECONDS', default=600)
+# minted by the miner for this executor, which waits for its next jobs under it
+EXECUTOR_IDLE_TOKEN = env.str('EXECUTOR_IDLE_TOKEN', default='')
 
 # Sentry
 if SENTRY_DSN := env('SENTRY_DSN', default=''):
@@ -12,6 +12,7 @@ django.setup(
 # to import consumers which import models
 
 from .miner.miner_consumer.executor_interface import MinerExecutorConsumer  # noqa
+from .miner.miner_consumer.idle_executor_interface import MinerIdleExecutorConsumer  # noqa
 from .miner.miner_consumer.validator_interface import MinerValidatorConsumer  # noqa
 
 application = ProtocolTypeRouter({
@@ -21,6 +22,7 @@ application = ProtocolTypeRouter({
     'websocket': URLRouter([
         path('v0/validator_interface/<str:validator_key>', MinerValidatorConsumer.as_asgi()),
         path('v0/executor_interface/<str:executor_token>', MinerExecutorConsumer.as_asgi()),
+        path('v0/executor_interface/idle/<str:executor_token>', MinerIdleExecutorConsumer.as_asgi()),
     ]),
 })
 
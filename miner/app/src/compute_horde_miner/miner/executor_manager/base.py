@@ -1,5 +1,9 @@
 import abc
 
+from django.conf import settings
+
+from compute_horde_miner.miner.models import IdleExecutor
+
 
 class ExecutorUnavailable(Exception):
     pass
@@ -10,3 +14,20 @@ class BaseExecutorManager(metaclass=abc.ABCMeta):
     @abc.abstractmethod
     async def reserve_executor(self, token):
         """Start spinning up an executor with `token` or raise ExecutorUnavailable if at capacity"""
+
+    async def idle_executor_token(self) -> str:
+        """Token the executor about to be spun up waits for its next jobs under, empty if it exits after its job"""
+        if not settings.PERSISTENT_EXECUTORS:
+            return ''
+        return await IdleExecutor.mint()
+
+    async def reserve_executors(self, tokens: list[str]) -> list[str]:
+        """Start spinning up executors for as many of `tokens` as possible, return the tokens that got one"""
+        reserved = []
+        for token in tokens:
+            try:
+                await self.reserve_executor(token)
+            except ExecutorUnavailable:
+                continue
+            reserved.append(token)
+        return reserved
@@ -18,6 +18,9 @@ class DevExecutorManager(BaseExecutorManager):
             env={
                 'MINER_ADDRESS': f'ws://{settings.ADDRESS_FOR_EXECUTORS}:{settings.PORT_FOR_EXECUTORS}',
                 'EXECUTOR_TOKEN': token,
+                'PERSISTENT_EXECUTOR': str(int(settings.PERSISTENT_EXECUTORS)),
+                'EXECUTOR_IDLE_TIMEOUT_SECONDS': str(settings.EXECUTOR_IDLE_TIMEOUT_SECONDS),
+                'EXECUTOR_IDLE_TOKEN': await self.idle_executor_token(),
                 'PATH': os.environ['PATH'],
             },
             cwd=executor_dir,
@@ -1,7 +1,8 @@
-import asyncio
 import logging
+import pathlib
 import subprocess
 
+from compute_horde.image_cache import ImageCache, ImagePullFailed
 from django.conf import settings
 
 from compute_horde_miner.miner.executor_manager.base import BaseExecutorManager, ExecutorUnavailable
@@ -13,31 +14,56 @@ logger = logging.getLogger(__name__)
 
 
 class DockerExecutorManager(BaseExecutorManager):
+    def __init__(self):
+        self.image_cache = ImageCache(
+            pathlib.Path(settings.IMAGE_CACHE_DIR),
+            freshness_seconds=settings.IMAGE_CACHE_FRESHNESS_SECONDS,
+        )
+
     async def reserve_executor(self, token):
+        await self.pull_executor_image()
+        self.run_executor(self.executor_address(), token, await self.idle_executor_token())
+
+    async def reserve_executors(self, tokens: list[str]) -> list[str]:
+        if not tokens:
+            return []
+        # one pull for the whole batch
+        try:
+            await self.pull_executor_image()
+        except ExecutorUnavailable:
+            return []
+        address = self.executor_address()
+        for token in tokens:
+            self.run_executor(address, token, await self.idle_executor_token())
+        return tokens
+
+    def executor_address(self) -> str:
         if settings.ADDRESS_FOR_EXECUTORS:
-            address = settings.ADDRESS_FOR_EXECUTORS
-        else:
-            address = subprocess.check_output([
-                'docker',
-                'inspect',
-                '-f',
-                '{{range .NetworkSettings.Networks}}{{.IPAddress}}{{end}}',
-                'root_app_1'
-            ]).decode().strip()
-        process = await asyncio.create_subprocess_exec('docker', 'pull', EXECUTOR_IMAGE)
+            return settings.ADDRESS_FOR_EXECUTORS
+        return subprocess.check_output([
+            'docker',
+            'inspect',
+            '-f',
+            '{{range .NetworkSettings.Networks}}{{.IPAddress}}{{end}}',
+            'root_app_1'
+        ]).decode().strip()
+
+    async def pull_executor_image(self):
+        # not pulled again for every job, only when the image is missing or may have changed
         try:
-            await asyncio.wait_for(process.communicate(), timeout=PULLING_TIMEOUT)
-            if process.returncode:
-                logger.error(f'Pulling executor container failed with returncode={process.returncode}')
-                raise ExecutorUnavailable('Failed to pull executor image')
-        except TimeoutError:
-            process.kill()
-            logger.error('Pulling executor container timed out, pulling it from shell might provide more details')
+            await self.image_cache.ensure(EXECUTOR_IMAGE, evictable=False, timeout=PULLING_TIMEOUT)
+        except ImagePullFailed as exc:
+            logger.error(f'Pulling executor container failed: {exc.description}')
             raise ExecutorUnavailable('Failed to pull executor image')
+
+    def run_executor(self, address: str, token: str, idle_token: str):
         subprocess.Popen([  # noqa: S607
             "docker", "run", "--rm",
             "-e", f"MINER_ADDRESS=ws://{address}:{settings.PORT_FOR_EXECUTORS}",
             "-e", f"EXECUTOR_TOKEN={token}",
+            "-e", f"PERSISTENT_EXECUTOR={int(settings.PERSISTENT_EXECUTORS)}",
+            "-e", f"EXECUTOR_IDLE_TIMEOUT_SECONDS={settings.EXECUTOR_IDLE_TIMEOUT_SECONDS}",
+            "-e", f"EXECUTOR_IDLE_TOKEN={idle_token}",
             # the executor must be able to spawn images on host
             "-v", "/var/run/docker.sock:/var/run/docker.sock",
             "-v", "/tmp:/tmp",
@@ -0,0 +1,27 @@
+# Generated by Django 4.2.9 on 2026-10-17 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("miner", "0003_validator_active"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="acceptedjob",
+            name="output_streamed",
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name="acceptedjob",
+            name="stdout_sha256",
+            field=models.CharField(max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name="acceptedjob",
+            name="stderr_sha256",
+            field=models.CharField(max_length=64, null=True),
+        ),
+    ]
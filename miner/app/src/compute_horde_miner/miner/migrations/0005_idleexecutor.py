@@ -0,0 +1,20 @@
+# Generated by Django 4.2.9 on 2026-10-17 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("miner", "0004_acceptedjob_output_streamed_and_more"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="IdleExecutor",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("executor_token", models.CharField(max_length=73, unique=True)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 4.2.9 on 2026-10-17 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("miner", "0005_idleexecutor"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="idleexecutor",
+            name="idle_since",
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name="idleexecutor",
+            name="next_job_executor_token",
+            field=models.CharField(max_length=73, null=True),
+        ),
+        migrations.AddField(
+            model_name="idleexecutor",
+            name="updated_at",
+            field=models.DateTimeField(auto_now=True),
+        ),
+    ]
@@ -1,12 +1,63 @@
 import abc
+import asyncio
 import functools
 import logging
+import time
 
 from channels.generic.websocket import AsyncWebsocketConsumer
+from compute_horde import transport
 from compute_horde.base_requests import BaseRequest, ValidationError
 
 logger = logging.getLogger(__name__)
 
+SESSION_EXPIRY_SECONDS = 600
+SESSION_SWEEP_INTERVAL_SECONDS = 60
+
+
+class SessionStore:
+    """
+    Sessions of this process, see `transport.Feature.sessions`. A session can only be resumed on the same path and
+    is forgotten `SESSION_EXPIRY_SECONDS` after its last connection was lost.
+    """
+
+    def __init__(self):
+        # session id -> (path, session, consumer currently sending the session's frames)
+        self.sessions: dict[str, tuple[str, transport.Session, BaseConsumer]] = {}
+        self.swept_at = time.time()
+
+    def expire(self):
+        self.swept_at = time.time()
+        threshold = self.swept_at - SESSION_EXPIRY_SECONDS
+        for session_id, (_, session, _) in list(self.sessions.items()):
+            if session.disconnected_at is not None and session.disconnected_at < threshold:
+                del self.sessions[session_id]
+
+    def sweep(self):
+        """Expire sessions every now and then, not only when one is resumed, abandoned ones pin their frames"""
+        if time.time() - self.swept_at >= SESSION_SWEEP_INTERVAL_SECONDS:
+            self.expire()
+
+    def resume(self, session_id: str | None, path: str, consumer: 'BaseConsumer') -> transport.Session | None:
+        self.expire()
+        if session_id is None or (entry := self.sessions.get(session_id)) is None or entry[0] != path:
+            return None
+        session = entry[1]
+        self.sessions[session_id] = (path, session, consumer)
+        return session
+
+    def create(self, path: str, consumer: 'BaseConsumer') -> transport.Session:
+        self.sweep()
+        session = transport.Session()
+        self.sessions[session.session_id] = (path, session, consumer)
+        return session
+
+    def owner(self, session: transport.Session) -> 'BaseConsumer | None':
+        entry = self.sessions.get(session.session_id)
+        return entry[2] if entry is not None else None
+
+
+sessions = SessionStore()
+
 
 def log_errors_explicitly(f):
     @functools.wraps(f)
@@ -20,6 +71,18 @@ def log_errors_explicitly(f):
 
 
 class BaseConsumer(AsyncWebsocketConsumer, abc.ABC):
+    def __init__(self, *a, **kw):
+        super().__init__(*a, **kw)
+        self.encoding = transport.Encoding.json
+        self.features: set[transport.Feature] = set()
+        self.compression: transport.Compression | None = None
+        self.received_blobs = transport.ReceivedBlobs()
+        self.session: transport.Session | None = None
+        # the peer's frames are counted after its first ack on this connection
+        self.peer_in_session = False
+        self.state_synced = False
+        self.ack_timer: asyncio.TimerHandle | None = None
+
     @abc.abstractmethod
     def accepted_request_type(self) -> type[BaseRequest]:
         pass
@@ -39,15 +102,119 @@ class BaseConsumer(AsyncWebsocketConsumer, abc.ABC):
     async def connect(self):
         await self.accept()
 
+    async def sync_state(self, since: float | None):
+        """
+        Send the peer what it needs to know about the state on this side: everything if `since` is None, otherwise
+        what changed since then (timestamp), the rest has been sent in the resumed session
+        """
+
+    async def send_model(self, model: BaseRequest):
+        await self._send_frame(transport.encode(model, self.encoding, self.compression))
+
+    async def send_blob(self, data: bytes) -> transport.BlobReference:
+        reference, frame = transport.encode_blob(data)
+        await self._send_frame(frame)
+        return reference
+
+    async def _send_frame(self, frame: str | bytes, sequenced: bool = True):
+        if sequenced and self.session is not None:
+            if sessions.owner(self.session) is not self:
+                # the session was resumed on another connection, which gets the same events
+                logger.debug('Dropping a frame of a session resumed elsewhere')
+                return
+            self.session.record_sent(frame)
+        if isinstance(frame, bytes):
+            await self.send(bytes_data=frame)
+        else:
+            await self.send(text_data=frame)
+
+    async def _send_ack(self):
+        if self.ack_timer is not None:
+            self.ack_timer.cancel()
+            self.ack_timer = None
+        if self.session is not None and self.session.received != self.session.acknowledged_received:
+            await self._send_frame(transport.encode(self.session.ack(), self.encoding, self.compression),
+                                   sequenced=False)
+
+    async def _session_received(self):
+        if self.session is None or not self.peer_in_session:
+            return
+        if self.session.record_received():
+            await self._send_ack()
+        elif self.ack_timer is None:
+            self.ack_timer = asyncio.get_running_loop().call_later(
+                transport.SESSION_ACK_DELAY_SECONDS, lambda: asyncio.ensure_future(self._send_ack()))
+
+    def select_features(self, offer: transport.V0TransportOfferRequest) -> list[transport.Feature]:
+        return offer.select_features()
+
+    async def handle_transport_message(self, msg: transport.BaseTransportRequest):
+        if isinstance(msg, transport.V0TransportOfferRequest):
+            encoding = msg.select_encoding()
+            features = self.select_features(msg)
+            compression = msg.select_compression()
+            session = None
+            resumed = False
+            replay = []
+            since = None
+            if transport.Feature.sessions in features:
+                resumed_at = time.time()
+                session = sessions.resume(msg.session_id, self.scope['path'], self)
+                if session is not None:
+                    replay = session.frames_to_replay(msg.received or 0)
+                    if replay is None:
+                        logger.info(f'Session {session.session_id} can not be resumed, frames are missing')
+                        session = None
+                    else:
+                        resumed = True
+                        since = session.disconnected_at or resumed_at
+                        session.disconnected_at = None
+                if session is None:
+                    session = sessions.create(self.scope['path'], self)
+            # the selection itself is always uncompressed json, that's what the peer is waiting for
+            await self._send_frame(transport.V0TransportSelectedRequest(
+                encoding=encoding,
+                features=features,
+                compression=compression,
+                session_id=session.session_id if session is not None else None,
+                resumed=resumed,
+                received=session.received if session is not None else None,
+            ).json(), sequenced=False)
+            self.encoding = encoding
+            self.features = set(features)
+            self.compression = compression
+            if session is not None:
+                for frame in replay:
+                    await self._send_frame(frame, sequenced=False)
+                self.session = session
+            if not self.state_synced:
+                self.state_synced = True
+                await self.sync_state(since)
+        elif isinstance(msg, transport.V0TransportAckRequest):
+            self.peer_in_session = True
+            if self.session is not None:
+                self.session.peer_received(msg.received)
+
     @log_errors_explicitly
     async def receive(self, text_data=None, bytes_data=None):
         try:
-            msg = self.accepted_request_type().parse(text_data)
+            if blob := transport.decode_blob(bytes_data):
+                await self._session_received()
+                self.received_blobs.add(*blob)
+                return
+            decoded = transport.decode(text_data if text_data is not None else bytes_data)
+            if transport_msg := transport.parse_transport_request(decoded):
+                await self.handle_transport_message(transport_msg)
+                return
+            await self._session_received()
+            if not self.state_synced:
+                # a peer that doesn't negotiate, or sent this before its offer
+                self.state_synced = True
+                await self.sync_state(None)
+            msg = self.accepted_request_type().parse_decoded(decoded)
         except ValidationError as ex:
             logger.error(f'Malformed message: {str(ex)}')
-            await self.send(
-                self.outgoing_generic_error_class()(details=f'Malformed message: {str(ex)}').json()
-            )
+            await self.send_model(self.outgoing_generic_error_class()(details=f'Malformed message: {str(ex)}'))
             return
 
         if isinstance(msg, self.incoming_generic_error_class()):
@@ -58,3 +225,11 @@ class BaseConsumer(AsyncWebsocketConsumer, abc.ABC):
                 return
 
         await self.handle(msg)
+
+    async def websocket_disconnect(self, message):
+        if self.ack_timer is not None:
+            self.ack_timer.cancel()
+        if self.session is not None and sessions.owner(self.session) is self:
+            self.session.disconnected_at = time.time()
+        sessions.sweep()
+        await super().websocket_disconnect(message)
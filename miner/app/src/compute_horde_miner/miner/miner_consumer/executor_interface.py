@@ -1,15 +1,19 @@
+import base64
 import logging
+import time
 
+from compute_horde import transport
 from compute_horde.em_protocol import executor_requests, miner_requests
 from compute_horde.em_protocol.executor_requests import BaseExecutorRequest
 from compute_horde.mv_protocol import validator_requests
+from compute_horde.timeline import JobPhase, Timeline
 
 from compute_horde_miner.miner.miner_consumer.base_compute_horde_consumer import (
     BaseConsumer,
     log_errors_explicitly,
 )
 from compute_horde_miner.miner.miner_consumer.layer_utils import ExecutorInterfaceMixin, JobRequest
-from compute_horde_miner.miner.models import AcceptedJob
+from compute_horde_miner.miner.models import AcceptedJob, IdleExecutor
 
 logger = logging.getLogger(__name__)
 
@@ -19,6 +23,11 @@ class MinerExecutorConsumer(BaseConsumer, ExecutorInterfaceMixin):
         super().__init__(*a, **kw)
         self.executor_token = ''
         self.job: AcceptedJob | None = None
+        self.timeline = Timeline()
+        # streamed output, stored with the job to be resent if the validator reconnects before getting the result
+        self.output_chunks: dict[executor_requests.OutputStream, list[str]] = {
+            stream: [] for stream in executor_requests.OutputStream
+        }
 
     def accepted_request_type(self):
         return BaseExecutorRequest
@@ -38,54 +47,81 @@ class MinerExecutorConsumer(BaseConsumer, ExecutorInterfaceMixin):
             # TODO maybe one day tokens will be reused, then we will have to add filtering here
             job = await AcceptedJob.objects.aget(executor_token=self.executor_token)
         except AcceptedJob.DoesNotExist:
-            await self.send(miner_requests.GenericError(
-                details=f'No job waiting for token {self.executor_token}').json())
+            await self.send_model(miner_requests.GenericError(
+                details=f'No job waiting for token {self.executor_token}'))
             logger.error(f'No job waiting for token {self.executor_token}')
             await self.websocket_disconnect({"code": f'No job waiting for token {self.executor_token}'})
             return
         if job.status != AcceptedJob.Status.WAITING_FOR_EXECUTOR:
             msg = f'Job with token {self.executor_token} is not waiting for an executor'
-            await self.send(miner_requests.GenericError(details=msg).json())
+            await self.send_model(miner_requests.GenericError(details=msg))
             logger.error(msg)
             await self.websocket_disconnect(
                 {"code": msg})
             return
 
         self.job = job
+        # a persistent executor the job was handed to came for it
+        await IdleExecutor.finish_handoff(self.executor_token)
+        self.timeline.add(JobPhase.executor_spawn, time.time() - job.created_at.timestamp())
         await self.group_add(self.executor_token)
         initial_job_details = validator_requests.V0InitialJobRequest(**job.initial_job_details)
-        await self.send(miner_requests.V0InitialJobRequest(
+        await self.send_model(miner_requests.V0InitialJobRequest(
             job_uuid=initial_job_details.job_uuid,
             base_docker_image_name=initial_job_details.base_docker_image_name,
             timeout_seconds=initial_job_details.timeout_seconds,
             volume_type=initial_job_details.volume_type.value,
-        ).json())
+            base_docker_image_digest=initial_job_details.base_docker_image_digest,
+        ))
+
+    def select_features(self, offer: transport.V0TransportOfferRequest) -> list[transport.Feature]:
+        features = super().select_features(offer)
+        if self.job is None or not self.job.output_streamed:
+            # the validator expects the output in the final message
+            features = [feature for feature in features if feature != transport.Feature.output_streaming]
+        # an executor runs a single job, if its connection is lost the job is lost too
+        return [feature for feature in features if feature != transport.Feature.sessions]
 
     async def handle(self, msg: BaseExecutorRequest):
         if isinstance(msg, executor_requests.V0ReadyRequest):
             self.job.status = AcceptedJob.Status.WAITING_FOR_PAYLOAD
             await self.job.asave()
-            await self.send_executor_ready(self.executor_token)
+            await self.send_executor_ready(self.executor_token, msg.cached_volumes, self._timeline(msg.timeline))
         if isinstance(msg, executor_requests.V0FailedToPrepare):
             self.job.status = AcceptedJob.Status.FAILED
             await self.job.asave()
             await self.send_executor_failed_to_prepare(self.executor_token)
+        if isinstance(msg, executor_requests.V0JobOutputChunk):
+            self.output_chunks[msg.stream].append(msg.data)
+            await self.send_executor_output_chunk(
+                job_uuid=msg.job_uuid,
+                executor_token=self.executor_token,
+                stream=msg.stream,
+                data=msg.data,
+            )
         if isinstance(msg, executor_requests.V0FinishedRequest):
             self.job.status = AcceptedJob.Status.FINISHED
-            self.job.stderr = msg.docker_process_stderr
-            self.job.stdout = msg.docker_process_stdout
+            self.job.stderr = self._output(executor_requests.OutputStream.stderr, msg.docker_process_stderr)
+            self.job.stdout = self._output(executor_requests.OutputStream.stdout, msg.docker_process_stdout)
+            self.job.stdout_sha256 = msg.docker_process_stdout_sha256
+            self.job.stderr_sha256 = msg.docker_process_stderr_sha256
 
             await self.job.asave()
             await self.send_executor_finished(
                 job_uuid=msg.job_uuid,
                 executor_token=self.executor_token,
                 stdout=msg.docker_process_stdout,
-                stderr=msg.docker_process_stderr
+                stderr=msg.docker_process_stderr,
+                stdout_sha256=msg.docker_process_stdout_sha256,
+                stderr_sha256=msg.docker_process_stderr_sha256,
+                timeline=self._timeline(msg.timeline),
             )
         if isinstance(msg, executor_requests.V0FailedRequest):
             self.job.status = AcceptedJob.Status.FAILED
-            self.job.stderr = msg.docker_process_stderr
-            self.job.stdout = msg.docker_process_stdout
+            self.job.stderr = self._output(executor_requests.OutputStream.stderr, msg.docker_process_stderr)
+            self.job.stdout = self._output(executor_requests.OutputStream.stdout, msg.docker_process_stdout)
+            self.job.stdout_sha256 = msg.docker_process_stdout_sha256
+            self.job.stderr_sha256 = msg.docker_process_stderr_sha256
             self.job.exit_status = msg.docker_process_exit_status
 
             await self.job.asave()
@@ -95,17 +131,40 @@ class MinerExecutorConsumer(BaseConsumer, ExecutorInterfaceMixin):
                 stdout=msg.docker_process_stdout,
                 stderr=msg.docker_process_stderr,
                 exit_status=msg.docker_process_exit_status,
+                stdout_sha256=msg.docker_process_stdout_sha256,
+                stderr_sha256=msg.docker_process_stderr_sha256,
+                timeline=self._timeline(msg.timeline),
             )
 
+    def _output(self, stream: executor_requests.OutputStream, output: str) -> str:
+        """The whole output of the stream, `output` of the final message is empty if it was streamed"""
+        return output or ''.join(self.output_chunks[stream])
+
+    def _timeline(self, executor_timeline: dict[str, float] | None) -> dict[str, float]:
+        return {**(executor_timeline or {}), **self.timeline.durations}
+
     async def _miner_job_request(self, msg: JobRequest):
-        await self.send(miner_requests.V0JobRequest(
+        volume = msg.volume
+        if msg.volume_blob is not None:
+            if transport.Feature.blobs in self.features:
+                volume = msg.volume.copy(update={
+                    'contents': '',
+                    'blob': await self.send_blob(msg.volume_blob),
+                })
+            else:
+                # executors that can't receive blobs get the volume inline, as it used to be sent by validators
+                volume = msg.volume.copy(update={
+                    'contents': base64.b64encode(msg.volume_blob).decode(),
+                })
+        await self.send_model(miner_requests.V0JobRequest(
             job_uuid=msg.job_uuid,
             docker_image_name=msg.docker_image_name,
             docker_run_options_preset=msg.docker_run_options_preset,
             docker_run_cmd=msg.docker_run_cmd,
-            volume=msg.volume,
+            volume=volume,
             output_upload=msg.output_upload,
-        ).json())
+            docker_image_digest=msg.docker_image_digest,
+        ))
 
     async def disconnect(self, close_code):
         logger.info(f'Executor {self.executor_token} disconnected')
@@ -0,0 +1,66 @@
+import datetime
+import logging
+
+from compute_horde import transport
+from compute_horde.em_protocol import executor_requests, miner_requests
+from compute_horde.em_protocol.executor_requests import BaseExecutorRequest
+
+from compute_horde_miner.miner.miner_consumer.base_compute_horde_consumer import (
+    BaseConsumer,
+    log_errors_explicitly,
+)
+from compute_horde_miner.miner.miner_consumer.layer_utils import IdleExecutorInterfaceMixin, NextJob
+from compute_horde_miner.miner.models import IdleExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class MinerIdleExecutorConsumer(BaseConsumer, IdleExecutorInterfaceMixin):
+    """A persistent executor waiting for its next job, see `IdleExecutor`"""
+
+    def __init__(self, *a, **kw):
+        super().__init__(*a, **kw)
+        self.executor_token = ''
+        self.idle_since: datetime.datetime | None = None
+
+    def accepted_request_type(self):
+        return BaseExecutorRequest
+
+    def incoming_generic_error_class(self):
+        return executor_requests.GenericError
+
+    def outgoing_generic_error_class(self):
+        return miner_requests.GenericError
+
+    @log_errors_explicitly
+    async def connect(self):
+        self.executor_token = self.scope['url_route']['kwargs']['executor_token']
+        # registered before accepting, so jobs can be assigned as soon as the executor is connected
+        await self.group_add(self.executor_token)
+        self.idle_since = await IdleExecutor.register(self.executor_token)
+        await super().connect()
+        if self.idle_since is None:
+            # a token not minted for an executor of this miner, or there's enough idle ones
+            msg = f'Executor {self.executor_token} can not wait for a job'
+            await self.send_model(miner_requests.GenericError(details=msg))
+            logger.info(msg)
+            await self.close(1000)
+            return
+        logger.debug(f'Executor {self.executor_token} is waiting for a job')
+
+    def select_features(self, offer: transport.V0TransportOfferRequest) -> list[transport.Feature]:
+        # the executor reconnects under the job's token anyway
+        return [feature for feature in super().select_features(offer) if feature != transport.Feature.sessions]
+
+    async def handle(self, msg: BaseExecutorRequest):
+        logger.warning(f'Idle executor {self.executor_token} sent unexpected {msg.message_type.value}')
+
+    async def _miner_next_job(self, msg: NextJob):
+        logger.debug(f'Idle executor {self.executor_token} gets the job of {msg.executor_token}')
+        await self.send_model(miner_requests.V0NextJobRequest(executor_token=msg.executor_token))
+
+    async def disconnect(self, close_code):
+        await self.group_discard(self.executor_token)
+        if self.idle_since is not None:
+            await IdleExecutor.unregister(self.executor_token, self.idle_since)
+        logger.debug(f'Idle executor {self.executor_token} disconnected')
@@ -1,8 +1,10 @@
 import abc
 import logging
+import time
 
 import pydantic
 from channels.generic.websocket import AsyncWebsocketConsumer
+from compute_horde.em_protocol.executor_requests import OutputStream
 from compute_horde.em_protocol.miner_requests import OutputUpload, Volume
 from compute_horde.mv_protocol import validator_requests
 
@@ -15,6 +17,10 @@ logger = logging.getLogger(__name__)
 
 class ExecutorReady(pydantic.BaseModel):
     executor_token: str
+    cached_volumes: list[str] | None = None
+    # phases of the job so far (see compute_horde.timeline) and when this was sent, to measure the relay
+    timeline: dict[str, float] | None = None
+    sent_at: float | None = None
 
 
 class ExecutorFailedToPrepare(pydantic.BaseModel):
@@ -28,12 +34,26 @@ class JobRequest(pydantic.BaseModel):
     docker_run_cmd: list[str]
     volume: Volume
     output_upload: OutputUpload | None
+    # inline volume received in a blob frame, passed on as raw bytes
+    volume_blob: bytes | None = None
+    docker_image_digest: str | None = None
+
+
+class ExecutorOutputChunk(pydantic.BaseModel):
+    job_uuid: str
+    stream: OutputStream
+    data: str
 
 
 class ExecutorFinished(pydantic.BaseModel):
     job_uuid: str
     docker_process_stdout: str
     docker_process_stderr: str
+    docker_process_stdout_sha256: str | None = None
+    docker_process_stderr_sha256: str | None = None
+    # phases of the job so far (see compute_horde.timeline) and when this was sent, to measure the relay
+    timeline: dict[str, float] | None = None
+    sent_at: float | None = None
 
 
 class ExecutorFailed(pydantic.BaseModel):
@@ -41,6 +61,16 @@ class ExecutorFailed(pydantic.BaseModel):
     docker_process_exit_status: int
     docker_process_stdout: str
     docker_process_stderr: str
+    docker_process_stdout_sha256: str | None = None
+    docker_process_stderr_sha256: str | None = None
+    # phases of the job so far (see compute_horde.timeline) and when this was sent, to measure the relay
+    timeline: dict[str, float] | None = None
+    sent_at: float | None = None
+
+
+class NextJob(pydantic.BaseModel):
+    # token of the job's executor, which the idle executor becomes
+    executor_token: str
 
 
 class BaseMixin(AsyncWebsocketConsumer, abc.ABC):
@@ -91,6 +121,16 @@ class ValidatorInterfaceMixin(BaseMixin, abc.ABC):
     async def _executor_failed_to_prepare(self, msg: ExecutorFailedToPrepare):
         ...
 
+    @log_errors_explicitly
+    async def executor_output_chunk(self, event: dict):
+        payload = self.validate_event('executor_output_chunk', ExecutorOutputChunk, event)
+        if payload:
+            await self._executor_output_chunk(payload)
+
+    @abc.abstractmethod
+    async def _executor_output_chunk(self, msg: ExecutorOutputChunk):
+        ...
+
     @log_errors_explicitly
     async def executor_finished(self, event: dict):
         payload = self.validate_event('executor_finished', ExecutorFinished, event)
@@ -111,7 +151,8 @@ class ValidatorInterfaceMixin(BaseMixin, abc.ABC):
     async def _executor_failed(self, msg: ExecutorFailed):
         ...
 
-    async def send_job_request(self, executor_token, job_request: validator_requests.V0JobRequest):
+    async def send_job_request(self, executor_token, job_request: validator_requests.V0JobRequest,
+                               volume_blob: bytes | None = None):
         await self.channel_layer.group_send(ExecutorInterfaceMixin.group_name(executor_token), {
             'type': 'miner.job_request',
             **JobRequest(
@@ -122,11 +163,25 @@ class ValidatorInterfaceMixin(BaseMixin, abc.ABC):
                 volume={
                     "volume_type": job_request.volume.volume_type.value,
                     "contents": job_request.volume.contents,
+                    "sha256": job_request.volume.sha256,
+                    "size": job_request.volume.size,
+                    "fallback_volume_type": (
+                        job_request.volume.fallback_volume_type.value
+                        if job_request.volume.fallback_volume_type else None
+                    ),
                 },
                 output_upload=job_request.output_upload,
+                volume_blob=volume_blob,
+                docker_image_digest=job_request.docker_image_digest,
             ).dict()
         })
 
+    async def send_next_job(self, idle_executor_token: str, executor_token: str):
+        await self.channel_layer.group_send(IdleExecutorInterfaceMixin.group_name(idle_executor_token), {
+            'type': 'miner.next_job',
+            **NextJob(executor_token=executor_token).dict(),
+        })
+
 
 class ExecutorInterfaceMixin(BaseMixin):
 
@@ -134,13 +189,19 @@ class ExecutorInterfaceMixin(BaseMixin):
     def group_name(cls, executor_token: str):
         return f'executor_interface_{executor_token}'
 
-    async def send_executor_ready(self, executor_token: str):
+    async def send_executor_ready(self, executor_token: str, cached_volumes: list[str] | None = None,
+                                  timeline: dict[str, float] | None = None):
         group_name = ValidatorInterfaceMixin.group_name(executor_token)
         await self.channel_layer.group_send(
             group_name,
             {
                 'type': 'executor.ready',
-                **ExecutorReady(executor_token=executor_token).dict(),
+                **ExecutorReady(
+                    executor_token=executor_token,
+                    cached_volumes=cached_volumes,
+                    timeline=timeline,
+                    sent_at=time.time(),
+                ).dict(),
             }
         )
 
@@ -154,7 +215,23 @@ class ExecutorInterfaceMixin(BaseMixin):
             }
         )
 
-    async def send_executor_finished(self, job_uuid: str, executor_token: str, stdout: str, stderr: str):
+    async def send_executor_output_chunk(self, job_uuid: str, executor_token: str, stream: OutputStream, data: str):
+        group_name = ValidatorInterfaceMixin.group_name(executor_token)
+        await self.channel_layer.group_send(
+            group_name,
+            {
+                'type': 'executor.output_chunk',
+                **ExecutorOutputChunk(
+                    job_uuid=job_uuid,
+                    stream=stream,
+                    data=data,
+                ).dict(),
+            }
+        )
+
+    async def send_executor_finished(self, job_uuid: str, executor_token: str, stdout: str, stderr: str,
+                                     stdout_sha256: str | None = None, stderr_sha256: str | None = None,
+                                     timeline: dict[str, float] | None = None):
         group_name = ValidatorInterfaceMixin.group_name(executor_token)
         await self.channel_layer.group_send(
             group_name,
@@ -164,12 +241,17 @@ class ExecutorInterfaceMixin(BaseMixin):
                     job_uuid=job_uuid,
                     docker_process_stdout=stdout,
                     docker_process_stderr=stderr,
+                    docker_process_stdout_sha256=stdout_sha256,
+                    docker_process_stderr_sha256=stderr_sha256,
+                    timeline=timeline,
+                    sent_at=time.time(),
                 ).dict(),
             }
         )
 
     async def send_executor_failed(self, job_uuid: str, executor_token: str, stdout: str, stderr: str,
-                                   exit_status: int):
+                                   exit_status: int, stdout_sha256: str | None = None,
+                                   stderr_sha256: str | None = None, timeline: dict[str, float] | None = None):
         group_name = ValidatorInterfaceMixin.group_name(executor_token)
         await self.channel_layer.group_send(
             group_name,
@@ -180,6 +262,10 @@ class ExecutorInterfaceMixin(BaseMixin):
                     docker_process_stdout=stdout,
                     docker_process_stderr=stderr,
                     docker_process_exit_status=exit_status,
+                    docker_process_stdout_sha256=stdout_sha256,
+                    docker_process_stderr_sha256=stderr_sha256,
+                    timeline=timeline,
+                    sent_at=time.time(),
                 ).dict(),
             }
         )
@@ -193,3 +279,20 @@ class ExecutorInterfaceMixin(BaseMixin):
         payload = self.validate_event('miner_job_request', JobRequest, event)
         if payload:
             await self._miner_job_request(payload)
+
+
+class IdleExecutorInterfaceMixin(BaseMixin):
+
+    @classmethod
+    def group_name(cls, executor_token: str):
+        return f'idle_executor_interface_{executor_token}'
+
+    @abc.abstractmethod
+    async def _miner_next_job(self, msg: NextJob):
+        ...
+
+    @log_errors_explicitly
+    async def miner_next_job(self, event: dict):
+        payload = self.validate_event('miner_next_job', NextJob, event)
+        if payload:
+            await self._miner_next_job(payload)
@@ -1,15 +1,19 @@
+import asyncio
+import datetime
 import logging
 import time
 import uuid
 
 import bittensor
+from compute_horde import transport
+from compute_horde.base_requests import ValidationError
 from compute_horde.mv_protocol import miner_requests, validator_requests
 from compute_horde.mv_protocol.validator_requests import BaseValidatorRequest
+from compute_horde.timeline import JobPhase, Timeline
 from django.conf import settings
 from django.utils import timezone
 
 from compute_horde_miner.miner.executor_manager import current
-from compute_horde_miner.miner.executor_manager.base import ExecutorUnavailable
 from compute_horde_miner.miner.miner_consumer.base_compute_horde_consumer import (
     BaseConsumer,
     log_errors_explicitly,
@@ -18,17 +22,29 @@ from compute_horde_miner.miner.miner_consumer.layer_utils import (
     ExecutorFailed,
     ExecutorFailedToPrepare,
     ExecutorFinished,
+    ExecutorOutputChunk,
     ExecutorReady,
     ValidatorInterfaceMixin,
 )
-from compute_horde_miner.miner.models import AcceptedJob, Validator
+from compute_horde_miner.miner.models import (
+    IDLE_EXECUTOR_HANDOFF_TIMEOUT,
+    AcceptedJob,
+    IdleExecutor,
+    Validator,
+)
 
 logger = logging.getLogger(__name__)
 
 AUTH_MESSAGE_MAX_AGE = 10
 
+# readiness of jobs updated shortly before the connection was lost may not have made it into the session
+SESSION_SYNC_MARGIN = datetime.timedelta(seconds=5)
+
 DONT_CHECK = 'DONT_CHECK'
 
+# referenced until done, they outlive the consumer if the validator disconnects
+handoff_tasks: set[asyncio.Task] = set()
+
 
 class MinerValidatorConsumer(BaseConsumer, ValidatorInterfaceMixin):
     def __init__(self, *a, **kw):
@@ -59,38 +75,53 @@ class MinerValidatorConsumer(BaseConsumer, ValidatorInterfaceMixin):
             msg = f'Inactive validator: {self.validator_key}'
             fail = True
         if fail:
-            await self.send(miner_requests.GenericError(details=msg).json())
+            await self.send_model(miner_requests.GenericError(details=msg))
             logger.info(msg)
             await self.close(1000)
             return
+        # TODO using advisory locks make sure that only one consumer per validator exists
+
+    async def sync_state(self, since: float | None):
+        if self.validator is None:
+            return
+        updated_since = None
+        if since is not None:
+            updated_since = datetime.datetime.fromtimestamp(since, datetime.UTC) - SESSION_SYNC_MARGIN
 
         self.pending_jobs = await AcceptedJob.get_for_validator(self.validator)
         for job in self.pending_jobs.values():
             await self.group_add(job.executor_token)
             if job.status != AcceptedJob.Status.WAITING_FOR_PAYLOAD:
                 continue
-            await self.send(miner_requests.V0ExecutorReadyRequest(job_uuid=str(job.job_uuid)).json())
+            if updated_since is not None and job.updated_at < updated_since:
+                # reported in the resumed session
+                continue
+            await self.send_model(miner_requests.V0ExecutorReadyRequest(job_uuid=str(job.job_uuid)))
             logger.debug(f'Readiness for job {job.job_uuid} reported to validator {self.validator_key}')
 
+        # results are marked as reported when sent, so these were never sent in any session
         for job in (await AcceptedJob.get_not_reported(self.validator)):
             if job.status == AcceptedJob.Status.FINISHED:
-                await self.send(miner_requests.V0JobFinishedRequest(
+                await self.send_model(miner_requests.V0JobFinishedRequest(
                     job_uuid=str(job.job_uuid),
                     docker_process_stdout=job.stdout,
                     docker_process_stderr=job.stderr,
-                ).json())
+                    docker_process_stdout_sha256=job.stdout_sha256,
+                    docker_process_stderr_sha256=job.stderr_sha256,
+                ))
                 logger.debug(f'Job {job.job_uuid} finished reported to validator {self.validator_key}')
             else:  # job.status == AcceptedJob.Status.FAILED:
-                await self.send(miner_requests.V0JobFailedRequest(
+                await self.send_model(miner_requests.V0JobFailedRequest(
                     job_uuid=str(job.job_uuid),
                     docker_process_stdout=job.stdout,
                     docker_process_stderr=job.stderr,
                     docker_process_exit_status=job.exit_status,
-                ).json())
+                    docker_process_stdout_sha256=job.stdout_sha256,
+                    docker_process_stderr_sha256=job.stderr_sha256,
+                ))
                 logger.debug(f'Failed job {job.job_uuid} reported to validator {self.validator_key}')
             job.result_reported_to_validator = timezone.now()
             await job.asave()
-        # TODO using advisory locks make sure that only one consumer per validator exists
 
     def accepted_request_type(self):
         return BaseValidatorRequest
@@ -124,7 +155,7 @@ class MinerValidatorConsumer(BaseConsumer, ValidatorInterfaceMixin):
             if not authenticated:
                 response_msg = f'Validator {self.validator_key} not authenticated due to: {error_msg}'
                 logger.info(response_msg)
-                await self.send(miner_requests.GenericError(details=response_msg).json())
+                await self.send_model(miner_requests.GenericError(details=response_msg))
                 await self.close(1000)
                 return
         self.validator_authenticated = True
@@ -139,47 +170,115 @@ class MinerValidatorConsumer(BaseConsumer, ValidatorInterfaceMixin):
             return
         if isinstance(msg, validator_requests.V0InitialJobRequest):
             # TODO add rate limiting per validator key here
-            token = f'{msg.job_uuid}-{uuid.uuid4()}'
-            await self.group_add(token)
-            # let's create the job object before spinning up the executor, so if this process dies before getting
-            # confirmation from the executor_manager the object is there and the executor will get the job details
-            job = AcceptedJob(
-                validator=self.validator,
-                job_uuid=msg.job_uuid,
-                executor_token=token,
-                initial_job_details=msg.dict(),
-                status=AcceptedJob.Status.WAITING_FOR_EXECUTOR,
-            )
-            await job.asave()
-            self.pending_jobs[msg.job_uuid] = job
-
-            try:
-                await current.executor_manager.reserve_executor(token)
-            except ExecutorUnavailable:
-                await self.send(miner_requests.V0DeclineJobRequest(job_uuid=msg.job_uuid).json())
-                await self.group_discard(token)
-                await job.adelete()
-                self.pending_jobs.pop(msg.job_uuid)
-                return
-            await self.send(miner_requests.V0AcceptJobRequest(job_uuid=msg.job_uuid).json())
+            accepted, _ = await self._accept_jobs([msg])
+            if accepted:
+                await self.send_model(miner_requests.V0AcceptJobRequest(job_uuid=msg.job_uuid))
+            else:
+                await self.send_model(miner_requests.V0DeclineJobRequest(job_uuid=msg.job_uuid))
+
+        if isinstance(msg, validator_requests.V0InitialJobBatchRequest):
+            accepted, declined = await self._accept_jobs(msg.jobs)
+            await self.send_model(miner_requests.V0JobBatchDecisionRequest(
+                accepted_job_uuids=accepted,
+                declined_job_uuids=declined,
+            ))
 
         if isinstance(msg, validator_requests.V0JobRequest):
             job = self.pending_jobs.get(msg.job_uuid)
             if job is None:
                 logger.error(f"Received JobRequest for unknown job_uuid: {msg.job_uuid}")
-                await self.send(miner_requests.GenericError(
-                    details=f"Received JobRequest for unknown job_uuid: {msg.job_uuid}").json())
+                await self.send_model(miner_requests.GenericError(
+                    details=f"Received JobRequest for unknown job_uuid: {msg.job_uuid}"))
                 return
-            await self.send_job_request(job.executor_token, msg)
+            volume_blob = None
+            if msg.volume.blob is not None:
+                try:
+                    volume_blob = self.received_blobs.pop(msg.volume.blob)
+                except ValidationError as ex:
+                    logger.error(f"Received JobRequest with invalid volume blob: {ex.msg}")
+                    await self.send_model(miner_requests.GenericError(
+                        details=f"Received JobRequest with invalid volume blob: {ex.msg}"))
+                    return
+            await self.send_job_request(job.executor_token, msg, volume_blob)
             logger.debug(f"Passing job details to executor consumer job_uuid: {msg.job_uuid}")
             job.status = AcceptedJob.Status.RUNNING
             job.full_job_details = msg.dict()
             await job.asave()
 
+    async def _accept_jobs(self, msgs: list[validator_requests.V0InitialJobRequest]) -> tuple[list[str], list[str]]:
+        """Reserve executors for the jobs in one pass, return uuids of accepted and declined jobs"""
+        jobs = []
+        for msg in msgs:
+            token = f'{msg.job_uuid}-{uuid.uuid4()}'
+            await self.group_add(token)
+            jobs.append(AcceptedJob(
+                validator=self.validator,
+                job_uuid=msg.job_uuid,
+                executor_token=token,
+                initial_job_details=msg.dict(),
+                status=AcceptedJob.Status.WAITING_FOR_EXECUTOR,
+                output_streamed=transport.Feature.output_streaming in self.features,
+            ))
+        # let's create the job objects before spinning up the executors, so if this process dies before getting
+        # confirmation from the executor_manager the objects are there and the executors will get the job details
+        await AcceptedJob.objects.abulk_create(jobs)
+        for job in jobs:
+            self.pending_jobs[str(job.job_uuid)] = job
+
+        tokens = [job.executor_token for job in jobs]
+        # idle persistent executors get the jobs first, new executors are spun up for the rest
+        idle_tokens = await IdleExecutor.claim(tokens)
+        for token, idle_token in idle_tokens.items():
+            await self.send_next_job(idle_token, token)
+            task = asyncio.create_task(self._watch_handoff(token))
+            handoff_tasks.add(task)
+            task.add_done_callback(handoff_tasks.discard)
+        reserved = set(idle_tokens)
+        reserved.update(await current.executor_manager.reserve_executors(
+            [token for token in tokens if token not in idle_tokens]))
+        declined_jobs = [job for job in jobs if job.executor_token not in reserved]
+        if declined_jobs:
+            for job in declined_jobs:
+                await self.group_discard(job.executor_token)
+                self.pending_jobs.pop(str(job.job_uuid))
+            await AcceptedJob.objects.filter(
+                executor_token__in=[job.executor_token for job in declined_jobs],
+            ).adelete()
+        return (
+            [str(job.job_uuid) for job in jobs if job.executor_token in reserved],
+            [str(job.job_uuid) for job in declined_jobs],
+        )
+
+    async def _watch_handoff(self, executor_token: str):
+        """
+        Spin up a new executor for a job handed to an idle one which doesn't come for it, e.g. because it exited or
+        lost its connection before getting the job
+        """
+        await asyncio.sleep(IDLE_EXECUTOR_HANDOFF_TIMEOUT.total_seconds())
+        if not await IdleExecutor.finish_handoff(executor_token):
+            return
+        logger.warning(f'Idle executor did not come for the job with token {executor_token}, spinning up a new one')
+        if await current.executor_manager.reserve_executors([executor_token]):
+            return
+        failed = await AcceptedJob.objects.filter(
+            executor_token=executor_token,
+            status=AcceptedJob.Status.WAITING_FOR_EXECUTOR,
+        ).aupdate(status=AcceptedJob.Status.FAILED)
+        if failed:
+            # to whichever consumer of the validator is connected now, like executors report it
+            await self.channel_layer.group_send(self.group_name(executor_token), {
+                'type': 'executor.failed_to_prepare',
+                **ExecutorFailedToPrepare(executor_token=executor_token).dict(),
+            })
+
     async def _executor_ready(self, msg: ExecutorReady):
         job = await AcceptedJob.objects.aget(executor_token=msg.executor_token)
-        self.pending_jobs[job.job_uuid] = job
-        await self.send(miner_requests.V0ExecutorReadyRequest(job_uuid=str(job.job_uuid)).json())
+        self.pending_jobs[str(job.job_uuid)] = job
+        await self.send_model(miner_requests.V0ExecutorReadyRequest(
+            job_uuid=str(job.job_uuid),
+            cached_volumes=msg.cached_volumes,
+            timeline=self._timeline(msg.timeline, JobPhase.ready_relay, msg.sent_at),
+        ))
         logger.debug(f'Readiness for job {job.job_uuid} reported to validator {self.validator_key}')
 
     async def _executor_failed_to_prepare(self, msg: ExecutorFailedToPrepare):
@@ -188,15 +287,29 @@ class MinerValidatorConsumer(BaseConsumer, ValidatorInterfaceMixin):
             return
         job = jobs[0]
         self.pending_jobs = {k: v for k, v in self.pending_jobs.items() if v.executor_token != msg.executor_token}
-        await self.send(miner_requests.V0ExecutorFailedRequest(job_uuid=job.job_uuid).json())
+        await self.send_model(miner_requests.V0ExecutorFailedRequest(job_uuid=job.job_uuid))
         logger.debug(f'Failure in preparation for job {job.job_uuid} reported to validator {self.validator_key}')
 
+    async def _executor_output_chunk(self, msg: ExecutorOutputChunk):
+        if transport.Feature.output_streaming not in self.features:
+            # the job was requested on a connection that streams output, but this one doesn't
+            logger.debug(f'Dropping output chunk of job {msg.job_uuid} for validator {self.validator_key}')
+            return
+        await self.send_model(miner_requests.V0JobOutputChunk(
+            job_uuid=msg.job_uuid,
+            stream=msg.stream.value,
+            data=msg.data,
+        ))
+
     async def _executor_finished(self, msg: ExecutorFinished):
-        await self.send(miner_requests.V0JobFinishedRequest(
+        await self.send_model(miner_requests.V0JobFinishedRequest(
             job_uuid=msg.job_uuid,
             docker_process_stdout=msg.docker_process_stdout,
             docker_process_stderr=msg.docker_process_stderr,
-        ).json())
+            docker_process_stdout_sha256=msg.docker_process_stdout_sha256,
+            docker_process_stderr_sha256=msg.docker_process_stderr_sha256,
+            timeline=self._timeline(msg.timeline, JobPhase.result_relay, msg.sent_at),
+        ))
         logger.debug(f'Finished job {msg.job_uuid} reported to validator {self.validator_key}')
         job = self.pending_jobs.pop(msg.job_uuid)
         await job.arefresh_from_db()
@@ -204,17 +317,30 @@ class MinerValidatorConsumer(BaseConsumer, ValidatorInterfaceMixin):
         await job.asave()
 
     async def _executor_failed(self, msg: ExecutorFailed):
-        await self.send(miner_requests.V0JobFailedRequest(
+        await self.send_model(miner_requests.V0JobFailedRequest(
             job_uuid=msg.job_uuid,
             docker_process_stdout=msg.docker_process_stdout,
             docker_process_stderr=msg.docker_process_stderr,
             docker_process_exit_status=msg.docker_process_exit_status,
-        ).json())
+            docker_process_stdout_sha256=msg.docker_process_stdout_sha256,
+            docker_process_stderr_sha256=msg.docker_process_stderr_sha256,
+            timeline=self._timeline(msg.timeline, JobPhase.result_relay, msg.sent_at),
+        ))
         logger.debug(f'Failed job {msg.job_uuid} reported to validator {self.validator_key}')
         job = self.pending_jobs.pop(msg.job_uuid)
         await job.arefresh_from_db()
         job.result_reported_to_validator = timezone.now()
         await job.asave()
 
+    def _timeline(self, timeline: dict[str, float] | None, relay: JobPhase,
+                  sent_at: float | None) -> dict[str, float] | None:
+        """The job's timeline with the relay from the executor's consumer, if the validator wants it"""
+        if transport.Feature.job_timeline not in self.features:
+            return None
+        timeline = Timeline(timeline)
+        if sent_at is not None:
+            timeline.add(relay, time.time() - sent_at)
+        return timeline.durations
+
     async def disconnect(self, close_code):
         logger.info(f'Validator {self.validator_key} disconnected')
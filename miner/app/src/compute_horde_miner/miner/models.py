@@ -1,9 +1,20 @@
+import datetime
+import uuid
 from collections.abc import Iterable
 from enum import Enum
 from typing import Self
 
+from django.conf import settings
 from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models
+from django.utils import timezone
+
+# idle executors this close to their idle timeout may exit before getting the job, they are not used
+IDLE_EXECUTOR_TIMEOUT_MARGIN = datetime.timedelta(seconds=30)
+# a job handed to an idle executor gets a new executor if the idle one doesn't connect for it within this time
+IDLE_EXECUTOR_HANDOFF_TIMEOUT = datetime.timedelta(seconds=30)
+# executors that weren't waiting for or handed a job for this long are gone, e.g. crashed during a job
+IDLE_EXECUTOR_TOKEN_EXPIRY = datetime.timedelta(days=1)
 
 
 class EnumEncoder(DjangoJSONEncoder):
@@ -35,6 +46,10 @@ class AcceptedJob(models.Model):
     exit_status = models.PositiveSmallIntegerField(null=True)
     stdout = models.TextField(blank=True, default='')
     stderr = models.TextField(blank=True, default='')
+    # the validator receives the output in chunks as it's produced, only its digests are stored
+    output_streamed = models.BooleanField(default=False)
+    stdout_sha256 = models.CharField(max_length=64, null=True)
+    stderr_sha256 = models.CharField(max_length=64, null=True)
     result_reported_to_validator = models.DateTimeField(null=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -59,3 +74,73 @@ class AcceptedJob(models.Model):
             status__in=[cls.Status.FINISHED.value, cls.Status.FAILED.value],
             result_reported_to_validator__isnull=True,
         )]
+
+
+class IdleExecutor(models.Model):
+    """
+    A persistent executor spun up by this miner, connected under a token of its own while waiting for its next job.
+    Tokens are minted before the executor is spun up, nothing else can register as an idle executor.
+    """
+    executor_token = models.CharField(max_length=73, unique=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    # since when it's connected and waiting for a job
+    idle_since = models.DateTimeField(null=True)
+    # token of the job it was handed, until it connects under it
+    next_job_executor_token = models.CharField(max_length=73, null=True)
+
+    def __str__(self):
+        return self.executor_token
+
+    @classmethod
+    async def mint(cls) -> str:
+        """Token for an executor about to be spun up"""
+        await cls.objects.filter(updated_at__lt=timezone.now() - IDLE_EXECUTOR_TOKEN_EXPIRY).adelete()
+        return (await cls.objects.acreate(executor_token=uuid.uuid4().hex)).executor_token
+
+    @classmethod
+    async def register(cls, executor_token: str) -> datetime.datetime | None:
+        """Mark the executor as waiting for a job, return since when, None for unknown tokens or too many idle ones"""
+        if await cls.objects.filter(idle_since__isnull=False).acount() >= settings.MAX_IDLE_EXECUTORS:
+            return None
+        now = timezone.now()
+        updated = await cls.objects.filter(executor_token=executor_token).aupdate(idle_since=now, updated_at=now)
+        return now if updated else None
+
+    @classmethod
+    async def unregister(cls, executor_token: str, idle_since: datetime.datetime):
+        """The connection registered at `idle_since` was lost, unless the executor got a job or registered again"""
+        await cls.objects.filter(executor_token=executor_token, idle_since=idle_since).aupdate(
+            idle_since=None, updated_at=timezone.now())
+
+    @classmethod
+    async def claim(cls, executor_tokens: list[str]) -> dict[str, str]:
+        """
+        Hand jobs with `executor_tokens` to idle executors, which no other job can get any more, as many as there are.
+        Return the tokens of the idle executors by job executor token.
+        """
+        idle_since = (timezone.now() - datetime.timedelta(seconds=settings.EXECUTOR_IDLE_TIMEOUT_SECONDS)
+                      + IDLE_EXECUTOR_TIMEOUT_MARGIN)
+        # most recently idle first, the others time out and exit if there's not enough jobs for all
+        candidates = [
+            idle async for idle in cls.objects.filter(
+                idle_since__gt=idle_since,
+                next_job_executor_token__isnull=True,
+            ).order_by('-idle_since')[:len(executor_tokens)]
+        ]
+        claimed = {}
+        tokens = list(executor_tokens)
+        for idle in candidates:
+            # of concurrent claims only one updates the row
+            updated = await cls.objects.filter(pk=idle.pk, idle_since=idle.idle_since).aupdate(
+                idle_since=None, next_job_executor_token=tokens[0], updated_at=timezone.now())
+            if updated:
+                claimed[tokens.pop(0)] = idle.executor_token
+        return claimed
+
+    @classmethod
+    async def finish_handoff(cls, executor_token: str) -> bool:
+        """Whether the job with `executor_token` was handed to an idle executor, it's not waiting for it any more"""
+        updated = await cls.objects.filter(next_job_executor_token=executor_token).aupdate(
+            next_job_executor_token=None, updated_at=timezone.now())
+        return updated > 0
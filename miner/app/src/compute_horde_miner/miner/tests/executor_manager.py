@@ -1,4 +1,5 @@
 import asyncio
+import hashlib
 from unittest import mock
 
 from channels.testing import WebsocketCommunicator
@@ -13,41 +14,94 @@ async def fake_executor(token):
     communicator = WebsocketCommunicator(asgi.application, f"v0/executor_interface/{token}")
     connected, _ = await communicator.connect()
     assert connected
+    if fake_executor.stream_output:
+        await communicator.send_json_to({
+            "message_type": "V0TransportOfferRequest",
+            "encodings": ["json"],
+            "features": ["output_streaming"],
+        })
     response = await communicator.receive_json_from(timeout=WEBSOCKET_TIMEOUT)
+    job_uuid = response.get("job_uuid")
     assert response == {
-        "job_uuid": fake_executor.job_uuid,
+        "job_uuid": job_uuid,
         "message_type": "V0PrepareJobRequest",
         "base_docker_image_name": "it's teeeeests",
         "timeout_seconds": 60,
-        "volume_type": "inline"
+        "volume_type": "inline",
+        "base_docker_image_digest": fake_executor.image_digest,
     }, response
+    if fake_executor.stream_output:
+        response = await communicator.receive_json_from(timeout=WEBSOCKET_TIMEOUT)
+        assert response == {
+            "message_type": "V0TransportSelectedRequest",
+            "encoding": "json",
+            "features": ["output_streaming"],
+            "compression": None,
+            "session_id": None,
+            "resumed": False,
+            "received": None,
+        }, response
     await communicator.send_json_to({
         "message_type": "V0ReadyRequest",
-        "job_uuid": fake_executor.job_uuid,
+        "job_uuid": job_uuid,
+        "cached_volumes": fake_executor.cached_volumes,
     })
     response = await communicator.receive_json_from(timeout=WEBSOCKET_TIMEOUT)
     assert response == {
-        "job_uuid": fake_executor.job_uuid,
+        "job_uuid": job_uuid,
         "message_type": "V0RunJobRequest",
         "docker_image_name": "it's teeeeests again",
         'docker_run_options_preset': 'none',
         "docker_run_cmd": [],
         "volume": {
+            "volume_type": "content_addressed",
+            "contents": "",
+            "blob": None,
+            "sha256": fake_executor.cached_volumes[0],
+            "size": 123,
+            "fallback_volume_type": None,
+            "shards": None,
+        } if fake_executor.cached_volumes else {
             "volume_type": "inline",
-            "contents": "nonsense"
+            "contents": "nonsense",
+            "blob": None,
+            "sha256": None,
+            "size": None,
+            "fallback_volume_type": None,
+            "shards": None,
         },
         "output_upload": mock.ANY,
+        "docker_image_digest": fake_executor.image_digest,
     }, response
-    await communicator.send_json_to({
-        "message_type": "V0FinishedRequest",
-        "job_uuid": fake_executor.job_uuid,
-        "docker_process_stdout": "some stdout",
-        "docker_process_stderr": "some stderr",
-    })
+    if fake_executor.stream_output:
+        for stream, data in [("stdout", "some "), ("stderr", "some stderr"), ("stdout", "stdout")]:
+            await communicator.send_json_to({
+                "message_type": "V0JobOutputChunk",
+                "job_uuid": job_uuid,
+                "stream": stream,
+                "data": data,
+            })
+        await communicator.send_json_to({
+            "message_type": "V0FinishedRequest",
+            "job_uuid": job_uuid,
+            "docker_process_stdout": "",
+            "docker_process_stderr": "",
+            "docker_process_stdout_sha256": hashlib.sha256(b"some stdout").hexdigest(),
+            "docker_process_stderr_sha256": hashlib.sha256(b"some stderr").hexdigest(),
+        })
+    else:
+        await communicator.send_json_to({
+            "message_type": "V0FinishedRequest",
+            "job_uuid": job_uuid,
+            "docker_process_stdout": "some stdout",
+            "docker_process_stderr": "some stderr",
+        })
     await communicator.disconnect()
 
 
-fake_executor.job_uuid = None
+fake_executor.stream_output = False
+fake_executor.cached_volumes = None
+fake_executor.image_digest = None
 
 
 class TestExecutorManager(BaseExecutorManager):
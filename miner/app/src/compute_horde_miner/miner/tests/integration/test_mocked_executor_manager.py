@@ -1,11 +1,19 @@
+import asyncio
+import base64
+import datetime
+import hashlib
+import json
 import time
 import uuid
 
+import msgpack
 import pytest
 from channels.testing import WebsocketCommunicator
+from compute_horde import transport
 
 from compute_horde_miner import asgi
-from compute_horde_miner.miner.models import Validator
+from compute_horde_miner.miner.miner_consumer import validator_interface
+from compute_horde_miner.miner.models import AcceptedJob, IdleExecutor, Validator
 from compute_horde_miner.miner.tests.executor_manager import fake_executor
 
 WEBSOCKET_TIMEOUT = 10
@@ -18,7 +26,6 @@ async def test_main_loop():
     await Validator.objects.acreate(public_key=validator_key, active=True)
 
     job_uuid = str(uuid.uuid4())
-    fake_executor.job_uuid = job_uuid
     communicator = WebsocketCommunicator(asgi.application, f"v0/validator_interface/{validator_key}")
     connected, _ = await communicator.connect()
     assert connected
@@ -47,6 +54,8 @@ async def test_main_loop():
     assert response == {
         "message_type": "V0ExecutorReadyRequest",
         "job_uuid": job_uuid,
+        "cached_volumes": None,
+        "timeline": None,
     }
 
     await communicator.send_json_to({
@@ -66,5 +75,914 @@ async def test_main_loop():
         "job_uuid": job_uuid,
         "docker_process_stdout": "some stdout",
         "docker_process_stderr": "some stderr",
+        "docker_process_stdout_sha256": None,
+        "docker_process_stderr_sha256": None,
+        "timeline": None,
     }
     await communicator.disconnect()
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db
+async def test_main_loop_msgpack_encoding():
+    validator_key = 'some_other_public_key'
+    await Validator.objects.acreate(public_key=validator_key, active=True)
+
+    job_uuid = str(uuid.uuid4())
+    communicator = WebsocketCommunicator(asgi.application, f"v0/validator_interface/{validator_key}")
+    connected, _ = await communicator.connect()
+    assert connected
+    await communicator.send_json_to({
+        "message_type": "V0TransportOfferRequest",
+        "encodings": ["some future encoding", "msgpack", "json"],
+    })
+    response = await communicator.receive_json_from(timeout=WEBSOCKET_TIMEOUT)
+    assert response == {
+        "message_type": "V0TransportSelectedRequest",
+        "encoding": "msgpack",
+        "features": [],
+        "compression": None,
+        "session_id": None,
+        "resumed": False,
+        "received": None,
+    }
+    # messages sent before the selection was received are still json
+    await communicator.send_json_to({
+        "message_type": "V0AuthenticateRequest",
+        "payload": {
+            'validator_hotkey': validator_key,
+            'miner_hotkey': 'some key',
+            'timestamp': int(time.time()),
+        },
+        "signature": "gibberish",
+    })
+    await communicator.send_to(bytes_data=msgpack.packb({
+        "message_type": "V0InitialJobRequest",
+        "job_uuid": job_uuid,
+        "base_docker_image_name": "it's teeeeests",
+        "timeout_seconds": 60,
+        "volume_type": "inline"
+    }))
+    response = msgpack.unpackb(await communicator.receive_from(timeout=WEBSOCKET_TIMEOUT))
+    assert response == {
+        "message_type": "V0AcceptJobRequest",
+        "job_uuid": job_uuid,
+    }
+    response = msgpack.unpackb(await communicator.receive_from(timeout=WEBSOCKET_TIMEOUT))
+    assert response == {
+        "message_type": "V0ExecutorReadyRequest",
+        "job_uuid": job_uuid,
+        "cached_volumes": None,
+        "timeline": None,
+    }
+
+    await communicator.send_to(bytes_data=msgpack.packb({
+        "message_type": "V0JobRequest",
+        "job_uuid": job_uuid,
+        "docker_image_name": "it's teeeeests again",
+        "docker_run_cmd": [],
+        "docker_run_options_preset": 'none',
+        "volume": {
+            "volume_type": "inline",
+            "contents": "nonsense"
+        }
+    }))
+    response = msgpack.unpackb(await communicator.receive_from(timeout=WEBSOCKET_TIMEOUT))
+    assert response == {
+        "message_type": "V0JobFinishedRequest",
+        "job_uuid": job_uuid,
+        "docker_process_stdout": "some stdout",
+        "docker_process_stderr": "some stderr",
+        "docker_process_stdout_sha256": None,
+        "docker_process_stderr_sha256": None,
+        "timeline": None,
+    }
+    await communicator.disconnect()
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db
+async def test_main_loop_volume_blob():
+    validator_key = 'yet_another_public_key'
+    await Validator.objects.acreate(public_key=validator_key, active=True)
+
+    job_uuid = str(uuid.uuid4())
+    communicator = WebsocketCommunicator(asgi.application, f"v0/validator_interface/{validator_key}")
+    connected, _ = await communicator.connect()
+    assert connected
+    await communicator.send_json_to({
+        "message_type": "V0TransportOfferRequest",
+        "encodings": ["json"],
+        "features": ["blobs"],
+    })
+    response = await communicator.receive_json_from(timeout=WEBSOCKET_TIMEOUT)
+    assert response == {
+        "message_type": "V0TransportSelectedRequest",
+        "encoding": "json",
+        "features": ["blobs"],
+        "compression": None,
+        "session_id": None,
+        "resumed": False,
+        "received": None,
+    }
+    await communicator.send_json_to({
+        "message_type": "V0AuthenticateRequest",
+        "payload": {
+            'validator_hotkey': validator_key,
+            'miner_hotkey': 'some key',
+            'timestamp': int(time.time()),
+        },
+        "signature": "gibberish",
+    })
+    await communicator.send_json_to({
+        "message_type": "V0InitialJobRequest",
+        "job_uuid": job_uuid,
+        "base_docker_image_name": "it's teeeeests",
+        "timeout_seconds": 60,
+        "volume_type": "inline"
+    })
+    response = await communicator.receive_json_from(timeout=WEBSOCKET_TIMEOUT)
+    assert response == {
+        "message_type": "V0AcceptJobRequest",
+        "job_uuid": job_uuid,
+    }
+    response = await communicator.receive_json_from(timeout=WEBSOCKET_TIMEOUT)
+    assert response == {
+        "message_type": "V0ExecutorReadyRequest",
+        "job_uuid": job_uuid,
+        "cached_volumes": None,
+        "timeline": None,
+    }
+
+    # the fake executor doesn't negotiate blobs, so it gets the volume base64 encoded, as "nonsense"
+    blob_reference, blob_frame = transport.encode_blob(base64.b64decode("nonsense"))
+    await communicator.send_to(bytes_data=blob_frame)
+    await communicator.send_json_to({
+        "message_type": "V0JobRequest",
+        "job_uuid": job_uuid,
+        "docker_image_name": "it's teeeeests again",
+        "docker_run_cmd": [],
+        "docker_run_options_preset": 'none',
+        "volume": {
+            "volume_type": "inline",
+            "contents": "",
+            "blob": blob_reference.dict(),
+        }
+    })
+    response = await communicator.receive_json_from(timeout=WEBSOCKET_TIMEOUT)
+    assert response == {
+        "message_type": "V0JobFinishedRequest",
+        "job_uuid": job_uuid,
+        "docker_process_stdout": "some stdout",
+        "docker_process_stderr": "some stderr",
+        "docker_process_stdout_sha256": None,
+        "docker_process_stderr_sha256": None,
+        "timeline": None,
+    }
+    await communicator.disconnect()
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db
+async def test_main_loop_compression(monkeypatch):
+    # compress every frame, not only the large ones
+    monkeypatch.setattr(transport, 'COMPRESSION_THRESHOLD_BYTES', 0)
+    validator_key = 'compressing_public_key'
+    await Validator.objects.acreate(public_key=validator_key, active=True)
+
+    job_uuid = str(uuid.uuid4())
+    communicator = WebsocketCommunicator(asgi.application, f"v0/validator_interface/{validator_key}")
+    connected, _ = await communicator.connect()
+    assert connected
+    await communicator.send_json_to({
+        "message_type": "V0TransportOfferRequest",
+        "encodings": ["json"],
+        "compressions": ["some future compression", "deflate"],
+    })
+    response = await communicator.receive_json_from(timeout=WEBSOCKET_TIMEOUT)
+    assert response == {
+        "message_type": "V0TransportSelectedRequest",
+        "encoding": "json",
+        "features": [],
+        "compression": "deflate",
+        "session_id": None,
+        "resumed": False,
+        "received": None,
+    }
+    await communicator.send_json_to({
+        "message_type": "V0AuthenticateRequest",
+        "payload": {
+            'validator_hotkey': validator_key,
+            'miner_hotkey': 'some key',
+            'timestamp': int(time.time()),
+        },
+        "signature": "gibberish",
+    })
+    await communicator.send_to(bytes_data=transport.compress(json.dumps({
+        "message_type": "V0InitialJobRequest",
+        "job_uuid": job_uuid,
+        "base_docker_image_name": "it's teeeeests",
+        "timeout_seconds": 60,
+        "volume_type": "inline"
+    }), transport.Compression.deflate))
+    response = await communicator.receive_from(timeout=WEBSOCKET_TIMEOUT)
+    assert response.startswith(transport.COMPRESSED_FRAME_PREFIX)
+    assert transport.decode(response) == {
+        "message_type": "V0AcceptJobRequest",
+        "job_uuid": job_uuid,
+    }
+    response = await communicator.receive_from(timeout=WEBSOCKET_TIMEOUT)
+    assert transport.decode(response) == {
+        "message_type": "V0ExecutorReadyRequest",
+        "job_uuid": job_uuid,
+        "cached_volumes": None,
+        "timeline": None,
+    }
+
+    await communicator.send_to(bytes_data=transport.compress(json.dumps({
+        "message_type": "V0JobRequest",
+        "job_uuid": job_uuid,
+        "docker_image_name": "it's teeeeests again",
+        "docker_run_cmd": [],
+        "docker_run_options_preset": 'none',
+        "volume": {
+            "volume_type": "inline",
+            "contents": "nonsense"
+        }
+    }), transport.Compression.deflate))
+    response = await communicator.receive_from(timeout=WEBSOCKET_TIMEOUT)
+    assert transport.decode(response) == {
+        "message_type": "V0JobFinishedRequest",
+        "job_uuid": job_uuid,
+        "docker_process_stdout": "some stdout",
+        "docker_process_stderr": "some stderr",
+        "docker_process_stdout_sha256": None,
+        "docker_process_stderr_sha256": None,
+        "timeline": None,
+    }
+    await communicator.disconnect()
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db
+async def test_main_loop_output_streaming(monkeypatch):
+    monkeypatch.setattr(fake_executor, 'stream_output', True)
+    validator_key = 'streaming_public_key'
+    await Validator.objects.acreate(public_key=validator_key, active=True)
+
+    job_uuid = str(uuid.uuid4())
+    communicator = WebsocketCommunicator(asgi.application, f"v0/validator_interface/{validator_key}")
+    connected, _ = await communicator.connect()
+    assert connected
+    await communicator.send_json_to({
+        "message_type": "V0TransportOfferRequest",
+        "encodings": ["json"],
+        "features": ["output_streaming"],
+    })
+    response = await communicator.receive_json_from(timeout=WEBSOCKET_TIMEOUT)
+    assert response == {
+        "message_type": "V0TransportSelectedRequest",
+        "encoding": "json",
+        "features": ["output_streaming"],
+        "compression": None,
+        "session_id": None,
+        "resumed": False,
+        "received": None,
+    }
+    await communicator.send_json_to({
+        "message_type": "V0AuthenticateRequest",
+        "payload": {
+            'validator_hotkey': validator_key,
+            'miner_hotkey': 'some key',
+            'timestamp': int(time.time()),
+        },
+        "signature": "gibberish",
+    })
+    await communicator.send_json_to({
+        "message_type": "V0InitialJobRequest",
+        "job_uuid": job_uuid,
+        "base_docker_image_name": "it's teeeeests",
+        "timeout_seconds": 60,
+        "volume_type": "inline"
+    })
+    response = await communicator.receive_json_from(timeout=WEBSOCKET_TIMEOUT)
+    assert response == {
+        "message_type": "V0AcceptJobRequest",
+        "job_uuid": job_uuid,
+    }
+    response = await communicator.receive_json_from(timeout=WEBSOCKET_TIMEOUT)
+    assert response == {
+        "message_type": "V0ExecutorReadyRequest",
+        "job_uuid": job_uuid,
+        "cached_volumes": None,
+        "timeline": None,
+    }
+
+    await communicator.send_json_to({
+        "message_type": "V0JobRequest",
+        "job_uuid": job_uuid,
+        "docker_image_name": "it's teeeeests again",
+        "docker_run_cmd": [],
+        "docker_run_options_preset": 'none',
+        "volume": {
+            "volume_type": "inline",
+            "contents": "nonsense"
+        }
+    })
+    for stream, data in [("stdout", "some "), ("stderr", "some stderr"), ("stdout", "stdout")]:
+        response = await communicator.receive_json_from(timeout=WEBSOCKET_TIMEOUT)
+        assert response == {
+            "message_type": "V0JobOutputChunk",
+            "job_uuid": job_uuid,
+            "stream": stream,
+            "data": data,
+        }
+    response = await communicator.receive_json_from(timeout=WEBSOCKET_TIMEOUT)
+    assert response == {
+        "message_type": "V0JobFinishedRequest",
+        "job_uuid": job_uuid,
+        "docker_process_stdout": "",
+        "docker_process_stderr": "",
+        "docker_process_stdout_sha256": hashlib.sha256(b"some stdout").hexdigest(),
+        "docker_process_stderr_sha256": hashlib.sha256(b"some stderr").hexdigest(),
+        "timeline": None,
+    }
+    # stored whole, to be resent if the validator reconnects before getting the result
+    job = await AcceptedJob.objects.aget(job_uuid=job_uuid)
+    assert (job.stdout, job.stderr) == ("some stdout", "some stderr")
+    await communicator.disconnect()
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db
+async def test_main_loop_concurrent_jobs():
+    validator_key = 'multiplexing_public_key'
+    await Validator.objects.acreate(public_key=validator_key, active=True)
+
+    job_uuids = [str(uuid.uuid4()), str(uuid.uuid4())]
+    communicator = WebsocketCommunicator(asgi.application, f"v0/validator_interface/{validator_key}")
+    connected, _ = await communicator.connect()
+    assert connected
+    await communicator.send_json_to({
+        "message_type": "V0AuthenticateRequest",
+        "payload": {
+            'validator_hotkey': validator_key,
+            'miner_hotkey': 'some key',
+            'timestamp': int(time.time()),
+        },
+        "signature": "gibberish",
+    })
+    for job_uuid in job_uuids:
+        await communicator.send_json_to({
+            "message_type": "V0InitialJobRequest",
+            "job_uuid": job_uuid,
+            "base_docker_image_name": "it's teeeeests",
+            "timeout_seconds": 60,
+            "volume_type": "inline"
+        })
+    responses = [await communicator.receive_json_from(timeout=WEBSOCKET_TIMEOUT) for _ in range(4)]
+    assert sorted(responses, key=lambda response: (response["message_type"], response["job_uuid"])) == sorted([
+        *({"message_type": "V0AcceptJobRequest", "job_uuid": job_uuid} for job_uuid in job_uuids),
+        *(
+            {"message_type": "V0ExecutorReadyRequest", "job_uuid": job_uuid, "cached_volumes": None, "timeline": None}
+            for job_uuid in job_uuids
+        ),
+    ], key=lambda response: (response["message_type"], response["job_uuid"]))
+
+    for job_uuid in job_uuids:
+        await communicator.send_json_to({
+            "message_type": "V0JobRequest",
+            "job_uuid": job_uuid,
+            "docker_image_name": "it's teeeeests again",
+            "docker_run_cmd": [],
+            "docker_run_options_preset": 'none',
+            "volume": {
+                "volume_type": "inline",
+                "contents": "nonsense"
+            }
+        })
+    responses = [await communicator.receive_json_from(timeout=WEBSOCKET_TIMEOUT) for _ in job_uuids]
+    assert sorted(responses, key=lambda response: response["job_uuid"]) == [
+        {
+            "message_type": "V0JobFinishedRequest",
+            "job_uuid": job_uuid,
+            "docker_process_stdout": "some stdout",
+            "docker_process_stderr": "some stderr",
+            "docker_process_stdout_sha256": None,
+            "docker_process_stderr_sha256": None,
+            "timeline": None,
+        }
+        for job_uuid in sorted(job_uuids)
+    ]
+    await communicator.disconnect()
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db
+async def test_main_loop_job_batch():
+    validator_key = 'batching_public_key'
+    await Validator.objects.acreate(public_key=validator_key, active=True)
+
+    job_uuids = sorted([str(uuid.uuid4()), str(uuid.uuid4())])
+    communicator = WebsocketCommunicator(asgi.application, f"v0/validator_interface/{validator_key}")
+    connected, _ = await communicator.connect()
+    assert connected
+    await communicator.send_json_to({
+        "message_type": "V0AuthenticateRequest",
+        "payload": {
+            'validator_hotkey': validator_key,
+            'miner_hotkey': 'some key',
+            'timestamp': int(time.time()),
+        },
+        "signature": "gibberish",
+    })
+    await communicator.send_json_to({
+        "message_type": "V0InitialJobBatchRequest",
+        "jobs": [
+            {
+                "message_type": "V0InitialJobRequest",
+                "job_uuid": job_uuid,
+                "base_docker_image_name": "it's teeeeests",
+                "timeout_seconds": 60,
+                "volume_type": "inline"
+            }
+            for job_uuid in job_uuids
+        ],
+    })
+    response = await communicator.receive_json_from(timeout=WEBSOCKET_TIMEOUT)
+    assert response == {
+        "message_type": "V0JobBatchDecisionRequest",
+        "accepted_job_uuids": job_uuids,
+        "declined_job_uuids": [],
+    }
+    responses = [await communicator.receive_json_from(timeout=WEBSOCKET_TIMEOUT) for _ in job_uuids]
+    assert sorted(responses, key=lambda response: response["job_uuid"]) == [
+        {"message_type": "V0ExecutorReadyRequest", "job_uuid": job_uuid, "cached_volumes": None, "timeline": None}
+        for job_uuid in job_uuids
+    ]
+
+    for job_uuid in job_uuids:
+        await communicator.send_json_to({
+            "message_type": "V0JobRequest",
+            "job_uuid": job_uuid,
+            "docker_image_name": "it's teeeeests again",
+            "docker_run_cmd": [],
+            "docker_run_options_preset": 'none',
+            "volume": {
+                "volume_type": "inline",
+                "contents": "nonsense"
+            }
+        })
+    responses = [await communicator.receive_json_from(timeout=WEBSOCKET_TIMEOUT) for _ in job_uuids]
+    assert sorted(responses, key=lambda response: response["job_uuid"]) == [
+        {
+            "message_type": "V0JobFinishedRequest",
+            "job_uuid": job_uuid,
+            "docker_process_stdout": "some stdout",
+            "docker_process_stderr": "some stderr",
+            "docker_process_stdout_sha256": None,
+            "docker_process_stderr_sha256": None,
+            "timeline": None,
+        }
+        for job_uuid in job_uuids
+    ]
+    await communicator.disconnect()
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db
+async def test_main_loop_cached_volume(monkeypatch):
+    cached_volume = hashlib.sha256(b"some zip").hexdigest()
+    monkeypatch.setattr(fake_executor, 'cached_volumes', [cached_volume])
+    validator_key = 'caching_public_key'
+    await Validator.objects.acreate(public_key=validator_key, active=True)
+
+    job_uuid = str(uuid.uuid4())
+    communicator = WebsocketCommunicator(asgi.application, f"v0/validator_interface/{validator_key}")
+    connected, _ = await communicator.connect()
+    assert connected
+    await communicator.send_json_to({
+        "message_type": "V0AuthenticateRequest",
+        "payload": {
+            'validator_hotkey': validator_key,
+            'miner_hotkey': 'some key',
+            'timestamp': int(time.time()),
+        },
+        "signature": "gibberish",
+    })
+    await communicator.send_json_to({
+        "message_type": "V0InitialJobRequest",
+        "job_uuid": job_uuid,
+        "base_docker_image_name": "it's teeeeests",
+        "timeout_seconds": 60,
+        "volume_type": "inline"
+    })
+    response = await communicator.receive_json_from(timeout=WEBSOCKET_TIMEOUT)
+    assert response == {
+        "message_type": "V0AcceptJobRequest",
+        "job_uuid": job_uuid,
+    }
+    response = await communicator.receive_json_from(timeout=WEBSOCKET_TIMEOUT)
+    assert response == {
+        "message_type": "V0ExecutorReadyRequest",
+        "job_uuid": job_uuid,
+        "cached_volumes": [cached_volume],
+        "timeline": None,
+    }
+    await communicator.send_json_to({
+        "message_type": "V0JobRequest",
+        "job_uuid": job_uuid,
+        "docker_image_name": "it's teeeeests again",
+        "docker_run_cmd": [],
+        "docker_run_options_preset": 'none',
+        "volume": {
+            "volume_type": "content_addressed",
+            "contents": "",
+            "sha256": cached_volume,
+            "size": 123,
+        }
+    })
+    response = await communicator.receive_json_from(timeout=WEBSOCKET_TIMEOUT)
+    assert response == {
+        "message_type": "V0JobFinishedRequest",
+        "job_uuid": job_uuid,
+        "docker_process_stdout": "some stdout",
+        "docker_process_stderr": "some stderr",
+        "docker_process_stdout_sha256": None,
+        "docker_process_stderr_sha256": None,
+        "timeline": None,
+    }
+    await communicator.disconnect()
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db
+async def test_main_loop_session_resumed(monkeypatch):
+    monkeypatch.setattr(validator_interface, 'SESSION_SYNC_MARGIN', datetime.timedelta(0))
+    validator_key = 'resuming_public_key'
+    await Validator.objects.acreate(public_key=validator_key, active=True)
+    authentication = {
+        "message_type": "V0AuthenticateRequest",
+        "payload": {
+            'validator_hotkey': validator_key,
+            'miner_hotkey': 'some key',
+            'timestamp': int(time.time()),
+        },
+        "signature": "gibberish",
+    }
+
+    job_uuid = str(uuid.uuid4())
+    communicator = WebsocketCommunicator(asgi.application, f"v0/validator_interface/{validator_key}")
+    connected, _ = await communicator.connect()
+    assert connected
+    await communicator.send_json_to({
+        "message_type": "V0TransportOfferRequest",
+        "encodings": ["json"],
+        "features": ["sessions"],
+    })
+    response = await communicator.receive_json_from(timeout=WEBSOCKET_TIMEOUT)
+    session_id = response["session_id"]
+    assert response == {
+        "message_type": "V0TransportSelectedRequest",
+        "encoding": "json",
+        "features": ["sessions"],
+        "compression": None,
+        "session_id": session_id,
+        "resumed": False,
+        "received": 0,
+    }
+    await communicator.send_json_to({"message_type": "V0TransportAckRequest", "received": 0})
+    await communicator.send_json_to(authentication)
+    await communicator.send_json_to({
+        "message_type": "V0InitialJobRequest",
+        "job_uuid": job_uuid,
+        "base_docker_image_name": "it's teeeeests",
+        "timeout_seconds": 60,
+        "volume_type": "inline"
+    })
+    response = await communicator.receive_json_from(timeout=WEBSOCKET_TIMEOUT)
+    assert response == {
+        "message_type": "V0AcceptJobRequest",
+        "job_uuid": job_uuid,
+    }
+    executor_ready = await communicator.receive_json_from(timeout=WEBSOCKET_TIMEOUT)
+    assert executor_ready["message_type"] == "V0ExecutorReadyRequest"
+    await communicator.disconnect()
+
+    # the readiness got lost with the connection
+    communicator = WebsocketCommunicator(asgi.application, f"v0/validator_interface/{validator_key}")
+    connected, _ = await communicator.connect()
+    assert connected
+    await communicator.send_json_to({
+        "message_type": "V0TransportOfferRequest",
+        "encodings": ["json"],
+        "features": ["sessions"],
+        "session_id": session_id,
+        "received": 1,
+    })
+    response = await communicator.receive_json_from(timeout=WEBSOCKET_TIMEOUT)
+    assert response == {
+        "message_type": "V0TransportSelectedRequest",
+        "encoding": "json",
+        "features": ["sessions"],
+        "compression": None,
+        "session_id": session_id,
+        "resumed": True,
+        "received": 2,
+    }
+    # replayed, not reported again
+    assert await communicator.receive_json_from(timeout=WEBSOCKET_TIMEOUT) == executor_ready
+    assert await communicator.receive_nothing()
+
+    await communicator.send_json_to({"message_type": "V0TransportAckRequest", "received": 2})
+    await communicator.send_json_to(authentication)
+    await communicator.send_json_to({
+        "message_type": "V0JobRequest",
+        "job_uuid": job_uuid,
+        "docker_image_name": "it's teeeeests again",
+        "docker_run_cmd": [],
+        "docker_run_options_preset": 'none',
+        "volume": {
+            "volume_type": "inline",
+            "contents": "nonsense"
+        }
+    })
+    response = await communicator.receive_json_from(timeout=WEBSOCKET_TIMEOUT)
+    assert response == {
+        "message_type": "V0JobFinishedRequest",
+        "job_uuid": job_uuid,
+        "docker_process_stdout": "some stdout",
+        "docker_process_stderr": "some stderr",
+        "docker_process_stdout_sha256": None,
+        "docker_process_stderr_sha256": None,
+        "timeline": None,
+    }
+    await communicator.disconnect()
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db
+async def test_main_loop_job_timeline():
+    validator_key = 'timeline_public_key'
+    await Validator.objects.acreate(public_key=validator_key, active=True)
+
+    job_uuid = str(uuid.uuid4())
+    communicator = WebsocketCommunicator(asgi.application, f"v0/validator_interface/{validator_key}")
+    connected, _ = await communicator.connect()
+    assert connected
+    await communicator.send_json_to({
+        "message_type": "V0TransportOfferRequest",
+        "encodings": ["json"],
+        "features": ["job_timeline"],
+    })
+    response = await communicator.receive_json_from(timeout=WEBSOCKET_TIMEOUT)
+    assert response["features"] == ["job_timeline"]
+    await communicator.send_json_to({
+        "message_type": "V0AuthenticateRequest",
+        "payload": {
+            'validator_hotkey': validator_key,
+            'miner_hotkey': 'some key',
+            'timestamp': int(time.time()),
+        },
+        "signature": "gibberish",
+    })
+    await communicator.send_json_to({
+        "message_type": "V0InitialJobRequest",
+        "job_uuid": job_uuid,
+        "base_docker_image_name": "it's teeeeests",
+        "timeout_seconds": 60,
+        "volume_type": "inline"
+    })
+    response = await communicator.receive_json_from(timeout=WEBSOCKET_TIMEOUT)
+    assert response["message_type"] == "V0AcceptJobRequest"
+    response = await communicator.receive_json_from(timeout=WEBSOCKET_TIMEOUT)
+    assert response["message_type"] == "V0ExecutorReadyRequest"
+    assert set(response["timeline"]) == {"executor_spawn", "ready_relay"}
+
+    await communicator.send_json_to({
+        "message_type": "V0JobRequest",
+        "job_uuid": job_uuid,
+        "docker_image_name": "it's teeeeests again",
+        "docker_run_cmd": [],
+        "docker_run_options_preset": 'none',
+        "volume": {
+            "volume_type": "inline",
+            "contents": "nonsense"
+        }
+    })
+    response = await communicator.receive_json_from(timeout=WEBSOCKET_TIMEOUT)
+    assert response["message_type"] == "V0JobFinishedRequest"
+    assert set(response["timeline"]) == {"executor_spawn", "result_relay"}
+    await communicator.disconnect()
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db
+async def test_main_loop_idle_executor(monkeypatch):
+    monkeypatch.setattr(validator_interface, 'IDLE_EXECUTOR_HANDOFF_TIMEOUT', datetime.timedelta(seconds=1))
+    async def reserve_executors(tokens):
+        assert not tokens, 'the idle executor should get the job'
+        return []
+
+    monkeypatch.setattr(validator_interface.current.executor_manager, 'reserve_executors', reserve_executors)
+    validator_key = 'idle_executor_public_key'
+    await Validator.objects.acreate(public_key=validator_key, active=True)
+
+    idle_token = await IdleExecutor.mint()
+    idle_executor = WebsocketCommunicator(asgi.application, f"v0/executor_interface/idle/{idle_token}")
+    connected, _ = await idle_executor.connect()
+    assert connected
+
+    job_uuid = str(uuid.uuid4())
+    communicator = WebsocketCommunicator(asgi.application, f"v0/validator_interface/{validator_key}")
+    connected, _ = await communicator.connect()
+    assert connected
+    await communicator.send_json_to({
+        "message_type": "V0AuthenticateRequest",
+        "payload": {
+            'validator_hotkey': validator_key,
+            'miner_hotkey': 'some key',
+            'timestamp': int(time.time()),
+        },
+        "signature": "gibberish",
+    })
+    await communicator.send_json_to({
+        "message_type": "V0InitialJobRequest",
+        "job_uuid": job_uuid,
+        "base_docker_image_name": "it's teeeeests",
+        "timeout_seconds": 60,
+        "volume_type": "inline"
+    })
+    response = await communicator.receive_json_from(timeout=WEBSOCKET_TIMEOUT)
+    assert response == {
+        "message_type": "V0AcceptJobRequest",
+        "job_uuid": job_uuid,
+    }
+    response = await idle_executor.receive_json_from(timeout=WEBSOCKET_TIMEOUT)
+    assert response["message_type"] == "V0NextJobRequest"
+    assert response["executor_token"].startswith(job_uuid)
+    idle = await IdleExecutor.objects.aget(executor_token=idle_token)
+    assert idle.idle_since is None
+    assert idle.next_job_executor_token == response["executor_token"]
+    await idle_executor.disconnect()
+
+    # the executor connects again under the job's token
+    executor_task = asyncio.create_task(fake_executor(response["executor_token"]))
+    response = await communicator.receive_json_from(timeout=WEBSOCKET_TIMEOUT)
+    assert response["message_type"] == "V0ExecutorReadyRequest"
+    assert (await IdleExecutor.objects.aget(executor_token=idle_token)).next_job_executor_token is None
+    # the job doesn't get another executor
+    await asyncio.gather(*validator_interface.handoff_tasks)
+    await communicator.send_json_to({
+        "message_type": "V0JobRequest",
+        "job_uuid": job_uuid,
+        "docker_image_name": "it's teeeeests again",
+        "docker_run_cmd": [],
+        "docker_run_options_preset": 'none',
+        "volume": {
+            "volume_type": "inline",
+            "contents": "nonsense"
+        }
+    })
+    response = await communicator.receive_json_from(timeout=WEBSOCKET_TIMEOUT)
+    assert response["message_type"] == "V0JobFinishedRequest"
+    await executor_task
+    await communicator.disconnect()
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db
+async def test_main_loop_idle_executor_handoff_failed(monkeypatch):
+    monkeypatch.setattr(validator_interface, 'IDLE_EXECUTOR_HANDOFF_TIMEOUT', datetime.timedelta(seconds=0.1))
+    reserved = []
+    reserve_executors = validator_interface.current.executor_manager.reserve_executors
+
+    async def record_reserve_executors(tokens):
+        reserved.append(tokens)
+        return await reserve_executors(tokens)
+
+    monkeypatch.setattr(validator_interface.current.executor_manager, 'reserve_executors', record_reserve_executors)
+    validator_key = 'idle_executor_handoff_public_key'
+    await Validator.objects.acreate(public_key=validator_key, active=True)
+
+    idle_executor = WebsocketCommunicator(asgi.application, f"v0/executor_interface/idle/{await IdleExecutor.mint()}")
+    connected, _ = await idle_executor.connect()
+    assert connected
+
+    job_uuid = str(uuid.uuid4())
+    communicator = WebsocketCommunicator(asgi.application, f"v0/validator_interface/{validator_key}")
+    connected, _ = await communicator.connect()
+    assert connected
+    await communicator.send_json_to({
+        "message_type": "V0AuthenticateRequest",
+        "payload": {
+            'validator_hotkey': validator_key,
+            'miner_hotkey': 'some key',
+            'timestamp': int(time.time()),
+        },
+        "signature": "gibberish",
+    })
+    await communicator.send_json_to({
+        "message_type": "V0InitialJobRequest",
+        "job_uuid": job_uuid,
+        "base_docker_image_name": "it's teeeeests",
+        "timeout_seconds": 60,
+        "volume_type": "inline"
+    })
+    response = await communicator.receive_json_from(timeout=WEBSOCKET_TIMEOUT)
+    assert response == {
+        "message_type": "V0AcceptJobRequest",
+        "job_uuid": job_uuid,
+    }
+    response = await idle_executor.receive_json_from(timeout=WEBSOCKET_TIMEOUT)
+    assert response["message_type"] == "V0NextJobRequest"
+    executor_token = response["executor_token"]
+    # e.g. exits before connecting for the job, which gets a new executor
+    await idle_executor.disconnect()
+    response = await communicator.receive_json_from(timeout=WEBSOCKET_TIMEOUT)
+    assert response["message_type"] == "V0ExecutorReadyRequest"
+    assert response["job_uuid"] == job_uuid
+    assert reserved == [[], [executor_token]]
+    await communicator.disconnect()
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db
+async def test_idle_executor_registration(settings):
+    settings.MAX_IDLE_EXECUTORS = 1
+
+    async def register(token):
+        idle_executor = WebsocketCommunicator(asgi.application, f"v0/executor_interface/idle/{token}")
+        connected, _ = await idle_executor.connect()
+        assert connected
+        return idle_executor
+
+    async def assert_rejected(idle_executor):
+        response = await idle_executor.receive_json_from(timeout=WEBSOCKET_TIMEOUT)
+        assert response["message_type"] == "GenericError"
+        assert (await idle_executor.receive_output(timeout=WEBSOCKET_TIMEOUT))["type"] == "websocket.close"
+        await idle_executor.disconnect()
+
+    # only executors spun up by the miner can wait for jobs, their tokens are minted first
+    await assert_rejected(await register('forged-token'))
+    assert not await IdleExecutor.objects.filter(executor_token='forged-token').aexists()
+
+    first = await register(await IdleExecutor.mint())
+    assert await first.receive_nothing()
+    # over MAX_IDLE_EXECUTORS
+    await assert_rejected(await register(await IdleExecutor.mint()))
+
+    await first.disconnect()
+    assert not await IdleExecutor.objects.filter(idle_since__isnull=False).aexists()
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db
+async def test_main_loop_pinned_images(monkeypatch):
+    image_digest = f'sha256:{hashlib.sha256(b"some image").hexdigest()}'
+    # the fake executor checks it gets the digests
+    monkeypatch.setattr(fake_executor, 'image_digest', image_digest)
+    validator_key = 'pinning_public_key'
+    await Validator.objects.acreate(public_key=validator_key, active=True)
+
+    job_uuid = str(uuid.uuid4())
+    communicator = WebsocketCommunicator(asgi.application, f"v0/validator_interface/{validator_key}")
+    connected, _ = await communicator.connect()
+    assert connected
+    await communicator.send_json_to({
+        "message_type": "V0AuthenticateRequest",
+        "payload": {
+            'validator_hotkey': validator_key,
+            'miner_hotkey': 'some key',
+            'timestamp': int(time.time()),
+        },
+        "signature": "gibberish",
+    })
+    await communicator.send_json_to({
+        "message_type": "V0InitialJobRequest",
+        "job_uuid": job_uuid,
+        "base_docker_image_name": "it's teeeeests",
+        "base_docker_image_digest": image_digest,
+        "timeout_seconds": 60,
+        "volume_type": "inline"
+    })
+    response = await communicator.receive_json_from(timeout=WEBSOCKET_TIMEOUT)
+    assert response["message_type"] == "V0AcceptJobRequest"
+    response = await communicator.receive_json_from(timeout=WEBSOCKET_TIMEOUT)
+    assert response["message_type"] == "V0ExecutorReadyRequest"
+
+    await communicator.send_json_to({
+        "message_type": "V0JobRequest",
+        "job_uuid": job_uuid,
+        "docker_image_name": "it's teeeeests again",
+        "docker_image_digest": image_digest,
+        "docker_run_cmd": [],
+        "docker_run_options_preset": 'none',
+        "volume": {
+            "volume_type": "inline",
+            "contents": "nonsense"
+        }
+    })
+    response = await communicator.receive_json_from(timeout=WEBSOCKET_TIMEOUT)
+    assert response["message_type"] == "V0JobFinishedRequest"
+    await communicator.disconnect()
@@ -0,0 +1,68 @@
+import time
+
+from compute_horde import transport
+
+from compute_horde_miner.miner.miner_consumer import base_compute_horde_consumer
+
+
+def session_with_sent(frames, **kwargs) -> transport.Session:
+    session = transport.Session(**kwargs)
+    for frame in frames:
+        session.record_sent(frame)
+    return session
+
+
+def test_acknowledged_frames_trimmed():
+    session = session_with_sent(['1', '2', b'3', '4'])
+    session.peer_received(2)
+    assert session.unacknowledged_frames() == [b'3', '4']
+    assert session.replay_buffer_bytes == 2
+    # acknowledgements arrive late, after later ones
+    session.peer_received(1)
+    assert session.unacknowledged_frames() == [b'3', '4']
+    session.peer_received(4)
+    assert session.unacknowledged_frames() == []
+    assert session.replay_buffer_bytes == 0
+
+
+def test_frames_to_replay():
+    session = session_with_sent(['1', '2', '3', '4'])
+    assert session.frames_to_replay(1) == ['2', '3', '4']
+    assert session.frames_to_replay(3) == ['4']
+    assert session.frames_to_replay(4) == []
+    # the peer can't have received more than was sent, or frames it has acknowledged before
+    assert session.frames_to_replay(5) is None
+    assert session.frames_to_replay(2) is None
+
+
+def test_replay_buffer_limits():
+    session = session_with_sent(['1', '2', '3', '4'], max_frames=2)
+    assert session.frames_to_replay(1) is None
+    assert session.frames_to_replay(2) == ['3', '4']
+
+    session = session_with_sent(['11', '22', '33'], max_bytes=5)
+    assert session.unacknowledged_frames() == ['22', '33']
+    assert session.frames_to_replay(0) is None
+    assert session.frames_to_replay(1) == ['22', '33']
+
+
+def test_ack():
+    session = transport.Session()
+    assert not any(session.record_received() for _ in range(transport.SESSION_ACK_EVERY - 1))
+    assert session.record_received()
+    assert session.ack().received == transport.SESSION_ACK_EVERY
+    assert not session.record_received()
+    assert session.acknowledged_received == transport.SESSION_ACK_EVERY
+
+
+def test_abandoned_sessions_swept_on_create():
+    store = base_compute_horde_consumer.SessionStore()
+    abandoned = store.create('/path', None)
+    abandoned.disconnected_at = time.time() - base_compute_horde_consumer.SESSION_EXPIRY_SECONDS - 1
+    store.create('/path', None)
+    # swept at most every SESSION_SWEEP_INTERVAL_SECONDS
+    assert abandoned.session_id in store.sessions
+    store.swept_at -= base_compute_horde_consumer.SESSION_SWEEP_INTERVAL_SECONDS
+    live = store.create('/path', None)
+    assert abandoned.session_id not in store.sessions
+    assert live.session_id in store.sessions
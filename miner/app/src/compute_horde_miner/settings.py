@@ -270,6 +270,15 @@ LOGGING = {
 EXECUTOR_MANAGER_CLASS_PATH = env.str('EXECUTOR_MANAGER_CLASS_PATH', default='compute_horde_miner.miner.executor_manager.docker:DockerExecutorManager')
 ADDRESS_FOR_EXECUTORS = env.str('ADDRESS_FOR_EXECUTORS', default='')
 PORT_FOR_EXECUTORS = env.int('PORT_FOR_EXECUTORS')
+# the executor image is pulled again only if it's missing, or if the freshness period is over and the registry has
+# another digest for its tag
+IMAGE_CACHE_DIR = env.str('IMAGE_CACHE_DIR', default='/tmp/compute_horde_image_cache')
+IMAGE_CACHE_FRESHNESS_SECONDS = env.int('IMAGE_CACHE_FRESHNESS_SECONDS', default=10 * 60)
+# executors wait for the next job after each one instead of exiting, up to EXECUTOR_IDLE_TIMEOUT_SECONDS
+PERSISTENT_EXECUTORS = env.bool('PERSISTENT_EXECUTORS', default=False)
+EXECUTOR_IDLE_TIMEOUT_SECONDS = env.int('EXECUTOR_IDLE_TIMEOUT_SECONDS', default=600)
+# executors over this many are not registered as idle, they exit after the idle timeout
+MAX_IDLE_EXECUTORS = env.int('MAX_IDLE_EXECUTORS', default=100)
 
 BITTENSOR_MINER_PORT = env.int('BITTENSOR_MINER_PORT')
 
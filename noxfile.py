@@ -29,3 +29,10 @@ def test(session):
         'tests',
         *session.posargs,
     )
+
+
+@nox.session(python=PYTHON_VERSIONS)
+def benchmark(session):
+    session.run('pdm', 'install', '--check', external=True)
+    session.run('python', 'compute_horde/benchmarks/protocol_parse.py')
+    session.run('python', 'compute_horde/benchmarks/protocol_codec.py', *session.posargs)
@@ -280,6 +280,12 @@ SYNTHETIC_JOB_GENERATOR = env.str(
     'SYNTHETIC_JOB_GENERATOR',
     default='compute_horde_validator.validator.synthetic_jobs.generator.gpu_hashcat:GPUHashcatSyntheticJobGenerator',
 )
+# sha256:... digest of the gpu hashcat job image, pinning it for reproducible timing and executors that have it
+# cached need no registry round trip, empty to go by its tag
+SYNTHETIC_JOB_IMAGE_DIGEST = env.str('SYNTHETIC_JOB_IMAGE_DIGEST', default='')
+# subtract the miner connection's smallest heartbeat round trip from synthetic job times, for both the timeout and
+# the score, so miners far from the validator aren't penalized for their latency
+SYNTHETIC_JOB_SUBTRACT_NETWORK_TIME = env.bool('SYNTHETIC_JOB_SUBTRACT_NETWORK_TIME', default=False)
 # if you need to hit a particular miner, without fetching their key, address or port from the blockchain
 DEBUG_MINER_KEY = env.str('DEBUG_MINER_KEY', default='')
 DEBUG_MINER_ADDRESS = env.str('DEBUG_MINER_ADDRESS', default='')
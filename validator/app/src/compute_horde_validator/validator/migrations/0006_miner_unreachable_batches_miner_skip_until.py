@@ -0,0 +1,22 @@
+# Generated by Django 4.2.9 on 2024-03-04 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("validator", "0005_organicjob_job_description_and_more"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="miner",
+            name="unreachable_batches",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="miner",
+            name="skip_until",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
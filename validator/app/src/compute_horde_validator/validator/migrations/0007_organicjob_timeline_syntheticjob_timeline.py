@@ -0,0 +1,22 @@
+# Generated by Django 4.2.9 on 2024-03-04 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("validator", "0006_miner_unreachable_batches_miner_skip_until"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="organicjob",
+            name="timeline",
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.AddField(
+            model_name="syntheticjob",
+            name="timeline",
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
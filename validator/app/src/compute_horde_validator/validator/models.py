@@ -6,6 +6,10 @@ from django.db import models
 class Miner(models.Model):
     hotkey = models.CharField(max_length=255, unique=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    # circuit breaker: a miner that couldn't be connected to in a number of batches in a row gets no synthetic jobs
+    # until `skip_until`, then it's tried again
+    unreachable_batches = models.PositiveIntegerField(default=0)
+    skip_until = models.DateTimeField(null=True, blank=True)
 
 
 class SyntheticJobBatch(models.Model):
@@ -31,6 +35,8 @@ class JobBase(models.Model):
     updated_at = models.DateTimeField(auto_now=True)
     comment = models.TextField(blank=True, default='')
     job_description = models.TextField(blank=True)
+    # durations of the phases of the job in seconds, by phase (see compute_horde.timeline)
+    timeline = models.JSONField(default=dict, blank=True)
 
 
 class SyntheticJob(JobBase):
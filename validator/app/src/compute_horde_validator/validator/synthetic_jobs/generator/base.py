@@ -16,6 +16,14 @@ class AbstractSyntheticJobGenerator(abc.ABC):
     def docker_image_name(self) -> str:
         ...
 
+    def base_docker_image_digest(self) -> str | None:
+        """`sha256:...` digest pinning `base_docker_image_name`, None to go by the tag"""
+        return None
+
+    def docker_image_digest(self) -> str | None:
+        """`sha256:...` digest pinning `docker_image_name`, None to go by the tag"""
+        return None
+
     @abc.abstractmethod
     def docker_run_options_preset(self) -> str:
         ...
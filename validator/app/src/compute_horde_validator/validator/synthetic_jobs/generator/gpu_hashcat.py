@@ -4,6 +4,7 @@ import io
 import zipfile
 
 from compute_horde.mv_protocol.miner_requests import V0JobFinishedRequest
+from django.conf import settings
 
 from compute_horde_validator.validator.jobs import Algorithm, V0SyntheticJob
 from compute_horde_validator.validator.synthetic_jobs.generator.base import (
@@ -46,6 +47,12 @@ class GPUHashcatSyntheticJobGenerator(AbstractSyntheticJobGenerator):
     def docker_image_name(self) -> str:
         return "backenddevelopersltd/compute-horde-job:v0-latest"
 
+    def base_docker_image_digest(self) -> str | None:
+        return settings.SYNTHETIC_JOB_IMAGE_DIGEST or None
+
+    def docker_image_digest(self) -> str | None:
+        return settings.SYNTHETIC_JOB_IMAGE_DIGEST or None
+
     def docker_run_options_preset(self) -> str:
         return 'nvidia_all'
 
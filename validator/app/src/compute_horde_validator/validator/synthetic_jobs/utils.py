@@ -1,30 +1,43 @@
 import asyncio
+import base64
 import datetime
+import hashlib
 import logging
 import time
+from collections import defaultdict
 from collections.abc import Iterable
 
 import bittensor
+from compute_horde import transport
 from compute_horde.base_requests import BaseRequest
-from compute_horde.miner_client.base import AbstractMinerClient, UnsupportedMessageReceived
+from compute_horde.miner_client.base import (
+    AbstractMinerClient,
+    MinerConnectionError,
+    UnsupportedMessageReceived,
+)
 from compute_horde.mv_protocol import miner_requests, validator_requests
 from compute_horde.mv_protocol.miner_requests import (
     BaseMinerRequest,
+    OutputStream,
     UnauthorizedError,
     V0AcceptJobRequest,
     V0DeclineJobRequest,
     V0ExecutorFailedRequest,
     V0ExecutorReadyRequest,
+    V0JobBatchDecisionRequest,
     V0JobFailedRequest,
     V0JobFinishedRequest,
+    V0JobOutputChunk,
 )
 from compute_horde.mv_protocol.validator_requests import (
     AuthenticationPayload,
     V0AuthenticateRequest,
+    V0InitialJobBatchRequest,
     V0InitialJobRequest,
     V0JobRequest,
     VolumeType,
 )
+from compute_horde.timeline import JobPhase, Timeline
 from django.conf import settings
 from django.utils.timezone import now
 
@@ -34,26 +47,92 @@ from compute_horde_validator.validator.synthetic_jobs.generator import current
 JOB_LENGTH = 300
 TIMEOUT_LEEWAY = 1
 TIMEOUT_MARGIN = 10
+# how long to wait for the miner to negotiate the connection before sending unbatched initial job requests
+TRANSPORT_SELECTION_TIMEOUT = 2
+# initial job requests sent within this many seconds after the first one go to the miner with it in a batch
+INITIAL_JOB_BATCH_WINDOW = 0.1
+# how long to wait for connections to all miners before starting jobs, miners not connected by then are retried
+# when their jobs start, for as long again
+CONNECT_TIMEOUT = 20
+# a miner unreachable in this many batches in a row is skipped, for a time doubling with each further such batch
+CIRCUIT_BREAKER_THRESHOLD = 3
+CIRCUIT_BREAKER_MIN_SKIP = datetime.timedelta(hours=2)
+CIRCUIT_BREAKER_MAX_SKIP = datetime.timedelta(days=1)
 
 
 logger = logging.getLogger(__name__)
 
 
+class JobState:
+    def __init__(self):
+        self.miner_ready_or_declining_future = asyncio.Future()
+        self.miner_ready_or_declining_timestamp: int = 0
+        self.miner_finished_or_failed_future = asyncio.Future()
+        self.miner_finished_or_failed_timestamp: int = 0
+        self.output_chunks: dict[OutputStream, list[str]] = {stream: [] for stream in OutputStream}
+        self.first_output_timestamp: float | None = None
+
+
 class MinerClient(AbstractMinerClient):
+    """Runs any number of jobs concurrently over one connection to the miner, see `add_job`"""
+
     def __init__(self, loop: asyncio.AbstractEventLoop, miner_address: str, my_hotkey: str, miner_hotkey: str,
-                 miner_port: int, job_uuid: str, keypair: bittensor.Keypair):
-        super().__init__(loop, f'{miner_hotkey}({miner_address}:{miner_port})')
+                 miner_port: int, keypair: bittensor.Keypair):
+        super().__init__(loop, f'{miner_hotkey}({miner_address}:{miner_port})', connect_timeout=CONNECT_TIMEOUT)
         self.miner_hotkey = miner_hotkey
         self.my_hotkey = my_hotkey
         self.miner_address = miner_address
         self.miner_port = miner_port
-        self.job_uuid = job_uuid
         self.keypair = keypair
+        self.jobs: dict[str, JobState] = {}
+        self.initial_job_batch: list[V0InitialJobRequest] = []
+        # sends the batch at the end of its window, owned by the client so that no job's cancellation stops it
+        self.initial_job_batch_task: asyncio.Task | None = None
+        # the miner accepted or declined a job, it's reachable for the circuit breaker
+        self.answered_jobs = False
 
-        self.miner_ready_or_declining_future = asyncio.Future()
-        self.miner_ready_or_declining_timestamp: int = 0
-        self.miner_finished_or_failed_future = asyncio.Future()
-        self.miner_finished_or_failed_timestamp: int = 0
+    def add_job(self, job_uuid: str) -> JobState:
+        """Start receiving messages about the job, until `remove_job`"""
+        job_state = self.jobs[job_uuid] = JobState()
+        return job_state
+
+    def remove_job(self, job_uuid: str):
+        self.jobs.pop(job_uuid, None)
+
+    async def send_initial_job_request(self, msg: V0InitialJobRequest):
+        """
+        Send the request, in one `V0InitialJobBatchRequest` with the requests of other jobs started at the same time
+        if the miner takes batches. The miner's answer is routed to the job as if it was sent alone, a batch that
+        can't be sent fails the jobs' `miner_ready_or_declining_future`.
+        """
+        await self.wait_for_transport_selection(TRANSPORT_SELECTION_TIMEOUT)
+        if transport.Feature.job_batches not in self.features:
+            await self.send_model(msg)
+            return
+        self.initial_job_batch.append(msg)
+        if len(self.initial_job_batch) == 1:
+            self.initial_job_batch_task = asyncio.create_task(self._send_initial_job_batch())
+
+    async def _send_initial_job_batch(self):
+        await asyncio.sleep(INITIAL_JOB_BATCH_WINDOW)
+        # jobs removed in the meantime, e.g. cancelled, are left out
+        jobs = [job for job in self.initial_job_batch if job.job_uuid in self.jobs]
+        self.initial_job_batch = []
+        if not jobs:
+            return
+        try:
+            await self.send_model(V0InitialJobBatchRequest(jobs=jobs))
+        except Exception as ex:
+            logger.info(f'Could not send initial job batch to {self.miner_name}: {ex!r}')
+            for job in jobs:
+                job_state = self.jobs.get(job.job_uuid)
+                if job_state is not None and not job_state.miner_ready_or_declining_future.done():
+                    job_state.miner_ready_or_declining_future.set_exception(ex)
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if self.initial_job_batch_task is not None:
+            self.initial_job_batch_task.cancel()
+        await super().__aexit__(exc_type, exc_val, exc_tb)
 
     def miner_url(self) -> str:
         return f'ws://{self.miner_address}:{self.miner_port}/v0/validator_interface/{self.my_hotkey}'
@@ -71,26 +150,73 @@ class MinerClient(AbstractMinerClient):
         if isinstance(msg, UnauthorizedError):
             logger.error(f'Unauthorized in {self.miner_name}: {msg.code}, details: {msg.details}')
             return
-        if msg.job_uuid != self.job_uuid:
-            logger.info(f'Recevied info about another job: {msg}')
+        if isinstance(msg, V0JobBatchDecisionRequest):
+            for job_uuid in msg.accepted_job_uuids:
+                await self.handle_message(V0AcceptJobRequest(job_uuid=job_uuid))
+            for job_uuid in msg.declined_job_uuids:
+                await self.handle_message(V0DeclineJobRequest(job_uuid=job_uuid))
+            return
+        if isinstance(msg, V0AcceptJobRequest | V0DeclineJobRequest):
+            self.answered_jobs = True
+        job_state = self.jobs.get(msg.job_uuid)
+        if job_state is None:
+            logger.info(f'Received info about another job: {msg}')
             return
         if isinstance(msg, V0AcceptJobRequest):
-            logger.info(f'Miner {self.miner_name} accepted job')
+            logger.info(f'Miner {self.miner_name} accepted job {msg.job_uuid}')
         elif isinstance(
                 msg,
                 V0DeclineJobRequest | V0ExecutorFailedRequest | V0ExecutorReadyRequest
         ):
-            self.miner_ready_or_declining_timestamp = time.time()
-            self.miner_ready_or_declining_future.set_result(msg)
+            if job_state.miner_ready_or_declining_future.done():
+                # resent by the miner after a reconnect
+                logger.debug(f'Duplicate {msg.message_type.value} for job {msg.job_uuid}')
+                return
+            job_state.miner_ready_or_declining_timestamp = time.time()
+            job_state.miner_ready_or_declining_future.set_result(msg)
+        elif isinstance(msg, V0JobOutputChunk):
+            if job_state.first_output_timestamp is None:
+                job_state.first_output_timestamp = time.time()
+                logger.debug(f'Miner {self.miner_name} started sending output of job {msg.job_uuid}')
+            job_state.output_chunks[msg.stream].append(msg.data)
         elif isinstance(
             msg,
             V0JobFailedRequest | V0JobFinishedRequest
         ):
-            self.miner_finished_or_failed_future.set_result(msg)
-            self.miner_finished_or_failed_timestamp = time.time()
+            if job_state.miner_finished_or_failed_future.done():
+                logger.debug(f'Duplicate {msg.message_type.value} for job {msg.job_uuid}')
+                return
+            job_state.miner_finished_or_failed_future.set_result(self.with_streamed_output(job_state, msg))
+            job_state.miner_finished_or_failed_timestamp = time.time()
         else:
             raise UnsupportedMessageReceived(msg)
 
+    def with_streamed_output(self, job_state: JobState, msg: V0JobFailedRequest | V0JobFinishedRequest):
+        """
+        Put the output received in V0JobOutputChunk messages into the final message, which only has digests - unless
+        the miner resent the result from its stored state, with the whole output
+        """
+        update = {}
+        for stream, field in [
+            (OutputStream.stdout, 'docker_process_stdout'),
+            (OutputStream.stderr, 'docker_process_stderr'),
+        ]:
+            expected_sha256 = getattr(msg, f'{field}_sha256')
+            if expected_sha256 is None:
+                continue
+            output = getattr(msg, field) or ''.join(job_state.output_chunks[stream])
+            if hashlib.sha256(output.encode()).hexdigest() != expected_sha256:
+                details = f'streamed {stream.value} does not match its digest'
+                logger.warning(f'Miner {self.miner_name} {details}')
+                return V0JobFailedRequest(
+                    job_uuid=msg.job_uuid,
+                    docker_process_exit_status=None,
+                    docker_process_stdout='',
+                    docker_process_stderr=details,
+                )
+            update[field] = output
+        return msg.copy(update=update)
+
     def generate_authentication_message(self):
         payload = AuthenticationPayload(
             validator_hotkey=self.my_hotkey,
@@ -123,7 +249,10 @@ def initiate_jobs(netuid, network) -> list[SyntheticJob]:
             miner_port=settings.DEBUG_MINER_PORT,
             status=SyntheticJob.Status.PENDING
         )]
-    miners = get_miners(metagraph)
+    miners = [miner for miner in get_miners(metagraph) if neurons_by_key[miner.hotkey].axon_info.is_serving]
+    skipped = {miner.hotkey for miner in miners if miner.skip_until is not None and miner.skip_until > now()}
+    if skipped:
+        logger.info(f'Skipping {len(skipped)} miners unreachable in recent batches: {", ".join(sorted(skipped))}')
     return list(SyntheticJob.objects.bulk_create([
         SyntheticJob(
             batch=batch,
@@ -132,36 +261,92 @@ def initiate_jobs(netuid, network) -> list[SyntheticJob]:
             miner_address_ip_version=neurons_by_key[miner.hotkey].axon_info.ip_type,
             miner_port=neurons_by_key[miner.hotkey].axon_info.port,
             status=SyntheticJob.Status.PENDING
-        ) for miner in miners if neurons_by_key[miner.hotkey].axon_info.is_serving]
+        ) for miner in miners if miner.hotkey not in skipped]
     ))
 
 
-async def _execute_job(job: JobBase) -> tuple[
+def create_miner_client(miner_address: str, miner_port: int, miner_hotkey: str) -> MinerClient:
+    key = settings.BITTENSOR_WALLET().get_hotkey()
+    return MinerClient(
+        loop=asyncio.get_event_loop(),
+        miner_address=miner_address,
+        miner_port=miner_port,
+        miner_hotkey=miner_hotkey,
+        my_hotkey=key.ss58_address,
+        keypair=key,
+    )
+
+
+class MinerConnectionPool:
+    """
+    Authenticated connections to miners, opened concurrently by `connect` before jobs start and kept alive by
+    heartbeats, so connecting is not part of running jobs. Jobs borrow a miner's connection with `client`.
+    """
+
+    def __init__(self):
+        self.clients: dict[tuple[str, str, int], MinerClient] = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await asyncio.gather(*[client.__aexit__(exc_type, exc_val, exc_tb) for client in self.clients.values()])
+        self.clients = {}
+
+    def client(self, miner_hotkey: str, miner_address: str, miner_port: int) -> MinerClient:
+        """The miner's client, connecting when it's first used if `connect` didn't"""
+        key = (miner_hotkey, miner_address, miner_port)
+        if key not in self.clients:
+            self.clients[key] = create_miner_client(miner_address, miner_port, miner_hotkey)
+        return self.clients[key]
+
+    async def _connect(self, client: MinerClient):
+        await client.ensure_connected()
+        await client.wait_for_transport_selection(TRANSPORT_SELECTION_TIMEOUT)
+
+    async def connect(self, miners: Iterable[tuple[str, str, int]], timeout: float = CONNECT_TIMEOUT):
+        """Connect to (hotkey, address, port) of all `miners` at once, giving up on the slow ones after `timeout`"""
+        tasks = [asyncio.create_task(self._connect(self.client(*miner))) for miner in miners]
+        if not tasks:
+            return
+        done, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        connected = sum(1 for task in done if task.exception() is None)
+        logger.info(f'Connected to {connected} of {len(tasks)} miners')
+
+
+async def _execute_job(job: JobBase, client: MinerClient | None = None) -> tuple[
     float | None,
     V0DeclineJobRequest | V0ExecutorFailedRequest | V0JobFailedRequest | V0JobFinishedRequest
 ]:
+    """
+    Run the job over `client`'s connection, which may be running other jobs to the same miner at the same time,
+    or over a connection of its own if no client is given
+    """
+    if client is None:
+        client = create_miner_client(job.miner_address, job.miner_port, job.miner.hotkey)
+        async with client:
+            return await _execute_job(job, client)
+
     job_generator = current.SyntheticJobGenerator()
     job.job_description = job_generator.job_description()
     await job.asave()
-    loop = asyncio.get_event_loop()
-    key = settings.BITTENSOR_WALLET().get_hotkey()
-    client = MinerClient(
-        loop=loop,
-        miner_address=job.miner_address,
-        miner_port=job.miner_port,
-        miner_hotkey=job.miner.hotkey,
-        my_hotkey=key.ss58_address,
-        job_uuid=str(job.job_uuid),
-        keypair=key,
-    )
-    async with client:
-        await client.send_model(V0InitialJobRequest(
+    job_state = client.add_job(str(job.job_uuid))
+    timeline = Timeline()
+    # saved with the job as it fills up
+    job.timeline = timeline.durations
+    try:
+        initial_job_sent = time.time()
+        await client.send_initial_job_request(V0InitialJobRequest(
             job_uuid=str(job.job_uuid),
             base_docker_image_name=job_generator.base_docker_image_name(),
             timeout_seconds=job_generator.timeout_seconds(),
             volume_type=VolumeType.inline.value,
+            base_docker_image_digest=job_generator.base_docker_image_digest(),
         ))
-        msg = await client.miner_ready_or_declining_future
+        msg = await job_state.miner_ready_or_declining_future
+        timeline.add(JobPhase.miner_ready, job_state.miner_ready_or_declining_timestamp - initial_job_sent)
         if isinstance(msg, V0DeclineJobRequest | V0ExecutorFailedRequest):
             logger.info(f'Miner {client.miner_name} won\'t do job: {msg}')
             job.status = JobBase.Status.FAILED
@@ -170,28 +355,51 @@ async def _execute_job(job: JobBase) -> tuple[
             return None, msg
         elif isinstance(msg, V0ExecutorReadyRequest):
             logger.debug(f'Miner {client.miner_name} ready for job: {msg}')
+            timeline.durations.update(msg.timeline or {})
         else:
             raise ValueError(f'Unexpected msg: {msg}')
 
+        volume = {
+            'volume_type': VolumeType.inline.value,
+            'contents': job_generator.volume_contents(),
+        }
+        if msg.cached_volumes is not None:
+            # the executor caches volumes, refer to this one by digest and only send it if it's not cached yet
+            volume_zip = base64.b64decode(volume['contents'])
+            volume['volume_type'] = VolumeType.content_addressed.value
+            volume['sha256'] = hashlib.sha256(volume_zip).hexdigest()
+            volume['size'] = len(volume_zip)
+            if volume['sha256'] in msg.cached_volumes:
+                volume['contents'] = ''
+            else:
+                volume['fallback_volume_type'] = VolumeType.inline.value
+        if volume['contents'] and transport.Feature.blobs in client.features:
+            # the zip goes in a binary frame of its own, miner passes it on to the executor without re-encoding
+            volume['blob'] = await client.send_blob(base64.b64decode(volume['contents']))
+            volume['contents'] = ''
         await client.send_model(V0JobRequest(
             job_uuid=str(job.job_uuid),
             docker_image_name=job_generator.docker_image_name(),
             docker_run_options_preset=job_generator.docker_run_options_preset(),
             docker_run_cmd=job_generator.docker_run_cmd(),
-            volume={
-                'volume_type': VolumeType.inline.value,
-                'contents': job_generator.volume_contents(),
-            },
+            volume=volume,
             output_upload=None,  # TODO
+            docker_image_digest=job_generator.docker_image_digest(),
         ))
         full_job_sent = time.time()
         msg = None
         try:
             msg = await asyncio.wait_for(
-                client.miner_finished_or_failed_future,
+                job_state.miner_finished_or_failed_future,
                 job_generator.timeout_seconds() + TIMEOUT_LEEWAY + TIMEOUT_MARGIN
             )
-            time_took = client.miner_finished_or_failed_timestamp - full_job_sent
+            time_took = job_state.miner_finished_or_failed_timestamp - full_job_sent
+            timeline.add(JobPhase.job, time_took)
+            if settings.SYNTHETIC_JOB_SUBTRACT_NETWORK_TIME:
+                # the job request and the result each crossed the link once; the smallest heartbeat round trip is the
+                # one a miner can't inflate by answering pings late, none is known before the first pong
+                time_took = max(time_took - (client.rtt.min or 0), 0)
+            timeline.durations.update(msg.timeline or {})
             if time_took > (job_generator.timeout_seconds() + TIMEOUT_LEEWAY):
                 logger.info(f'Miner {client.miner_name} sent a job result but too late: {msg}')
                 raise TimeoutError
@@ -224,20 +432,68 @@ async def _execute_job(job: JobBase) -> tuple[
                 return None, msg
         else:
             raise ValueError(f'Unexpected msg: {msg}')
+    except MinerConnectionError as ex:
+        logger.info(str(ex))
+        job.status = JobBase.Status.FAILED
+        job.comment = 'Miner unreachable'
+        await job.asave()
+        return None, None
+    finally:
+        client.remove_job(str(job.job_uuid))
 
 
-async def execute_job(synthetic_job_id):
+async def execute_job(synthetic_job_id, client: MinerClient | None = None):
     synthetic_job: SyntheticJob = await SyntheticJob.objects.prefetch_related('miner').aget(id=synthetic_job_id)
-    score, msg = await _execute_job(synthetic_job)
+    score, msg = await _execute_job(synthetic_job, client)
     if score is not None:
         synthetic_job.score = score
         await synthetic_job.asave()
 
 
+async def execute_miner_jobs(synthetic_jobs: list[SyntheticJob], client: MinerClient, timeout: float):
+    """Run jobs of one miner concurrently, over a single connection, cancelling the ones not done after `timeout`"""
+    tasks = [asyncio.create_task(execute_job(synthetic_job.id, client)) for synthetic_job in synthetic_jobs]
+    _, pending = await asyncio.wait(tasks, timeout=timeout)
+    for task in pending:
+        task.cancel()
+    if pending:
+        # they must be done with the connection before it's closed
+        await asyncio.wait(pending)
+
+
 async def execute_jobs(synthetic_jobs: Iterable[SyntheticJob]):
-    tasks = [asyncio.create_task(asyncio.wait_for(execute_job(synthetic_job.id), JOB_LENGTH))
-             for synthetic_job in synthetic_jobs]
-    await asyncio.wait(tasks)
+    deadline = time.monotonic() + JOB_LENGTH
+    jobs_by_miner: dict[tuple[str, str, int], list[SyntheticJob]] = defaultdict(list)
+    for synthetic_job in synthetic_jobs:
+        jobs_by_miner[(synthetic_job.miner.hotkey, synthetic_job.miner_address, synthetic_job.miner_port)].append(
+            synthetic_job)
+    async with MinerConnectionPool() as pool:
+        await pool.connect(jobs_by_miner.keys())
+        tasks = [
+            asyncio.create_task(execute_miner_jobs(miner_jobs, pool.client(*miner), deadline - time.monotonic()))
+            for miner, miner_jobs in jobs_by_miner.items()
+        ]
+        await asyncio.wait(tasks)
+        reachable = {miner: pool.client(*miner).answered_jobs for miner in jobs_by_miner}
+    for miner, miner_jobs in jobs_by_miner.items():
+        await update_circuit_breaker(miner_jobs[0].miner, reachable[miner])
+
+
+async def update_circuit_breaker(miner: Miner, reachable: bool):
+    if reachable:
+        if not miner.unreachable_batches and miner.skip_until is None:
+            return
+        miner.unreachable_batches = 0
+        miner.skip_until = None
+    else:
+        miner.unreachable_batches += 1
+        if miner.unreachable_batches >= CIRCUIT_BREAKER_THRESHOLD:
+            doublings = min(miner.unreachable_batches - CIRCUIT_BREAKER_THRESHOLD, 10)
+            skip = min(CIRCUIT_BREAKER_MIN_SKIP * 2 ** doublings, CIRCUIT_BREAKER_MAX_SKIP)
+            miner.skip_until = now() + skip
+            logger.info(f'Miner {miner.hotkey} unreachable in {miner.unreachable_batches} batches in a row, '
+                        f'skipping it until {miner.skip_until}')
+    await miner.asave(update_fields=['unreachable_batches', 'skip_until'])
 
 
 def get_miners(metagraph) -> list[Miner]:
@@ -0,0 +1,305 @@
+import asyncio
+import hashlib
+import uuid
+from types import SimpleNamespace
+
+import pytest
+from compute_horde import transport
+from compute_horde.miner_client.base import MinerConnectionError
+from compute_horde.mv_protocol.miner_requests import (
+    V0AcceptJobRequest,
+    V0DeclineJobRequest,
+    V0ExecutorReadyRequest,
+    V0JobBatchDecisionRequest,
+    V0JobFailedRequest,
+    V0JobFinishedRequest,
+    V0JobOutputChunk,
+)
+from compute_horde.mv_protocol.validator_requests import (
+    V0InitialJobRequest,
+    V0JobRequest,
+    VolumeType,
+)
+from django.utils.timezone import now
+
+from compute_horde_validator.validator.models import Miner, SyntheticJob
+from compute_horde_validator.validator.synthetic_jobs import utils
+from compute_horde_validator.validator.synthetic_jobs.generator import current
+from compute_horde_validator.validator.synthetic_jobs.generator.echo import (
+    EchoSyntheticJobGenerator,
+)
+from compute_horde_validator.validator.synthetic_jobs.utils import MinerClient
+
+
+def sha256(text: str) -> str:
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def miner_client() -> MinerClient:
+    return MinerClient(
+        loop=asyncio.get_running_loop(),
+        miner_address='127.0.0.1',
+        my_hotkey='validator_hotkey',
+        miner_hotkey='miner_hotkey',
+        miner_port=8000,
+        keypair=None,
+    )
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(('chunks', 'stdout', 'expected'), [
+    # streamed
+    (['some ', 'stdout'], '', V0JobFinishedRequest),
+    (['some ', 'other stdout'], '', V0JobFailedRequest),
+    # resent from the miner's stored state after a reconnect, without the chunks
+    ([], 'some stdout', V0JobFinishedRequest),
+    ([], 'other stdout', V0JobFailedRequest),
+])
+async def test_streamed_output_digest(chunks, stdout, expected):
+    client = miner_client()
+    job_uuid = str(uuid.uuid4())
+    job_state = client.add_job(job_uuid)
+    for data in chunks:
+        await client.handle_message(V0JobOutputChunk(job_uuid=job_uuid, stream='stdout', data=data))
+    await client.handle_message(V0JobFinishedRequest(
+        job_uuid=job_uuid,
+        docker_process_stdout=stdout,
+        docker_process_stderr='',
+        docker_process_stdout_sha256=sha256('some stdout'),
+    ))
+    msg = job_state.miner_finished_or_failed_future.result()
+    assert isinstance(msg, expected)
+    if expected is V0JobFinishedRequest:
+        assert msg.docker_process_stdout == 'some stdout'
+    else:
+        assert msg.docker_process_stderr == 'streamed stdout does not match its digest'
+
+
+@pytest.mark.asyncio
+async def test_initial_job_batch_send_failure_fails_every_job(monkeypatch):
+    client = miner_client()
+    client.features = {transport.Feature.job_batches}
+    client.transport_selected.set()
+
+    async def send_model(model):
+        raise MinerConnectionError('connection lost')
+
+    monkeypatch.setattr(client, 'send_model', send_model)
+    job_states = [client.add_job(str(uuid.uuid4())) for _ in range(3)]
+    await asyncio.gather(*[
+        client.send_initial_job_request(V0InitialJobRequest(
+            job_uuid=job_uuid,
+            base_docker_image_name='image',
+            timeout_seconds=60,
+            volume_type=VolumeType.inline,
+        ))
+        for job_uuid in client.jobs
+    ])
+    await client.initial_job_batch_task
+    for job_state in job_states:
+        with pytest.raises(MinerConnectionError):
+            job_state.miner_ready_or_declining_future.result()
+
+
+@pytest.mark.asyncio
+async def test_replies_routed_by_job_uuid():
+    client = miner_client()
+    first_uuid, second_uuid, third_uuid = (str(uuid.uuid4()) for _ in range(3))
+    first, second, third = (client.add_job(job_uuid) for job_uuid in (first_uuid, second_uuid, third_uuid))
+    await client.handle_message(V0JobBatchDecisionRequest(
+        accepted_job_uuids=[first_uuid, third_uuid],
+        declined_job_uuids=[second_uuid],
+    ))
+    await client.handle_message(V0ExecutorReadyRequest(job_uuid=third_uuid))
+    await client.handle_message(V0JobOutputChunk(job_uuid=third_uuid, stream='stdout', data='third'))
+    await client.handle_message(V0ExecutorReadyRequest(job_uuid=first_uuid))
+    await client.handle_message(V0JobOutputChunk(job_uuid=first_uuid, stream='stdout', data='first'))
+    # about a job that has already been removed
+    await client.handle_message(V0ExecutorReadyRequest(job_uuid=str(uuid.uuid4())))
+    for job_uuid, stdout in [(first_uuid, 'first'), (third_uuid, 'third')]:
+        await client.handle_message(V0JobFinishedRequest(
+            job_uuid=job_uuid,
+            docker_process_stdout='',
+            docker_process_stderr='',
+            docker_process_stdout_sha256=sha256(stdout),
+        ))
+
+    assert first.miner_ready_or_declining_future.result() == V0ExecutorReadyRequest(job_uuid=first_uuid)
+    assert second.miner_ready_or_declining_future.result() == V0DeclineJobRequest(job_uuid=second_uuid)
+    assert third.miner_ready_or_declining_future.result() == V0ExecutorReadyRequest(job_uuid=third_uuid)
+    assert first.miner_finished_or_failed_future.result().docker_process_stdout == 'first'
+    assert not second.miner_finished_or_failed_future.done()
+    assert third.miner_finished_or_failed_future.result().docker_process_stdout == 'third'
+
+
+@pytest.mark.asyncio
+async def test_miner_jobs_cancelled_at_deadline(monkeypatch):
+    running = set()
+
+    async def execute_job(synthetic_job_id, client):
+        running.add(synthetic_job_id)
+        try:
+            if synthetic_job_id != 'quick':
+                await asyncio.sleep(60)
+        finally:
+            running.remove(synthetic_job_id)
+
+    monkeypatch.setattr(utils, 'execute_job', execute_job)
+    jobs = [SimpleNamespace(id=job_id) for job_id in ('quick', 'slow', 'slower')]
+    await asyncio.wait_for(utils.execute_miner_jobs(jobs, miner_client(), timeout=0.1), 1)
+    assert not running
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('msg', [V0AcceptJobRequest, V0DeclineJobRequest])
+async def test_answering_miner_reachable(msg):
+    client = miner_client()
+    job_uuid = str(uuid.uuid4())
+    client.add_job(job_uuid)
+    await client.handle_message(V0ExecutorReadyRequest(job_uuid=str(uuid.uuid4())))
+    assert not client.answered_jobs
+    await client.handle_message(msg(job_uuid=job_uuid))
+    assert client.answered_jobs
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db(transaction=True)
+async def test_circuit_breaker():
+    miner = await Miner.objects.acreate(hotkey='miner_hotkey')
+    for _ in range(utils.CIRCUIT_BREAKER_THRESHOLD - 1):
+        await utils.update_circuit_breaker(miner, reachable=False)
+    assert miner.skip_until is None
+
+    skips = []
+    for _ in range(14):
+        await utils.update_circuit_breaker(miner, reachable=False)
+        skips.append(round((miner.skip_until - now()).total_seconds()))
+    # doubling from the shortest skip, up to the longest
+    min_skip = utils.CIRCUIT_BREAKER_MIN_SKIP.total_seconds()
+    assert skips[:3] == [min_skip, 2 * min_skip, 4 * min_skip]
+    assert skips[-1] == utils.CIRCUIT_BREAKER_MAX_SKIP.total_seconds()
+
+    await utils.update_circuit_breaker(miner, reachable=True)
+    await miner.arefresh_from_db()
+    assert (miner.unreachable_batches, miner.skip_until) == (0, None)
+
+
+class FakeMinerClient:
+    def __init__(self, miner_address, miner_port, miner_hotkey):
+        self.miner_hotkey = miner_hotkey
+        self.connected = self.closed = False
+
+    async def ensure_connected(self):
+        if self.miner_hotkey == 'slow':
+            await asyncio.sleep(60)
+        self.connected = True
+
+    async def wait_for_transport_selection(self, timeout):
+        pass
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.closed = True
+
+
+@pytest.mark.asyncio
+async def test_miner_connection_pool(monkeypatch):
+    monkeypatch.setattr(utils, 'create_miner_client', FakeMinerClient)
+    miners = [('fast', '127.0.0.1', 8000), ('slow', '127.0.0.2', 8000)]
+    async with utils.MinerConnectionPool() as pool:
+        await asyncio.wait_for(pool.connect(miners, timeout=0.1), 1)
+        fast, slow = (pool.client(*miner) for miner in miners)
+        assert (fast.connected, slow.connected) == (True, False)
+        assert pool.client(*miners[0]) is fast
+    assert fast.closed and slow.closed
+
+
+@pytest.mark.asyncio
+async def test_initial_job_batch_window(monkeypatch):
+    client = miner_client()
+    client.features = {transport.Feature.job_batches}
+    client.transport_selected.set()
+    sent = []
+
+    async def send_model(model):
+        sent.append(model)
+
+    monkeypatch.setattr(client, 'send_model', send_model)
+
+    def initial_job_request(job_uuid):
+        return V0InitialJobRequest(
+            job_uuid=job_uuid,
+            base_docker_image_name='image',
+            timeout_seconds=60,
+            volume_type=VolumeType.inline,
+        )
+
+    async def job(job_uuid):
+        """Like `_execute_job`, waiting for the miner's answer and removing the job when done or cancelled"""
+        job_state = client.add_job(job_uuid)
+        try:
+            await client.send_initial_job_request(initial_job_request(job_uuid))
+            await job_state.miner_ready_or_declining_future
+        finally:
+            client.remove_job(job_uuid)
+
+    jobs = [asyncio.create_task(job(str(i))) for i in range(3)]
+    await asyncio.sleep(utils.INITIAL_JOB_BATCH_WINDOW / 10)
+    # the job that started the batch is cancelled within its window
+    jobs[0].cancel()
+    await client.initial_job_batch_task
+    jobs.append(asyncio.create_task(job('3')))
+    await asyncio.sleep(utils.INITIAL_JOB_BATCH_WINDOW / 10)
+    await client.initial_job_batch_task
+    assert [[job.job_uuid for job in batch.jobs] for batch in sent] == [['1', '2'], ['3']]
+    for task in jobs:
+        task.cancel()
+    await asyncio.gather(*jobs, return_exceptions=True)
+
+
+class TimedGenerator(EchoSyntheticJobGenerator):
+    instances = []
+
+    def __init__(self):
+        super().__init__()
+        self.instances.append(self)
+        self.time_took = None
+
+    def verify(self, msg, time_took):
+        self.time_took = time_took
+        return super().verify(msg, time_took)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(('subtract_network_time', 'expected_time_took'), [(False, 0.3), (True, 0.3 - 0.1)])
+async def test_network_time(monkeypatch, settings, subtract_network_time, expected_time_took):
+    settings.SYNTHETIC_JOB_SUBTRACT_NETWORK_TIME = subtract_network_time
+    monkeypatch.setattr(current, 'SyntheticJobGenerator', TimedGenerator)
+    client = miner_client()
+    client.transport_selected.set()
+    client.rtt.add(0.4)
+    client.rtt.add(0.1)
+
+    async def reply(msg, delay=0):
+        await asyncio.sleep(delay)
+        await client.handle_message(msg)
+
+    async def send_model(model):
+        if isinstance(model, V0InitialJobRequest):
+            asyncio.create_task(reply(V0ExecutorReadyRequest(job_uuid=model.job_uuid)))
+        elif isinstance(model, V0JobRequest):
+            generator = TimedGenerator.instances[-1]
+            asyncio.create_task(reply(V0JobFinishedRequest(
+                job_uuid=model.job_uuid,
+                docker_process_stdout=generator.payload,
+                docker_process_stderr='',
+            ), delay=0.3))
+
+    monkeypatch.setattr(client, 'send_model', send_model)
+
+    async def asave():
+        pass
+
+    job = SimpleNamespace(job_uuid=uuid.uuid4(), asave=asave)
+    score, msg = await utils._execute_job(job, client)
+    assert (score, job.status) == (1, SyntheticJob.Status.COMPLETED)
+    assert TimedGenerator.instances[-1].time_took == pytest.approx(expected_time_took, abs=0.05)